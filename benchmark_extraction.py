@@ -0,0 +1,168 @@
+# benchmark_extraction.py
+# Confronto dell'estrazione del testo dai PDF:
+#   workers  -> tempo al crescere dei processi (seriale vs intervalli di pagine in parallelo)
+#   backends -> pagine/s, memoria di picco e qualità del testo per ogni backend installato
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional
+
+from pdf_text_extraction import EXTRACTORS, open_extractor, extractor_available, iter_pages, iter_pages_parallel
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+# Lettere isolate separate da spazi ("P r o f. M a r c o"): sintomo di spaziatura dei glifi mal ricostruita
+SPACED_RE = re.compile(r'(?:\b\w\b[ .]{1,2}){3,}\b\w\b', re.UNICODE)
+
+
+def extract_serial(pdf_path: str, backend: str = 'pypdf2') -> List[str]:
+    with open_extractor(backend, pdf_path) as extractor:
+        return [page['text'] for page in iter_pages(extractor)]
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Memoria di picco del processo (resource su Linux/macOS, psutil su Windows se installato)"""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+    except ImportError:
+        try:
+            import psutil
+            return round(psutil.Process().memory_info().peak_wset / 1024 / 1024, 1)
+        except (ImportError, AttributeError):
+            return None
+
+
+def spaced_letters_ratio(text: str) -> float:
+    """Frazione dei caratteri alfanumerici che cadono in sequenze di lettere spaziate"""
+    total = sum(len(word) for word in WORD_RE.findall(text))
+    spaced = sum(len(WORD_RE.findall(match.group())) for match in SPACED_RE.finditer(text))
+    return round(spaced / total, 4) if total else 0.0
+
+
+def word_f1(text: str, reference: str) -> float:
+    """F1 sulle parole (multinsiemi, minuscole) rispetto a un testo di riferimento"""
+    words, expected = Counter(WORD_RE.findall(text.lower())), Counter(WORD_RE.findall(reference.lower()))
+    common = sum((words & expected).values())
+    if not common:
+        return 0.0
+    precision, recall = common / sum(words.values()), common / sum(expected.values())
+    return round(2 * precision * recall / (precision + recall), 4)
+
+
+def measure_backend(backend: str, pdf_path: str) -> Dict:
+    """Eseguito in un processo nuovo per backend: la memoria di picco non risente degli altri"""
+    before = peak_rss_mb()
+    start = time.perf_counter()
+    texts = extract_serial(pdf_path, backend)
+    elapsed = time.perf_counter() - start
+    after = peak_rss_mb()
+    return {
+        'seconds': round(elapsed, 3),
+        'pages_per_second': round(len(texts) / elapsed, 1) if elapsed else None,
+        'peak_rss_mb': after,
+        'extraction_rss_mb': round(after - before, 1) if before is not None and after is not None else None,
+        'texts': texts
+    }
+
+
+def compare_backends(args) -> List[Dict]:
+    backends = args.backends.split(',') if args.backends else [name for name in EXTRACTORS if extractor_available(name)]
+    results = []
+    for pdf_path in args.pdf:
+        # Testo di riferimento opzionale accanto al PDF (es. corso.pdf -> corso.txt)
+        reference_path = os.path.splitext(pdf_path)[0] + '.txt'
+        reference = None
+        if os.path.exists(reference_path):
+            with open(reference_path, 'r', encoding='utf-8') as f:
+                reference = f.read()
+        print(f"📚 {pdf_path}{' (con testo di riferimento)' if reference else ''}")
+
+        for backend in backends:
+            if not extractor_available(backend):
+                print(f"  • {backend}: non installato (pip install {EXTRACTORS[backend].package})")
+                continue
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                result = executor.submit(measure_backend, backend, pdf_path).result()
+            text = '\n\n'.join(result.pop('texts'))
+            result.update(pdf=pdf_path, backend=backend, characters=len(text),
+                          spaced_letters=spaced_letters_ratio(text))
+            if reference is not None:
+                result['word_f1'] = word_f1(text, reference)
+
+            line = (f"  • {backend}: {result['pages_per_second']} pagine/s, picco {result['peak_rss_mb']} MB, "
+                    f"lettere spaziate {result['spaced_letters']:.1%}")
+            if 'word_f1' in result:
+                line += f", F1 parole {result['word_f1']:.3f}"
+            print(line)
+            results.append(result)
+    return results
+
+
+def compare_workers(args) -> List[Dict]:
+    pdf_path = args.pdf[0]
+    cores = os.cpu_count() or 1
+    if args.workers:
+        counts = [int(w) for w in args.workers.split(',')]
+    else:
+        counts = sorted({1, cores} | {2 ** i for i in range(1, cores.bit_length()) if 2 ** i < cores})
+    with open_extractor(args.backend, pdf_path) as extractor:
+        total_pages = len(extractor)
+    print(f"📚 {pdf_path}: {total_pages} pagine, {cores} core, backend {args.backend}")
+
+    results = []
+    baseline = None
+    for workers in counts:
+        start = time.perf_counter()
+        if workers == 1:
+            texts = extract_serial(pdf_path, args.backend)
+        else:
+            texts = [page['text'] for page in
+                     iter_pages_parallel(pdf_path, total_pages, workers, args.range_pages, args.backend)]
+        elapsed = time.perf_counter() - start
+        if baseline is None:
+            baseline = (elapsed, texts if workers == 1 else extract_serial(pdf_path, args.backend))
+
+        result = {'workers': workers, 'seconds': round(elapsed, 3),
+                  'pages_per_second': round(total_pages / elapsed, 1),
+                  'speedup': round(baseline[0] / elapsed, 2), 'identical': texts == baseline[1]}
+        print(f"  • {workers} processi: {result['seconds']} s ({result['pages_per_second']} pagine/s), "
+              f"speedup {result['speedup']}x{'' if result['identical'] else ' ⚠️ testo diverso dal seriale'}")
+        results.append(result)
+    return results
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Benchmark estrazione testo PDF")
+    parser.add_argument('mode', choices=['backends', 'workers'])
+    parser.add_argument('--pdf', action='append', help="PDF di prova (ripetibile)")
+    parser.add_argument('--backends', help="Backend da confrontare, separati da virgola (default: tutti gli installati)")
+    parser.add_argument('--backend', default='pypdf2', choices=list(EXTRACTORS), help="Backend per la modalità workers")
+    parser.add_argument('--workers', help="Processi da provare, separati da virgola (default 1,2,4,...,core)")
+    parser.add_argument('--range-pages', type=int, default=25, help="Pagine per intervallo")
+    parser.add_argument('--output', help="File JSON dei risultati")
+    args = parser.parse_args(argv)
+
+    args.pdf = args.pdf or [os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'source', 'corso_completo.pdf')]
+    missing = [path for path in args.pdf if not os.path.exists(path)]
+    if missing:
+        print(f"❌ PDF non trovati: {', '.join(missing)}")
+        return 1
+
+    results = compare_backends(args) if args.mode == 'backends' else compare_workers(args)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'mode': args.mode, 'cores': os.cpu_count(), 'results': results}, f, indent=2)
+        print(f"💾 Risultati salvati: {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,304 @@
+# benchmark_pipeline.py
+# Benchmark end-to-end offline: PDF sintetico + server stub di OpenAI e Pinecone + PreprocessingPipeline
+# Tempo e throughput per fase, memoria di picco e richieste alle API, salvati in JSON per confrontare i commit
+
+import os
+import sys
+import json
+import time
+import shutil
+import inspect
+import argparse
+import importlib
+import contextlib
+import subprocess
+import multiprocessing
+import urllib.request
+from typing import Dict, List, Optional
+
+from synthetic_pdf import generate_course_pdf
+from benchmark_extraction import peak_rss_mb
+
+PIPELINES = {'text': 'preprocess_v4', 'vision': 'preprocess_v4_vision'}
+
+# Fasi misurate: (nome, oggetto della pipeline, metodi che la implementano)
+STAGES = [
+    ('extraction', 'pdf_processor', ['extract_pdf']),
+    ('vision', 'vision_analyzer', ['process_vision_pages']),
+    ('chunking', 'pdf_processor', ['create_chunks']),
+    ('analysis', None, ['_analyze_chunks', '_analyze_chunks_async', '_analyze_chunks_batch_api']),
+    ('embedding', None, ['_embed_chunks_batched']),
+    ('indexing', 'vector_indexer', ['sync_chunks', 'index_chunks']),
+    ('save', None, ['_save_data'])
+]
+
+
+def serve_stubs(options: Dict, ports: multiprocessing.Queue, stop: multiprocessing.Event):
+    """Processo separato per gli stub: CPU e memoria del benchmark restano quelle della pipeline"""
+    from stub_services import OpenAIStub, PineconeStub
+    openai_stub = OpenAIStub(**options['openai']).start()
+    pinecone_stub = PineconeStub(**options['pinecone']).start()
+    ports.put((openai_stub.url, pinecone_stub.url))
+    stop.wait()
+    openai_stub.stop()
+    pinecone_stub.stop()
+
+
+def stub_stats(url: str) -> Dict:
+    with urllib.request.urlopen(f'{url}/_stats', timeout=10) as response:
+        return json.load(response)
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class StageTimer:
+    """Avvolge i metodi delle fasi: secondi, chiamate e risultato (lunghezza della lista o intero restituito)"""
+
+    def __init__(self):
+        self.stages: Dict[str, Dict] = {}
+
+    def _record(self, stage: str, elapsed: float, result):
+        entry = self.stages.setdefault(stage, {'seconds': 0.0, 'calls': 0, 'items': None})
+        entry['seconds'] += elapsed
+        entry['calls'] += 1
+        count = len(result) if isinstance(result, (list, dict)) else result if isinstance(result, int) else None
+        if count is not None:
+            entry['items'] = (entry['items'] or 0) + count
+
+    def wrap(self, target, method: str, stage: str):
+        original = getattr(target, method, None)
+        if original is None:
+            return
+        timer = self
+
+        if inspect.iscoroutinefunction(original):
+            async def timed(*args, **kwargs):
+                start = time.perf_counter()
+                result = await original(*args, **kwargs)
+                timer._record(stage, time.perf_counter() - start, result)
+                return result
+        else:
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                result = original(*args, **kwargs)
+                timer._record(stage, time.perf_counter() - start, result)
+                return result
+        setattr(target, method, timed)
+
+    def instrument(self, pipeline):
+        """Avvolge i metodi sulle istanze; VisionAnalyzer nasce durante run, quindi si avvolge la classe"""
+        module = sys.modules[type(pipeline).__module__]
+        for stage, attribute, methods in STAGES:
+            if attribute == 'vision_analyzer':
+                target = getattr(module, 'VisionAnalyzer', None)
+            else:
+                target = getattr(pipeline, attribute) if attribute else pipeline
+            for method in methods:
+                if target is not None:
+                    self.wrap(target, method, stage)
+
+
+def configure(config: Dict, work_dir: str, pdf_path: str, openai_url: str, pinecone_url: str, args):
+    """CONFIG della pipeline puntato agli stub, con tutti i file nella cartella di lavoro"""
+    output_dir = os.path.join(work_dir, 'output')
+    for key, value in config['paths'].items():
+        if isinstance(value, str) and key not in ('pdf_source', 'output_dir'):
+            config['paths'][key] = os.path.join(output_dir, value.replace('\\', '/').split('/')[-1])
+    config['paths'].update(pdf_source=pdf_path, output_dir=output_dir)
+    if 'corpus_source' in config['paths']:
+        config['paths']['corpus_source'] = None
+
+    config['openai'].update(api_key='sk-benchmark', base_url=f'{openai_url}/v1', batch_poll_seconds=0.1)
+    # Host del control-plane, non del data-plane: _setup_index fa lookup e verifica della metrica come in produzione
+    config['pinecone'].update(api_key='pc-benchmark', controller_host=pinecone_url, host=None, backend='pinecone')
+    config['processing']['max_chunks_to_process'] = None
+    config['processing']['extractor'] = args.extractor
+    if args.streaming:
+        config['processing']['streaming'] = True
+    if args.batch_api:
+        config['processing']['batch_api'] = True
+    if args.async_analysis:
+        config['processing']['async_analysis'] = True
+    if args.dedup:
+        config['processing']['dedup'] = True
+    if args.sparse:
+        config['pinecone']['sparse_vectors'] = True
+    # Senza cache ogni esecuzione fa tutte le chiamate: i tempi sono confrontabili
+    config['cache']['enable'] = args.cache
+
+
+def run_pipeline(args, work_dir: str, pdf_path: str, openai_url: str, pinecone_url: str) -> Dict:
+    module = importlib.import_module(PIPELINES[args.pipeline])
+    configure(module.CONFIG, work_dir, pdf_path, openai_url, pinecone_url, args)
+
+    timer = StageTimer()
+    log_path = os.path.join(work_dir, f'pipeline_{args.pipeline}.log')
+    rss_before = peak_rss_mb()
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    with open(log_path, 'w', encoding='utf-8') as log, \
+            contextlib.redirect_stdout(log if args.quiet else sys.stdout):
+        pipeline = module.PreprocessingPipeline()
+        timer.instrument(pipeline)
+        pipeline.run()
+    elapsed = time.perf_counter() - start
+
+    # run() intercetta le eccezioni: il metadata scritto alla fine è la prova del completamento
+    metadata_path = module.CONFIG['paths']['metadata_file']
+    metadata = None
+    if os.path.exists(metadata_path):
+        with open(metadata_path, 'r', encoding='utf-8') as f:
+            metadata = json.load(f)
+    return {
+        'completed': metadata is not None,
+        'seconds': round(elapsed, 3),
+        'cpu_seconds': round(time.process_time() - cpu_start, 3),
+        'peak_rss_mb': peak_rss_mb(),
+        'rss_before_run_mb': rss_before,
+        'stages': timer.stages,
+        'metrics': pipeline.metrics.summary(),
+        'usage': pipeline.semantic_analyzer.usage.to_dict(),
+        'chunks': metadata['processing']['total_chunks'] if metadata else None,
+        'indexed_vectors': metadata['processing']['indexed_vectors'] if metadata else None,
+        'log': log_path if args.quiet else None
+    }
+
+
+def add_throughput(result: Dict, pages: int):
+    """Unità per secondo di ogni fase (pagine per l'estrazione, chunks o vettori per le altre)"""
+    for stage, entry in result['stages'].items():
+        items = pages if stage == 'extraction' else entry['items']
+        if stage == 'embedding':
+            items = result['stages'].get('analysis', {}).get('items')
+        elif stage == 'save':
+            items = result['chunks']
+        entry['seconds'] = round(entry['seconds'], 3)
+        entry['items'] = items
+        entry['per_second'] = round(items / entry['seconds'], 1) if items and entry['seconds'] else None
+
+
+def compare(current: Dict, previous: Dict, threshold: float) -> List[str]:
+    """Fasi più lente del riferimento oltre la soglia relativa"""
+    regressions = []
+    print(f"\n📈 Confronto con {previous.get('commit', '?')[:10]}:")
+    rows = [('totale', current['run']['seconds'], previous['run']['seconds'])]
+    for stage, entry in current['run']['stages'].items():
+        before = previous['run']['stages'].get(stage)
+        if before:
+            rows.append((stage, entry['seconds'], before['seconds']))
+    rows.append(('memoria di picco (MB)', current['run']['peak_rss_mb'], previous['run']['peak_rss_mb']))
+
+    for name, now, before in rows:
+        if not now or not before:
+            continue
+        change = (now - before) / before
+        # Sotto un decimo di secondo la differenza è rumore di misura
+        flag = ' ⚠️' if change > threshold and now - before > 0.1 else ''
+        print(f"  • {name}: {before} → {now} ({change:+.1%}){flag}")
+        if flag:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Benchmark offline della pipeline con PDF sintetico e API stub")
+    parser.add_argument('--pipeline', choices=list(PIPELINES), default='text')
+    parser.add_argument('--pages', type=int, default=100, help="Pagine del PDF sintetico")
+    parser.add_argument('--table-ratio', type=float, default=0.15)
+    parser.add_argument('--image-ratio', type=float, default=0.15)
+    parser.add_argument('--duplicate-ratio', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--openai-latency-ms', type=float, default=50)
+    parser.add_argument('--pinecone-latency-ms', type=float, default=20)
+    parser.add_argument('--jitter-ms', type=float, default=10)
+    parser.add_argument('--error-rate', type=float, default=0, help="Frazione di richieste stub che falliscono (429/5xx)")
+    parser.add_argument('--extractor', default='pypdf2', help="Backend di estrazione del testo")
+    parser.add_argument('--streaming', action='store_true')
+    parser.add_argument('--batch-api', action='store_true')
+    parser.add_argument('--async-analysis', action='store_true', help="Analisi ed embedding concorrenti con AsyncOpenAI")
+    parser.add_argument('--dedup', action='store_true', help="Deduplicazione dei chunks quasi identici")
+    parser.add_argument('--sparse', action='store_true', help="Vettori sparse BM25 (richiedono --pinecone-metric dotproduct)")
+    parser.add_argument('--pinecone-metric', choices=['cosine', 'dotproduct'], default='cosine',
+                        help="Metrica dell'indice stub riportata da describe_index")
+    parser.add_argument('--cache', action='store_true', help="Mantiene la cache locale (di default disabilitata)")
+    parser.add_argument('--work-dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'benchmark'), help="Cartella di lavoro (svuotata a ogni esecuzione)")
+    parser.add_argument('--output', help="File JSON dei risultati (default: nella cartella di lavoro, per commit)")
+    parser.add_argument('--compare', help="Risultati JSON di un'esecuzione precedente")
+    parser.add_argument('--threshold', type=float, default=0.1, help="Rallentamento relativo segnalato come regressione")
+    parser.add_argument('--quiet', action='store_true', help="Output della pipeline nel log della cartella di lavoro")
+    args = parser.parse_args(argv)
+
+    work_dir = os.path.abspath(args.work_dir)
+    shutil.rmtree(os.path.join(work_dir, 'output'), ignore_errors=True)
+    os.makedirs(os.path.join(work_dir, 'output'), exist_ok=True)
+
+    pdf_path = os.path.join(work_dir, f'synthetic_{args.pages}p_seed{args.seed}.pdf')
+    composition = generate_course_pdf(pdf_path, args.pages, args.table_ratio, args.image_ratio,
+                                      args.duplicate_ratio, args.seed)
+    composition.pop('expected_text')
+    print(f"📄 PDF sintetico: {pdf_path} {composition['kinds']}")
+
+    options = {
+        'openai': {'latency_ms': args.openai_latency_ms, 'jitter_ms': args.jitter_ms,
+                   'error_rate': args.error_rate, 'seed': args.seed},
+        'pinecone': {'latency_ms': args.pinecone_latency_ms, 'jitter_ms': args.jitter_ms,
+                     'error_rate': args.error_rate, 'seed': args.seed + 1, 'metric': args.pinecone_metric,
+                     'index_name': importlib.import_module(PIPELINES[args.pipeline]).CONFIG['pinecone']['index_name']}
+    }
+    ports, stop = multiprocessing.Queue(), multiprocessing.Event()
+    stubs = multiprocessing.Process(target=serve_stubs, args=(options, ports, stop), daemon=True)
+    stubs.start()
+    try:
+        openai_url, pinecone_url = ports.get(timeout=30)
+        print(f"🤖 Stub OpenAI {openai_url} • 🌲 Stub Pinecone {pinecone_url}\n")
+        run = run_pipeline(args, work_dir, pdf_path, openai_url, pinecone_url)
+        requests = {'openai': stub_stats(openai_url), 'pinecone': stub_stats(pinecone_url)}
+    finally:
+        stop.set()
+        stubs.join(timeout=10)
+
+    add_throughput(run, args.pages)
+    commit = git_commit()
+    result = {
+        'commit': commit,
+        'created_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'cores': os.cpu_count(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('compare', 'output', 'quiet')},
+        'pdf': composition,
+        'run': run,
+        'requests': requests
+    }
+
+    print(f"\n{'✅' if run['completed'] else '❌'} Pipeline {args.pipeline}: {run['seconds']} s "
+          f"(CPU {run['cpu_seconds']} s), picco {run['peak_rss_mb']} MB")
+    for stage, entry in run['stages'].items():
+        rate = f", {entry['per_second']}/s" if entry['per_second'] else ''
+        print(f"  • {stage}: {entry['seconds']} s ({entry['items']} elementi{rate})")
+    for service, stats in requests.items():
+        print(f"  • {service}: {stats['total_requests']} richieste, {stats['total_errors']} errori simulati")
+    print(f"  • Token: {run['usage']['total_tokens']} (costo a listino ${run['usage']['total_cost_usd']:.4f})")
+
+    output = args.output or os.path.join(work_dir, f"benchmark_{args.pipeline}_{(commit or 'nocommit')[:8]}.json")
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, indent=2)
+    print(f"💾 Risultati salvati: {output}")
+
+    if not run['completed']:
+        print(f"❌ La pipeline non ha completato l'esecuzione{': vedi ' + run['log'] if run['log'] else ''}")
+        return 1
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            previous = json.load(f)
+        if compare(result, previous, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
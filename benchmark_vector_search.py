@@ -0,0 +1,99 @@
+# benchmark_vector_search.py
+# Latenza di ricerca dell'indice locale al crescere del corpus: forza bruta a blocchi vs IVF
+# Vettori sintetici a cluster (come embedding di argomenti diversi), query vicine ai dati
+
+import sys
+import json
+import time
+import argparse
+from typing import Dict, List
+
+import numpy as np
+
+from local_vector_index import LocalVectorIndex
+
+
+def synthetic_corpus(size: int, dimension: int, clusters: int, rng: np.random.Generator) -> np.ndarray:
+    """Vettori raggruppati attorno a `clusters` centri casuali"""
+    centers = rng.standard_normal((clusters, dimension)).astype(np.float32)
+    labels = rng.integers(0, clusters, size)
+    return centers[labels] + 0.6 * rng.standard_normal((size, dimension)).astype(np.float32)
+
+
+def percentiles(samples: List[float]) -> Dict:
+    values = np.array(samples) * 1000
+    return {'p50_ms': round(float(np.percentile(values, 50)), 3),
+            'p95_ms': round(float(np.percentile(values, 95)), 3)}
+
+
+def run(size: int, args, rng: np.random.Generator) -> Dict:
+    corpus = synthetic_corpus(size, args.dimension, args.clusters, rng)
+    queries = corpus[rng.integers(0, size, args.queries)] + 0.3 * rng.standard_normal(
+        (args.queries, args.dimension)).astype(np.float32)
+
+    index = LocalVectorIndex(args.dimension, block_size=args.block_size, nlist=args.nlist, nprobe=args.nprobe)
+    start = time.perf_counter()
+    index.upsert([{'id': f'v{i}', 'values': row, 'metadata': {}} for i, row in enumerate(corpus)])
+    load_s = time.perf_counter() - start
+
+    exact_times, exact_rows = [], []
+    for query in queries:
+        start = time.perf_counter()
+        _, rows = index.search(query, args.top_k, exact=True)
+        exact_times.append(time.perf_counter() - start)
+        exact_rows.append(set(rows[0].tolist()))
+
+    result = {'size': size, 'load_s': round(load_s, 3), 'exact': percentiles(exact_times)}
+
+    if args.nlist:
+        start = time.perf_counter()
+        index.build_ivf()
+        build_s = time.perf_counter() - start
+
+        ivf_times, recalls = [], []
+        for query, truth in zip(queries, exact_rows):
+            start = time.perf_counter()
+            _, rows = index.search(query, args.top_k, exact=False)
+            ivf_times.append(time.perf_counter() - start)
+            recalls.append(len(truth & set(rows[0].tolist())) / args.top_k)
+
+        result['ivf'] = dict(percentiles(ivf_times), build_s=round(build_s, 3),
+                             recall_at_k=round(float(np.mean(recalls)), 3))
+    return result
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Benchmark latenza ricerca vettoriale locale")
+    parser.add_argument('--sizes', default='1000,10000,50000', help="Dimensioni del corpus separate da virgola")
+    parser.add_argument('--dimension', type=int, default=1536)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--top-k', type=int, default=15)  # Come topK in api/analyze-v4-rag.js
+    parser.add_argument('--block-size', type=int, default=8192)
+    parser.add_argument('--nlist', type=int, default=64, help="Liste IVF (0 = solo forza bruta)")
+    parser.add_argument('--nprobe', type=int, default=8)
+    parser.add_argument('--clusters', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="File JSON dei risultati")
+    args = parser.parse_args(argv)
+
+    rng = np.random.default_rng(args.seed)
+    results = []
+    for size in (int(s) for s in args.sizes.split(',')):
+        print(f"⏱️ Corpus di {size} vettori ({args.dimension} dimensioni)...")
+        result = run(size, args, rng)
+        line = f"  • Forza bruta: p50 {result['exact']['p50_ms']} ms, p95 {result['exact']['p95_ms']} ms"
+        if 'ivf' in result:
+            ivf = result['ivf']
+            line += f" • IVF: p50 {ivf['p50_ms']} ms, p95 {ivf['p95_ms']} ms, recall@{args.top_k} {ivf['recall_at_k']:.0%}"
+        print(line)
+        results.append(result)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'config': vars(args), 'results': results}, f, indent=2)
+        print(f"💾 Risultati salvati: {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,223 @@
+# bm25_index.py
+# Indice lessicale BM25 dei chunks: dizionario dei termini, posting list delta-encoded in array compatti
+# e norme di documento precalcolate. Risponde localmente a domande con parole chiave esatte (codici, numeri)
+
+import os
+import re
+import sys
+import json
+import time
+import heapq
+import argparse
+import unicodedata
+from math import log
+from array import array
+from itertools import accumulate
+from operator import itemgetter
+from typing import Dict, Iterable, List, Tuple
+
+# Cartella dei dati della pipeline (default dei comandi), relativa allo script
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'processed-v4')
+
+# Stesse stopword del preprocessing JS (advanced-text-preprocessing.js), senza accenti
+STOPWORDS = {
+    'il', 'la', 'di', 'che', 'e', 'a', 'un', 'in', 'con', 'per', 'da', 'su',
+    'i', 'le', 'del', 'della', 'dei', 'delle', 'al', 'alla', 'dal', 'dalla',
+    'nel', 'nella', 'sul', 'sulla', 'sono', 'questo', 'questa', 'lo', 'gli',
+    'una', 'non', 'si', 'o', 'ed', 'come', 'anche', 'piu'
+}
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+# Sezioni binarie dell'indice: nome -> typecode dell'array
+SECTIONS = {'offsets': 'I', 'doc_deltas': 'I', 'term_freqs': 'H', 'norms': 'f', 'idf': 'f'}
+
+
+def tokenize(text: str) -> List[str]:
+    """Minuscolo, senza accenti, parole e numeri interi ("1000" resta un termine)"""
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return [token for token in TOKEN_RE.findall(text)
+            if token not in STOPWORDS and (len(token) > 1 or token.isdigit())]
+
+
+class BM25Index:
+    """Indice BM25 in sola lettura, costruito dai chunks con build()"""
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.terms: List[str] = []
+        self.term_ids: Dict[str, int] = {}
+        self.doc_ids: List[str] = []
+        self.avgdl = 0.0
+        self.offsets = array('I', [0])     # Posting del termine t in [offsets[t], offsets[t+1])
+        self.doc_deltas = array('I')       # Documenti come differenze dal precedente
+        self.term_freqs = array('H')       # Frequenza del termine nel documento
+        self.norms = array('f')            # k1 * (1 - b + b * |d| / avgdl) per documento
+        self.idf = array('f')
+
+    @classmethod
+    def build(cls, documents: Iterable[Tuple[str, str]], k1: float = 1.2, b: float = 0.75) -> 'BM25Index':
+        """Costruisce l'indice da coppie (id chunk, testo)"""
+        index = cls(k1, b)
+        postings: Dict[str, Tuple[array, array]] = {}
+        lengths = []
+
+        for doc, (doc_id, text) in enumerate(documents):
+            index.doc_ids.append(doc_id)
+            counts: Dict[str, int] = {}
+            tokens = tokenize(text)
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            lengths.append(len(tokens))
+            for term, tf in counts.items():
+                docs, freqs = postings.setdefault(term, (array('I'), array('H')))
+                docs.append(doc)
+                freqs.append(min(tf, 65535))
+
+        n_docs = len(lengths)
+        index.avgdl = sum(lengths) / n_docs if n_docs else 0.0
+        index.norms = array('f', (k1 * (1 - b + b * length / (index.avgdl or 1)) for length in lengths))
+
+        index.terms = sorted(postings)
+        index.term_ids = {term: term_id for term_id, term in enumerate(index.terms)}
+        for term in index.terms:
+            docs, freqs = postings[term]
+            # I documenti arrivano in ordine crescente: le differenze sono piccole e non negative
+            previous = 0
+            for doc in docs:
+                index.doc_deltas.append(doc - previous)
+                previous = doc
+            index.term_freqs.extend(freqs)
+            index.offsets.append(len(index.doc_deltas))
+            index.idf.append(_idf(n_docs, len(docs)))
+        return index
+
+    def postings(self, term_id: int) -> Tuple[Iterable[int], array]:
+        """Documenti (decodificati) e frequenze della posting list di un termine"""
+        start, end = self.offsets[term_id], self.offsets[term_id + 1]
+        return accumulate(self.doc_deltas[start:end]), self.term_freqs[start:end]
+
+    def search(self, text: str, top_k: int = 10) -> List[Tuple[str, float]]:
+        """Top-k (id chunk, punteggio BM25) per il testo della domanda"""
+        scores: Dict[int, float] = {}
+        k1 = self.k1
+        norms = self.norms
+
+        for term in set(tokenize(text)):
+            term_id = self.term_ids.get(term)
+            if term_id is None:
+                continue
+            idf = self.idf[term_id]
+            docs, freqs = self.postings(term_id)
+            for doc, tf in zip(docs, freqs):
+                scores[doc] = scores.get(doc, 0.0) + idf * tf * (k1 + 1) / (tf + norms[doc])
+
+        best = heapq.nlargest(top_k, scores.items(), key=itemgetter(1))
+        return [(self.doc_ids[doc], round(score, 4)) for doc, score in best]
+
+    def stats(self) -> Dict:
+        return {
+            'documents': len(self.doc_ids),
+            'terms': len(self.terms),
+            'postings': len(self.doc_deltas),
+            'avgdl': round(self.avgdl, 2),
+            'postings_bytes': sum(getattr(self, name).itemsize * len(getattr(self, name)) for name in SECTIONS)
+        }
+
+    def save(self, path: str):
+        """Salva dizionario e ID in JSON (path) e gli array in un file binario accanto (path + '.bin')"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        sections = {}
+        with open(path + '.bin.tmp', 'wb') as f:
+            for name, typecode in SECTIONS.items():
+                values = getattr(self, name)
+                sections[name] = {'offset': f.tell(), 'count': len(values), 'typecode': typecode}
+                values.tofile(f)
+        os.replace(path + '.bin.tmp', path + '.bin')
+
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({
+                'version': 1,
+                'k1': self.k1,
+                'b': self.b,
+                'avgdl': self.avgdl,
+                'byteorder': sys.byteorder,
+                'sections': sections,
+                'terms': self.terms,
+                'doc_ids': self.doc_ids
+            }, f, ensure_ascii=False)
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path: str) -> 'BM25Index':
+        with open(path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+
+        index = cls(meta['k1'], meta['b'])
+        index.avgdl = meta['avgdl']
+        index.terms = meta['terms']
+        index.term_ids = {term: term_id for term_id, term in enumerate(index.terms)}
+        index.doc_ids = meta['doc_ids']
+
+        with open(path + '.bin', 'rb') as f:
+            for name, section in meta['sections'].items():
+                values = array(section['typecode'])
+                f.seek(section['offset'])
+                values.fromfile(f, section['count'])
+                if meta['byteorder'] != sys.byteorder:
+                    values.byteswap()
+                setattr(index, name, values)
+        return index
+
+
+def _idf(n_docs: int, df: int) -> float:
+    """IDF di BM25 sempre positivo (anche per termini presenti in più di metà dei documenti)"""
+    return log(1 + (n_docs - df + 0.5) / (df + 0.5))
+
+
+def main(argv: List[str] = None):
+    """Comandi: build --chunks FILE | query TESTO [--top-k N] | stats"""
+    parser = argparse.ArgumentParser(description="Indice BM25 dei chunks")
+    parser.add_argument('command', choices=['build', 'query', 'stats'])
+    parser.add_argument('text', nargs='?', help="Testo della domanda (query)")
+    parser.add_argument('--index', default=os.path.join(DATA_DIR, 'bm25_vision.json'), help="File dell'indice")
+    parser.add_argument('--chunks', default=os.path.join(DATA_DIR, 'chunks_vision.json'), help="Chunks da indicizzare")
+    parser.add_argument('--top-k', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        with open(args.chunks, 'r', encoding='utf-8') as f:
+            chunks = json.load(f)
+        index = BM25Index.build((chunk['id'], chunk['text']) for chunk in chunks)
+        index.save(args.index)
+        print(json.dumps(index.stats(), indent=2))
+        return 0
+
+    if not os.path.exists(args.index):
+        print(f"❌ Indice non trovato: {args.index}")
+        return 1
+    index = BM25Index.load(args.index)
+
+    if args.command == 'stats':
+        print(json.dumps(index.stats(), indent=2))
+        return 0
+
+    if not args.text:
+        print("❌ Indicare il testo della domanda")
+        return 1
+    start = time.perf_counter()
+    results = index.search(args.text, args.top_k)
+    elapsed = (time.perf_counter() - start) * 1000
+    for chunk_id, score in results:
+        print(f"  {score:8.4f}  {chunk_id}")
+    print(f"⏱️ {elapsed:.3f} ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,200 @@
+# content_cache.py
+# Cache persistente (SQLite) per analisi ed embedding dei chunks
+# Chiave = hash di (testo, modello, versione prompt): i chunks invariati non si ripagano
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+from array import array
+from typing import Any, Dict, List, Optional
+
+# Cartella dei dati della pipeline (default dei comandi), relativa allo script
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'processed-v4')
+
+
+class ContentCache:
+    """Cache key/value su SQLite con statistiche hit/miss e limite di dimensione LRU"""
+
+    def __init__(self, db_path: str, max_bytes: Optional[int] = None):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.hits = {}
+        self.misses = {}
+
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                namespace TEXT NOT NULL,
+                model TEXT,
+                encoding TEXT NOT NULL,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_lru ON entries(last_access)")
+        self.conn.commit()
+
+        row = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()
+        self.total_bytes = row[0]
+
+    @staticmethod
+    def make_key(namespace: str, text: str, model: str, prompt_version: str = '', extra: Any = None) -> str:
+        """Calcola la chiave content-addressed per un input"""
+        payload = json.dumps([namespace, text, model, prompt_version, extra],
+                             ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _encode(value: Any) -> tuple:
+        """Embedding come array binario di double, il resto come JSON"""
+        if isinstance(value, list) and value and all(isinstance(v, float) for v in value):
+            return 'f64', array('d', value).tobytes()
+        return 'json', json.dumps(value, ensure_ascii=False).encode('utf-8')
+
+    @staticmethod
+    def _decode(encoding: str, blob: bytes) -> Any:
+        if encoding == 'f64':
+            values = array('d')
+            values.frombytes(blob)
+            return values.tolist()
+        return json.loads(blob.decode('utf-8'))
+
+    def get(self, namespace: str, key: str) -> Optional[Any]:
+        """Restituisce il valore in cache (o None) e aggiorna l'ordine LRU"""
+        row = self.conn.execute(
+            "SELECT encoding, value FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+
+        if row is None:
+            self.misses[namespace] = self.misses.get(namespace, 0) + 1
+            return None
+
+        self.hits[namespace] = self.hits.get(namespace, 0) + 1
+        self.conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+        self.conn.commit()
+        return self._decode(row[0], row[1])
+
+    def put(self, namespace: str, key: str, value: Any, model: str = None):
+        """Salva un valore ed eventualmente libera spazio (LRU)"""
+        encoding, blob = self._encode(value)
+        now = time.time()
+
+        old = self.conn.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+        if old:
+            self.total_bytes -= old[0]
+
+        self.conn.execute(
+            "INSERT OR REPLACE INTO entries (key, namespace, model, encoding, value, size, created_at, last_access) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (key, namespace, model, encoding, blob, len(blob), now, now)
+        )
+        self.total_bytes += len(blob)
+        self.conn.commit()
+
+        if self.max_bytes and self.total_bytes > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        """Elimina le voci usate meno di recente finché si rientra nel limite"""
+        # Scende al 90% del limite per non rifare l'eviction ad ogni put
+        target = int(self.max_bytes * 0.9)
+        evicted = 0
+        rows = self.conn.execute("SELECT key, size FROM entries ORDER BY last_access ASC")
+        to_delete = []
+        for key, size in rows:
+            if self.total_bytes <= target:
+                break
+            to_delete.append((key,))
+            self.total_bytes -= size
+            evicted += 1
+
+        self.conn.executemany("DELETE FROM entries WHERE key = ?", to_delete)
+        self.conn.commit()
+        return evicted
+
+    def invalidate(self, namespace: str = None, model: str = None) -> int:
+        """Cancella le voci (tutte, o filtrate per namespace/modello)"""
+        conditions, params = [], []
+        if namespace:
+            conditions.append("namespace = ?")
+            params.append(namespace)
+        if model:
+            conditions.append("model = ?")
+            params.append(model)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        deleted = self.conn.execute(f"DELETE FROM entries{where}", params).rowcount
+        self.conn.commit()
+
+        row = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()
+        self.total_bytes = row[0]
+        return deleted
+
+    def stats(self) -> Dict:
+        """Statistiche della cache e hit/miss della sessione corrente"""
+        namespaces = {}
+        for namespace, count, size in self.conn.execute(
+            "SELECT namespace, COUNT(*), SUM(size) FROM entries GROUP BY namespace"
+        ):
+            namespaces[namespace] = {'entries': count, 'bytes': size}
+
+        for namespace in set(self.hits) | set(self.misses):
+            entry = namespaces.setdefault(namespace, {'entries': 0, 'bytes': 0})
+            entry['hits'] = self.hits.get(namespace, 0)
+            entry['misses'] = self.misses.get(namespace, 0)
+
+        hits = sum(self.hits.values())
+        misses = sum(self.misses.values())
+        return {
+            'db_path': self.db_path,
+            'total_bytes': self.total_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / (hits + misses) if hits + misses else 0.0,
+            'namespaces': namespaces
+        }
+
+    def close(self):
+        self.conn.close()
+
+
+def main(argv: List[str] = None):
+    """Comandi: stats | invalidate [--namespace N] [--model M]"""
+    parser = argparse.ArgumentParser(description="Gestione cache analisi/embedding")
+    parser.add_argument('command', choices=['stats', 'invalidate'])
+    parser.add_argument('--db', default=os.path.join(DATA_DIR, 'cache.sqlite'), help="Percorso database cache")
+    parser.add_argument('--namespace', help="Es. analysis, embedding")
+    parser.add_argument('--model', help="Solo le voci di questo modello")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.db):
+        print(f"❌ Cache non trovata: {args.db}")
+        return 1
+
+    cache = ContentCache(args.db)
+    try:
+        if args.command == 'stats':
+            print(json.dumps(cache.stats(), indent=2))
+        else:
+            deleted = cache.invalidate(args.namespace, args.model)
+            print(f"🗑️ Eliminate {deleted} voci dalla cache")
+    finally:
+        cache.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
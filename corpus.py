@@ -0,0 +1,72 @@
+# corpus.py
+# Elenco dei PDF di un corpus (cartella o manifest) con identificativi stabili per documento
+# Gli ID fanno da namespace per i chunks: "<documento>:chunk_N"
+
+import os
+import re
+import sys
+import json
+import argparse
+from typing import Dict, List
+
+
+def document_id(path: str) -> str:
+    """ID leggibile dal nome del file: minuscolo, solo lettere, cifre e trattini"""
+    stem = os.path.splitext(os.path.basename(path))[0].lower()
+    return re.sub(r'[^a-z0-9]+', '-', stem).strip('-') or 'documento'
+
+
+def discover_documents(source: str) -> List[Dict]:
+    """Documenti da una cartella di PDF o da un manifest.
+
+    Il manifest è un JSON (lista di path o di oggetti {"path", "id"}) oppure un
+    file di testo con un path per riga; i path relativi partono dal manifest.
+    """
+    if os.path.isdir(source):
+        entries = [os.path.join(source, name) for name in sorted(os.listdir(source))
+                   if name.lower().endswith('.pdf')]
+    else:
+        base = os.path.dirname(os.path.abspath(source))
+        with open(source, 'r', encoding='utf-8') as f:
+            if source.lower().endswith('.json'):
+                entries = json.load(f)
+            else:
+                entries = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+        entries = [dict(entry, path=os.path.join(base, entry['path'])) if isinstance(entry, dict)
+                   else os.path.join(base, entry) for entry in entries]
+
+    documents = []
+    used = set()
+    for entry in entries:
+        path = entry['path'] if isinstance(entry, dict) else entry
+        doc_id = entry.get('id') if isinstance(entry, dict) and entry.get('id') else document_id(path)
+        # Nomi uguali in cartelle diverse: suffisso numerico
+        unique, n = doc_id, 2
+        while unique in used:
+            unique, n = f'{doc_id}-{n}', n + 1
+        used.add(unique)
+        documents.append({'id': unique, 'path': path})
+
+    if not documents:
+        raise FileNotFoundError(f"Nessun PDF trovato in {source}")
+    missing = [doc['path'] for doc in documents if not os.path.exists(doc['path'])]
+    if missing:
+        raise FileNotFoundError(f"PDF non trovati: {', '.join(missing)}")
+    return documents
+
+
+def main(argv: List[str] = None):
+    """Mostra i documenti che la modalità corpus elaborerebbe"""
+    parser = argparse.ArgumentParser(description="Documenti di un corpus di PDF")
+    parser.add_argument('source', help="Cartella di PDF o manifest (.json / .txt)")
+    args = parser.parse_args(argv)
+
+    documents = discover_documents(args.source)
+    for doc in documents:
+        print(f"  • {doc['id']}: {doc['path']} ({os.path.getsize(doc['path']) / 1024 / 1024:.1f} MB)")
+    print(f"📚 {len(documents)} documenti")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
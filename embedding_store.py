@@ -0,0 +1,175 @@
+# embedding_store.py
+# Archivio locale degli embedding: matrice NumPy memory-mapped + tabella degli ID dei chunks
+# La riga i della matrice è l'embedding del chunk ids[i]; l'apertura non copia i dati
+
+import os
+import sys
+import json
+import time
+import argparse
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+# Cartella dei dati della pipeline (default dei comandi), relativa allo script
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'processed-v4')
+
+DATA_FILE = 'embeddings.bin'
+META_FILE = 'embeddings.json'
+DTYPES = {'float16', 'float32'}
+
+
+class EmbeddingStore:
+    """Embedding in float16/float32 su file binario, allineati riga per riga agli ID"""
+
+    def __init__(self, directory: str, dimension: Optional[int] = None, dtype: str = 'float16',
+                 model: Optional[str] = None):
+        self.directory = directory
+        self.data_path = os.path.join(directory, DATA_FILE)
+        self.meta_path = os.path.join(directory, META_FILE)
+        self.ids: List[str] = []
+        self.dimension = dimension
+        self.dtype = dtype
+        self.model = model
+
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            for key, expected in (('dimension', dimension), ('dtype', dtype if dimension else None), ('model', model)):
+                if expected is not None and meta.get(key) != expected:
+                    raise ValueError(f"Archivio {directory} creato con {key}={meta.get(key)}, richiesto {expected}")
+            self.ids = meta['ids']
+            self.dimension = meta['dimension']
+            self.dtype = meta['dtype']
+            self.model = meta.get('model')
+        elif dimension is None:
+            raise FileNotFoundError(f"Archivio embedding non trovato: {directory}")
+
+        if self.dtype not in DTYPES:
+            raise ValueError(f"dtype non supportato: {self.dtype} (usa {', '.join(sorted(DTYPES))})")
+        self.rows: Dict[str, int] = {chunk_id: row for row, chunk_id in enumerate(self.ids)}
+
+    @classmethod
+    def open(cls, directory: str) -> 'EmbeddingStore':
+        """Apre un archivio esistente con dimensione e dtype registrati"""
+        return cls(directory)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, chunk_id: str) -> bool:
+        return chunk_id in self.rows
+
+    @property
+    def row_bytes(self) -> int:
+        return self.dimension * np.dtype(self.dtype).itemsize
+
+    def vectors(self, writable: bool = False) -> np.ndarray:
+        """Matrice (n, dimension) mappata dal file, senza copia"""
+        if not self.ids:
+            return np.empty((0, self.dimension), dtype=self.dtype)
+        return np.memmap(self.data_path, dtype=self.dtype, mode='r+' if writable else 'r',
+                         shape=(len(self.ids), self.dimension))
+
+    def get(self, chunk_id: str) -> Optional[np.ndarray]:
+        row = self.rows.get(chunk_id)
+        return None if row is None else self.vectors()[row]
+
+    def _as_matrix(self, vectors: Sequence[Sequence[float]]) -> np.ndarray:
+        matrix = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dimension)
+        return matrix.astype(self.dtype, copy=False)
+
+    def upsert(self, ids: Sequence[str], vectors: Sequence[Sequence[float]]) -> int:
+        """Aggiorna in place le righe esistenti e accoda le nuove; restituisce le righe accodate"""
+        matrix = self._as_matrix(vectors)
+        if len(ids) != len(matrix):
+            raise ValueError(f"{len(ids)} ID per {len(matrix)} vettori")
+        os.makedirs(self.directory, exist_ok=True)
+
+        existing = [(i, self.rows[chunk_id]) for i, chunk_id in enumerate(ids) if chunk_id in self.rows]
+        if existing:
+            mapped = self.vectors(writable=True)
+            for i, row in existing:
+                mapped[row] = matrix[i]
+            mapped.flush()
+            del mapped
+
+        new = [i for i, chunk_id in enumerate(ids) if chunk_id not in self.rows]
+        if new:
+            with open(self.data_path, 'ab') as f:
+                # Righe oltre la tabella ID (scrittura interrotta prima del meta) vanno scartate
+                f.truncate(len(self.ids) * self.row_bytes)
+                f.write(np.ascontiguousarray(matrix[new]).tobytes())
+            for i in new:
+                self.rows[ids[i]] = len(self.ids)
+                self.ids.append(ids[i])
+
+        self._save_meta()
+        return len(new)
+
+    def compact(self, keep_ids: Sequence[str]) -> int:
+        """Riscrive l'archivio con i soli ID indicati (nell'ordine dato); restituisce le righe rimosse"""
+        keep = [chunk_id for chunk_id in keep_ids if chunk_id in self.rows]
+        removed = len(self.ids) - len(keep)
+        if removed == 0 and keep == self.ids:
+            return 0
+
+        tmp = self.data_path + '.tmp'
+        source = self.vectors()
+        with open(tmp, 'wb') as f:
+            for start in range(0, len(keep), 4096):
+                rows = [self.rows[chunk_id] for chunk_id in keep[start:start + 4096]]
+                f.write(np.ascontiguousarray(source[rows]).tobytes())
+        del source
+        os.replace(tmp, self.data_path)
+
+        self.ids = list(keep)
+        self.rows = {chunk_id: row for row, chunk_id in enumerate(self.ids)}
+        self._save_meta()
+        return removed
+
+    def _save_meta(self):
+        """Scrittura atomica della tabella ID (dopo i dati: il meta non punta mai a righe mancanti)"""
+        tmp = self.meta_path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({
+                'dimension': self.dimension,
+                'dtype': self.dtype,
+                'model': self.model,
+                'count': len(self.ids),
+                'updated_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'ids': self.ids
+            }, f, ensure_ascii=False)
+        os.replace(tmp, self.meta_path)
+
+    def stats(self) -> Dict:
+        return {
+            'count': len(self.ids),
+            'dimension': self.dimension,
+            'dtype': self.dtype,
+            'model': self.model,
+            'total_bytes': len(self.ids) * self.row_bytes
+        }
+
+
+def main(argv: List[str] = None):
+    """Comandi: info [--dir PATH]"""
+    parser = argparse.ArgumentParser(description="Archivio locale degli embedding")
+    parser.add_argument('command', choices=['info'])
+    parser.add_argument('--dir', default=os.path.join(DATA_DIR, 'embeddings_vision'), help="Cartella dell'archivio")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(os.path.join(args.dir, META_FILE)):
+        print(f"❌ Archivio non trovato: {args.dir}")
+        return 1
+
+    start = time.perf_counter()
+    store = EmbeddingStore.open(args.dir)
+    vectors = store.vectors()
+    elapsed = (time.perf_counter() - start) * 1000
+    print(json.dumps(dict(store.stats(), shape=list(vectors.shape), open_ms=round(elapsed, 2)), indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
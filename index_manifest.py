@@ -0,0 +1,124 @@
+# index_manifest.py
+# Manifest locale dei vettori in Pinecone: id -> (hash contenuto, hash metadata)
+# Permette di sincronizzare l'indice toccando solo i vettori nuovi, modificati o spariti
+
+import os
+import json
+import time
+import hashlib
+from array import array
+from typing import Dict, Iterable, List, Optional
+
+
+class ManifestDiff:
+    """Differenza tra il manifest e il nuovo insieme di vettori"""
+
+    def __init__(self):
+        self.upserts: List[Dict] = []          # Nuovi o con valori cambiati
+        self.metadata_updates: List[Dict] = []  # Solo metadata cambiati
+        self.deletes: List[str] = []            # Presenti nell'indice ma non più generati
+        self.unchanged = 0
+
+    def summary(self) -> Dict:
+        return {
+            'upserts': len(self.upserts),
+            'metadata_updates': len(self.metadata_updates),
+            'deletes': len(self.deletes),
+            'unchanged': self.unchanged
+        }
+
+
+class IndexManifest:
+    """Stato noto dei vettori di un indice, salvato in JSON accanto ai dati processati"""
+
+    def __init__(self, path: str, index_name: str):
+        self.path = path
+        self.index_name = index_name
+        self.vectors: Dict[str, Dict] = {}
+
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('index_name') == index_name:
+                self.vectors = data.get('vectors', {})
+            else:
+                print(f"  ⚠️ Manifest di un altro indice ({data.get('index_name')}), ignorato")
+
+    @property
+    def exists(self) -> bool:
+        return bool(self.vectors)
+
+    @staticmethod
+    def content_hash(values: List[float], sparse: Optional[Dict] = None) -> str:
+        """Hash dei valori dense e, se presenti, dei valori sparse"""
+        digest = hashlib.sha256(array('d', values).tobytes())
+        if sparse:
+            digest.update(array('q', sparse['indices']).tobytes())
+            digest.update(array('d', sparse['values']).tobytes())
+        return digest.hexdigest()
+
+    @staticmethod
+    def metadata_hash(metadata: Dict) -> str:
+        payload = json.dumps(metadata, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def bootstrap(self, ids: Iterable[str]):
+        """Registra ID già presenti nell'indice ma di contenuto sconosciuto (verranno riscritti o eliminati)"""
+        for vector_id in ids:
+            self.vectors.setdefault(vector_id, {'content': None, 'metadata': None, 'keys': []})
+
+    def diff(self, vectors: List[Dict], present_ids: Optional[Iterable[str]] = None) -> ManifestDiff:
+        """Confronta i vettori generati ora con quelli registrati.
+
+        present_ids sono gli ID di tutti i chunks dell'esecuzione, anche senza embedding:
+        un vettore si elimina solo se il suo chunk non esiste più, non se l'embedding è fallito.
+        """
+        result = ManifestDiff()
+        seen = set(present_ids or ())
+
+        for vector in vectors:
+            seen.add(vector['id'])
+            known = self.vectors.get(vector['id'])
+
+            content = self.content_hash(vector['values'], vector.get('sparse_values'))
+            if known is None or known['content'] != content:
+                result.upserts.append(vector)
+            elif known['metadata'] != self.metadata_hash(vector['metadata']):
+                # set_metadata non rimuove chiavi: se l'insieme di chiavi cambia serve un upsert completo
+                if sorted(vector['metadata']) == known.get('keys'):
+                    result.metadata_updates.append(vector)
+                else:
+                    result.upserts.append(vector)
+            else:
+                result.unchanged += 1
+
+        result.deletes = sorted(vector_id for vector_id in self.vectors if vector_id not in seen)
+        return result
+
+    def record(self, vectors: Iterable[Dict]):
+        """Registra i vettori scritti con successo"""
+        for vector in vectors:
+            self.vectors[vector['id']] = {
+                'content': self.content_hash(vector['values'], vector.get('sparse_values')),
+                'metadata': self.metadata_hash(vector['metadata']),
+                'keys': sorted(vector['metadata'])
+            }
+
+    def forget(self, ids: Iterable[str]):
+        for vector_id in ids:
+            self.vectors.pop(vector_id, None)
+
+    def save(self):
+        """Scrittura atomica del manifest"""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({
+                'index_name': self.index_name,
+                'updated_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'vectors': self.vectors
+            }, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
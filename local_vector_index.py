@@ -0,0 +1,322 @@
+# local_vector_index.py
+# Indice vettoriale locale (NumPy) con la stessa interfaccia data-plane dell'indice Pinecone
+# Ricerca coseno esatta a blocchi di prodotti matriciali, partizionamento IVF opzionale per corpus grandi
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from typing import Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+
+# Cartella dei dati della pipeline (default dei comandi), relativa allo script
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'processed-v4')
+
+VECTORS_FILE = 'vectors.npy'
+INDEX_FILE = 'index.json'
+CENTROIDS_FILE = 'ivf_centroids.npy'
+ASSIGNMENTS_FILE = 'ivf_assignments.npy'
+
+
+def normalize(matrix: np.ndarray) -> np.ndarray:
+    """Normalizza le righe (norma L2 = 1) così il coseno diventa un prodotto scalare"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class LocalVectorIndex:
+    """Vettori normalizzati in una matrice float32 più ID e metadata, salvabili su disco.
+
+    Espone upsert/update/delete/list/describe_index_stats/query come l'indice
+    Pinecone, quindi UpsertEngine e VectorIndexer lo usano senza modifiche.
+    Un solo namespace: l'argomento `namespace` è accettato e ignorato.
+    """
+
+    def __init__(self, dimension: int, directory: Optional[str] = None, block_size: int = 8192,
+                 nlist: int = 0, nprobe: int = 8):
+        self.dimension = dimension
+        self.directory = directory
+        self.block_size = block_size
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.ids: List[str] = []
+        self.rows: Dict[str, int] = {}
+        self.metadata: List[Dict] = []
+        self._data = np.empty((0, dimension), dtype=np.float32)
+        self.count = 0
+        self.centroids: Optional[np.ndarray] = None
+        self.assignments: Optional[np.ndarray] = None
+        self._lists: Optional[List[np.ndarray]] = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, directory: str, dimension: int, **options) -> 'LocalVectorIndex':
+        """Apre l'indice salvato (vettori mappati senza copia) o ne crea uno vuoto"""
+        index = cls(dimension, directory, **options)
+        index_path = os.path.join(directory, INDEX_FILE)
+        if not os.path.exists(index_path):
+            return index
+
+        with open(index_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data['dimension'] != dimension:
+            raise ValueError(f"Indice {directory} di dimensione {data['dimension']}, richiesta {dimension}")
+
+        index.ids = data['ids']
+        index.metadata = data['metadata']
+        index.rows = {vector_id: row for row, vector_id in enumerate(index.ids)}
+        index.count = len(index.ids)
+        if index.count:
+            index._data = np.load(os.path.join(directory, VECTORS_FILE), mmap_mode='r')
+
+        centroids_path = os.path.join(directory, CENTROIDS_FILE)
+        if data.get('ivf') and os.path.exists(centroids_path):
+            index.centroids = np.load(centroids_path)
+            index.assignments = np.load(os.path.join(directory, ASSIGNMENTS_FILE))
+        return index
+
+    @property
+    def vectors(self) -> np.ndarray:
+        return self._data[:self.count]
+
+    def _reserve(self, extra: int):
+        """Capacità geometrica; un indice caricato da disco diventa scrivibile alla prima modifica"""
+        needed = self.count + extra
+        if isinstance(self._data, np.memmap) or needed > len(self._data):
+            capacity = max(needed, len(self._data) * 2, 1024)
+            data = np.empty((capacity, self.dimension), dtype=np.float32)
+            data[:self.count] = self._data[:self.count]
+            self._data = data
+
+    def _invalidate_ivf(self):
+        self.centroids = None
+        self.assignments = None
+        self._lists = None
+
+    # ---- Interfaccia data-plane (come pinecone.Index) ----
+
+    def upsert(self, vectors: Sequence[Dict], namespace: Optional[str] = None) -> Dict:
+        """Inserisce o sostituisce vettori {'id', 'values', 'metadata'}"""
+        if not vectors:
+            return {'upserted_count': 0}
+        matrix = normalize([vector['values'] for vector in vectors])
+        if matrix.shape[1] != self.dimension:
+            raise ValueError(f"Dimensione {matrix.shape[1]} diversa da {self.dimension}")
+
+        with self._lock:
+            self._reserve(len(vectors))
+            for vector, values in zip(vectors, matrix):
+                row = self.rows.get(vector['id'])
+                if row is None:
+                    row = self.count
+                    self.rows[vector['id']] = row
+                    self.ids.append(vector['id'])
+                    self.metadata.append({})
+                    self.count += 1
+                self._data[row] = values
+                self.metadata[row] = dict(vector.get('metadata') or {})
+            self._invalidate_ivf()
+        return {'upserted_count': len(vectors)}
+
+    def update(self, id: str, set_metadata: Optional[Dict] = None, values: Optional[Sequence[float]] = None,
+               namespace: Optional[str] = None) -> Dict:
+        """Aggiorna metadata (merge, come Pinecone) e/o valori di un vettore esistente"""
+        with self._lock:
+            row = self.rows.get(id)
+            if row is None:
+                return {}
+            if set_metadata:
+                self.metadata[row].update(set_metadata)
+            if values is not None:
+                self._reserve(0)
+                self._data[row] = normalize(values)
+                self._invalidate_ivf()
+        return {}
+
+    def delete(self, ids: Sequence[str], namespace: Optional[str] = None) -> Dict:
+        """Elimina gli ID indicati spostando l'ultima riga nel posto liberato"""
+        with self._lock:
+            targets = [vector_id for vector_id in ids if vector_id in self.rows]
+            if targets:
+                self._reserve(0)
+            for vector_id in targets:
+                row = self.rows.pop(vector_id)
+                last = self.count - 1
+                if row != last:
+                    moved = self.ids[last]
+                    self._data[row] = self._data[last]
+                    self.ids[row] = moved
+                    self.metadata[row] = self.metadata[last]
+                    self.rows[moved] = row
+                self.ids.pop()
+                self.metadata.pop()
+                self.count -= 1
+            if targets:
+                self._invalidate_ivf()
+        return {}
+
+    def list(self, limit: int = 100, namespace: Optional[str] = None) -> Iterator[List[str]]:
+        """ID a pagine, come index.list() dei serverless"""
+        ids = list(self.ids)
+        for start in range(0, len(ids), limit):
+            yield ids[start:start + limit]
+
+    def describe_index_stats(self) -> Dict:
+        return {
+            'dimension': self.dimension,
+            'total_vector_count': self.count,
+            'ivf_lists': 0 if self.centroids is None else len(self.centroids)
+        }
+
+    def query(self, vector: Sequence[float], top_k: int = 10, include_metadata: bool = False,
+              include_values: bool = False, namespace: Optional[str] = None, **kwargs) -> Dict:
+        """Top-k per similarità coseno; accetta anche topK/includeMetadata come il client JS"""
+        top_k = kwargs.get('topK', top_k)
+        include_metadata = kwargs.get('includeMetadata', include_metadata)
+        scores, rows = self.search(np.asarray([vector], dtype=np.float32), top_k)
+
+        matches = []
+        for score, row in zip(scores[0], rows[0]):
+            if row < 0:
+                continue
+            match = {'id': self.ids[row], 'score': float(score)}
+            if include_metadata:
+                match['metadata'] = self.metadata[row]
+            if include_values:
+                match['values'] = self._data[row].tolist()
+            matches.append(match)
+        return {'matches': matches, 'namespace': namespace or ''}
+
+    # ---- Ricerca ----
+
+    def search(self, queries: np.ndarray, top_k: int, exact: Optional[bool] = None):
+        """Punteggi e righe dei top-k per ogni query (righe -1 se l'indice ha meno di k vettori)"""
+        queries = normalize(np.atleast_2d(queries))
+        # In automatico l'IVF si usa solo quando ogni lista ha in media qualche vettore
+        use_ivf = (self.count > self.nlist * 4) if exact is None else not exact
+        if use_ivf and self.nlist > 0 and self.count:
+            self.build_ivf()
+            return self._search_ivf(queries, top_k)
+        return self._search_exact(queries, self.vectors, top_k)
+
+    def _search_exact(self, queries: np.ndarray, matrix: np.ndarray, top_k: int,
+                      row_ids: Optional[np.ndarray] = None):
+        """Forza bruta a blocchi: ogni blocco è un prodotto matrice-matrice, si tiene il top-k corrente"""
+        n_queries = len(queries)
+        best_scores = np.full((n_queries, top_k), -np.inf, dtype=np.float32)
+        best_rows = np.full((n_queries, top_k), -1, dtype=np.int64)
+
+        for start in range(0, len(matrix), self.block_size):
+            block = np.asarray(matrix[start:start + self.block_size], dtype=np.float32)
+            scores = queries @ block.T
+            rows = np.arange(start, start + len(block)) if row_ids is None else row_ids[start:start + len(block)]
+
+            merged_scores = np.concatenate([best_scores, scores], axis=1)
+            merged_rows = np.concatenate([best_rows, np.broadcast_to(rows, scores.shape)], axis=1)
+            keep = np.argpartition(-merged_scores, top_k - 1, axis=1)[:, :top_k]
+            best_scores = np.take_along_axis(merged_scores, keep, axis=1)
+            best_rows = np.take_along_axis(merged_rows, keep, axis=1)
+
+        order = np.argsort(-best_scores, axis=1)
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        best_rows[~np.isfinite(best_scores)] = -1
+        return best_scores, best_rows
+
+    def build_ivf(self, iterations: int = 10, sample: int = 50000, seed: int = 0):
+        """K-means sferico sui vettori: nlist centroidi e lista di righe per centroide"""
+        if self.centroids is not None and self.assignments is not None:
+            if self._lists is None:
+                self._lists = [np.flatnonzero(self.assignments == c) for c in range(len(self.centroids))]
+            return
+
+        vectors = self.vectors
+        nlist = min(self.nlist, self.count)
+        rng = np.random.default_rng(seed)
+        training = vectors[rng.choice(self.count, min(sample, self.count), replace=False)]
+        centroids = np.array(training[rng.choice(len(training), nlist, replace=False)], dtype=np.float32)
+
+        for _ in range(iterations):
+            _, nearest = self._search_exact(training, centroids, 1)
+            nearest = nearest[:, 0]
+            for c in range(nlist):
+                members = training[nearest == c]
+                if len(members):
+                    centroids[c] = members.sum(axis=0)
+            centroids = normalize(centroids)
+
+        _, nearest = self._search_exact(vectors, centroids, 1)
+        self.centroids = centroids
+        self.assignments = nearest[:, 0].astype(np.int32)
+        self._lists = [np.flatnonzero(self.assignments == c) for c in range(nlist)]
+
+    def _search_ivf(self, queries: np.ndarray, top_k: int):
+        """Ricerca esatta limitata alle nprobe liste con centroide più vicino a ciascuna query"""
+        _, probes = self._search_exact(queries, self.centroids, min(self.nprobe, len(self.centroids)))
+        all_scores, all_rows = [], []
+        for query, lists in zip(queries, probes):
+            candidates = np.concatenate([self._lists[c] for c in lists if c >= 0])
+            scores, rows = self._search_exact(query[None, :], self.vectors[candidates], top_k, candidates)
+            all_scores.append(scores[0])
+            all_rows.append(rows[0])
+        return np.stack(all_scores), np.stack(all_rows)
+
+    # ---- Persistenza ----
+
+    def save(self, directory: Optional[str] = None):
+        """Salva vettori (.npy, caricabili con mmap) e tabella ID/metadata con scritture atomiche"""
+        directory = directory or self.directory
+        os.makedirs(directory, exist_ok=True)
+
+        with self._lock:
+            vectors_path = os.path.join(directory, VECTORS_FILE)
+            # Un indice appena caricato e non modificato è già su disco
+            if not isinstance(self._data, np.memmap) or directory != self.directory:
+                with open(vectors_path + '.tmp', 'wb') as f:
+                    np.save(f, self.vectors)
+                os.replace(vectors_path + '.tmp', vectors_path)
+
+            ivf = self.centroids is not None
+            if ivf:
+                np.save(os.path.join(directory, CENTROIDS_FILE), self.centroids)
+                np.save(os.path.join(directory, ASSIGNMENTS_FILE), self.assignments)
+
+            index_path = os.path.join(directory, INDEX_FILE)
+            with open(index_path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump({
+                    'dimension': self.dimension,
+                    'count': self.count,
+                    'ivf': ivf,
+                    'updated_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+                    'ids': self.ids,
+                    'metadata': self.metadata
+                }, f, ensure_ascii=False)
+            os.replace(index_path + '.tmp', index_path)
+
+
+def main(argv: List[str] = None):
+    """Comandi: stats [--dir PATH] [--dimension N]"""
+    parser = argparse.ArgumentParser(description="Indice vettoriale locale")
+    parser.add_argument('command', choices=['stats'])
+    parser.add_argument('--dir', default=os.path.join(DATA_DIR, 'local_index_vision'), help="Cartella dell'indice")
+    parser.add_argument('--dimension', type=int, default=1536)
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(os.path.join(args.dir, INDEX_FILE)):
+        print(f"❌ Indice non trovato: {args.dir}")
+        return 1
+
+    start = time.perf_counter()
+    index = LocalVectorIndex.load(args.dir, args.dimension)
+    elapsed = (time.perf_counter() - start) * 1000
+    print(json.dumps(dict(index.describe_index_stats(), open_ms=round(elapsed, 2)), indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
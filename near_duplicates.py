@@ -0,0 +1,162 @@
+# near_duplicates.py
+# Rilevamento dei chunks quasi identici (MinHash + LSH) prima delle chiamate API a pagamento
+# Le slide ripetute o costruite a passi producono chunks quasi uguali: se ne analizza uno solo
+
+import os
+import re
+import sys
+import json
+import zlib
+import argparse
+import unicodedata
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+# Cartella dei dati della pipeline (default dei comandi), relativa allo script
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'processed-v4')
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+# Primo > 2^32: con a < 2^31 e shingle a 32 bit (a * x + b) resta in uint64
+PRIME = np.uint64(4294967311)
+
+
+def shingles(text: str, size: int = 3) -> np.ndarray:
+    """Hash a 32 bit delle sequenze di `size` parole (minuscole, senza accenti)"""
+    text = unicodedata.normalize('NFKD', text.lower())
+    words = WORD_RE.findall(''.join(ch for ch in text if not unicodedata.combining(ch)))
+    if len(words) < size:
+        grams = [' '.join(words)] if words else []
+    else:
+        grams = {' '.join(words[i:i + size]) for i in range(len(words) - size + 1)}
+    return np.fromiter((zlib.crc32(gram.encode('utf-8')) for gram in grams), dtype=np.uint64)
+
+
+def vision_variant(chunk: Dict) -> Optional[int]:
+    """Impronta dei dati Vision del chunk: slide con lo stesso testo ma figure diverse non sono duplicati"""
+    vision_data = chunk.get('vision_data')
+    if not vision_data:
+        return None
+    return zlib.crc32(json.dumps(vision_data, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+
+
+class NearDuplicateDetector:
+    """Raggruppamento online: ogni chunk è duplicato del rappresentante più simile o ne diventa uno nuovo"""
+
+    def __init__(self, threshold: float = 0.85, num_perm: int = 128, bands: int = 16,
+                 shingle_size: int = 3, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError("num_perm deve essere multiplo di bands")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, 1 << 31, num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, 1 << 32, num_perm, dtype=np.uint64)
+
+        self.buckets: List[Dict[bytes, List[int]]] = [{} for _ in range(bands)]
+        self.representatives: List[str] = []
+        self.signatures: List[np.ndarray] = []
+        self.variants: List[Optional[int]] = []
+        self.order: List[str] = []
+        self.duplicates: Dict[str, Dict] = {}
+
+    def signature(self, text: str) -> Optional[np.ndarray]:
+        """Firma MinHash: minimo di num_perm permutazioni hash degli shingle"""
+        values = shingles(text, self.shingle_size)
+        if not len(values):
+            return None
+        return ((np.outer(self.a, values) + self.b[:, None]) % PRIME).min(axis=1)
+
+    def add(self, chunk_id: str, text: str, variant: Optional[int] = None) -> Optional[Tuple[str, float]]:
+        """(rappresentante, similarità stimata) se il chunk è un quasi duplicato, altrimenti None.
+
+        variant separa i chunks con contenuto non testuale diverso: si confrontano solo quelli con la stessa.
+        """
+        signature = self.signature(text)
+        if signature is None:
+            return None
+
+        keys = [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+        # LSH: candidati solo i rappresentanti che condividono almeno una banda intera
+        candidates = {rep for band, key in enumerate(keys) for rep in self.buckets[band].get(key, ())}
+        best, best_similarity = None, 0.0
+        for rep in candidates:
+            if self.variants[rep] != variant:
+                continue
+            similarity = float(np.mean(self.signatures[rep] == signature))
+            if similarity > best_similarity:
+                best, best_similarity = rep, similarity
+        if best is not None and best_similarity >= self.threshold:
+            return self.representatives[best], round(best_similarity, 3)
+
+        rep = len(self.representatives)
+        self.representatives.append(chunk_id)
+        self.signatures.append(signature)
+        self.variants.append(variant)
+        for band, key in enumerate(keys):
+            self.buckets[band].setdefault(key, []).append(rep)
+        return None
+
+    def filter(self, chunks: Iterable[Dict]) -> Iterator[Dict]:
+        """Passa avanti i soli rappresentanti; i duplicati restano da parte con il collegamento"""
+        for chunk in chunks:
+            self.order.append(chunk['id'])
+            match = self.add(chunk['id'], chunk['text'], vision_variant(chunk))
+            if match:
+                chunk['duplicate_of'], chunk['similarity'] = match
+                self.duplicates[chunk['id']] = chunk
+            else:
+                yield chunk
+
+    def link(self, representatives: List[Dict]) -> List[Dict]:
+        """Tutti i chunks nell'ordine originale, con l'elenco dei duplicati su ogni rappresentante"""
+        by_id = {chunk['id']: chunk for chunk in representatives}
+        for chunk in self.duplicates.values():
+            rep = by_id.get(chunk['duplicate_of'])
+            if rep is not None:
+                rep.setdefault('duplicates', []).append(chunk['id'])
+        return [by_id.get(chunk_id) or self.duplicates[chunk_id]
+                for chunk_id in self.order if chunk_id in by_id or chunk_id in self.duplicates]
+
+    def stats(self) -> Dict:
+        clusters = {chunk['duplicate_of'] for chunk in self.duplicates.values()}
+        return {
+            'chunks': len(self.order),
+            'representatives': len(self.order) - len(self.duplicates),
+            'duplicates': len(self.duplicates),
+            'clusters': len(clusters),
+            'threshold': self.threshold
+        }
+
+
+def main(argv: List[str] = None):
+    """Gruppi di quasi duplicati in un file di chunks già prodotto (per scegliere la soglia)"""
+    parser = argparse.ArgumentParser(description="Quasi duplicati tra i chunks (MinHash/LSH)")
+    parser.add_argument('--chunks', default=os.path.join(DATA_DIR, 'chunks_vision.json'))
+    parser.add_argument('--threshold', type=float, default=0.85)
+    parser.add_argument('--show', type=int, default=10, help="Gruppi da mostrare")
+    args = parser.parse_args(argv)
+
+    with open(args.chunks, 'r', encoding='utf-8') as f:
+        chunks = [{'id': chunk['id'], 'text': chunk['text']} for chunk in json.load(f)]
+
+    detector = NearDuplicateDetector(threshold=args.threshold)
+    for _ in detector.filter(chunks):
+        pass
+    stats = detector.stats()
+    print(json.dumps(stats, indent=2))
+
+    groups: Dict[str, List[str]] = {}
+    for chunk in detector.duplicates.values():
+        groups.setdefault(chunk['duplicate_of'], []).append(chunk['id'])
+    for rep, members in sorted(groups.items(), key=lambda item: -len(item[1]))[:args.show]:
+        print(f"  • {rep}: {len(members)} duplicati ({', '.join(members[:5])}{'...' if len(members) > 5 else ''})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
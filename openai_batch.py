@@ -0,0 +1,197 @@
+# openai_batch.py
+# Modalità Batch API di OpenAI: richieste scritte in JSONL, inviate in blocco e raccolte a fine elaborazione
+# Metà prezzo e nessun rate limit delle chiamate sincrone, in cambio di risultati non immediati
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+from typing import Dict, Iterable, List, Tuple
+
+# Cartella dei dati della pipeline (default dei comandi), relativa allo script
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'processed-v4')
+
+# Limiti della Batch API per singolo file di input
+MAX_REQUESTS_PER_FILE = 50000
+MAX_BYTES_PER_FILE = 190 * 1024 * 1024
+
+# Stati finali di un batch; expired e cancelled possono avere comunque risultati parziali
+FINAL_STATES = {'completed', 'failed', 'expired', 'cancelled'}
+
+
+class BatchRunner:
+    """Scrive, invia e attende i batch; lo stato su disco permette di riagganciarsi dopo un'interruzione"""
+
+    def __init__(self, client, work_dir: str, poll_interval: float = 30, completion_window: str = '24h'):
+        self.client = client
+        self.work_dir = work_dir
+        self.poll_interval = poll_interval
+        self.completion_window = completion_window
+        self.state_path = os.path.join(work_dir, 'batches.json')
+        os.makedirs(work_dir, exist_ok=True)
+
+        self.state: Dict[str, Dict] = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                self.state = json.load(f)
+
+    def _save_state(self):
+        tmp = self.state_path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp, self.state_path)
+
+    def write_requests(self, name: str, endpoint: str, requests: Iterable[Tuple[str, Dict]]) -> List[str]:
+        """File JSONL di input (custom_id, method, url, body), divisi secondo i limiti per file"""
+        paths = []
+        f = None
+        count = size = 0
+        try:
+            for custom_id, body in requests:
+                line = json.dumps({'custom_id': custom_id, 'method': 'POST', 'url': endpoint, 'body': body},
+                                  ensure_ascii=False) + '\n'
+                data = line.encode('utf-8')
+                if f is None or count >= MAX_REQUESTS_PER_FILE or size + len(data) > MAX_BYTES_PER_FILE:
+                    if f:
+                        f.close()
+                    paths.append(os.path.join(self.work_dir, f'{name}_{len(paths)}.jsonl'))
+                    f = open(paths[-1], 'wb')
+                    count = size = 0
+                f.write(data)
+                count += 1
+                size += len(data)
+        finally:
+            if f:
+                f.close()
+        return paths
+
+    def submit(self, path: str, endpoint: str) -> str:
+        """Carica il file e crea il batch; uno stesso input già inviato non viene reinviato"""
+        with open(path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+
+        known = self.state.get(digest)
+        if known and known.get('status') not in {'failed', 'expired', 'cancelled'}:
+            print(f"  ♻️ Batch già inviato per {os.path.basename(path)}: {known['id']}")
+            return known['id']
+
+        with open(path, 'rb') as f:
+            input_file = self.client.files.create(file=f, purpose='batch')
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=endpoint,
+            completion_window=self.completion_window,
+            metadata={'source': os.path.basename(path)}
+        )
+        self.state[digest] = {'id': batch.id, 'input': os.path.basename(path), 'status': batch.status}
+        self._save_state()
+        print(f"  📤 Batch inviato: {batch.id} ({os.path.basename(path)})")
+        return batch.id
+
+    def wait(self, batch_ids: List[str]) -> Dict[str, object]:
+        """Attende che tutti i batch raggiungano uno stato finale"""
+        done = {}
+        while True:
+            for batch_id in batch_ids:
+                if batch_id not in done:
+                    batch = self.client.batches.retrieve(batch_id)
+                    self._record_status(batch)
+                    if batch.status in FINAL_STATES:
+                        done[batch_id] = batch
+            if len(done) == len(batch_ids):
+                return done
+
+            counts = [done.get(batch_id) for batch_id in batch_ids]
+            print(f"\r  ⏳ Batch completati: {sum(1 for c in counts if c)}/{len(batch_ids)}...", end='')
+            time.sleep(self.poll_interval)
+
+    def _record_status(self, batch):
+        for entry in self.state.values():
+            if entry['id'] == batch.id and entry.get('status') != batch.status:
+                entry['status'] = batch.status
+                self._save_state()
+
+    def _read_file(self, file_id: str) -> Iterable[Dict]:
+        if not file_id:
+            return []
+        content = self.client.files.content(file_id)
+        return [json.loads(line) for line in content.text.splitlines() if line.strip()]
+
+    def collect(self, batch) -> Tuple[Dict[str, Dict], Dict[str, str]]:
+        """Risultati (custom_id -> body) ed errori (custom_id -> messaggio) di un batch, anche parziale"""
+        results, errors = {}, {}
+        for record in self._read_file(batch.output_file_id) + self._read_file(batch.error_file_id):
+            custom_id = record['custom_id']
+            response = record.get('response') or {}
+            if response.get('status_code') == 200 and not record.get('error'):
+                results[custom_id] = response['body']
+            else:
+                error = record.get('error') or response.get('body', {}).get('error') or {}
+                errors[custom_id] = error.get('message', f"status {response.get('status_code')}")
+        return results, errors
+
+    def run(self, jobs: Dict[str, Tuple[str, List[Tuple[str, Dict]]]]) -> Dict[str, Tuple[Dict, Dict]]:
+        """Esegue più gruppi di richieste {nome: (endpoint, [(custom_id, body)])} in parallelo.
+
+        Le richieste senza risposta (batch scaduto o fallito) compaiono tra gli errori,
+        così il chiamante può ripeterle con le chiamate sincrone.
+        """
+        submitted = {}
+        for name, (endpoint, requests) in jobs.items():
+            if requests:
+                paths = self.write_requests(name, endpoint, requests)
+                submitted[name] = [self.submit(path, endpoint) for path in paths]
+
+        batches = self.wait([batch_id for ids in submitted.values() for batch_id in ids])
+        print()
+
+        outcome = {}
+        for name, (endpoint, requests) in jobs.items():
+            results, errors = {}, {}
+            for batch_id in submitted.get(name, []):
+                batch = batches[batch_id]
+                batch_results, batch_errors = self.collect(batch)
+                results.update(batch_results)
+                errors.update(batch_errors)
+                if batch.status != 'completed':
+                    print(f"  ⚠️ Batch {batch_id} {batch.status}: {len(batch_results)} risultati parziali")
+            for custom_id, _ in requests:
+                if custom_id not in results and custom_id not in errors:
+                    errors[custom_id] = 'nessuna risposta nel batch'
+            outcome[name] = (results, errors)
+        return outcome
+
+
+def main(argv: List[str] = None):
+    """Stato dei batch registrati in una cartella di lavoro"""
+    from dotenv import load_dotenv
+    from openai import OpenAI
+
+    parser = argparse.ArgumentParser(description="Batch OpenAI della pipeline")
+    parser.add_argument('command', choices=['status', 'cancel'])
+    parser.add_argument('--dir', default=os.path.join(DATA_DIR, 'batch_vision'), help="Cartella di lavoro dei batch")
+    args = parser.parse_args(argv)
+
+    load_dotenv('.env.local')
+    client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'), base_url=os.getenv('OPENAI_BASE_URL') or None)
+    runner = BatchRunner(client, args.dir)
+    if not runner.state:
+        print(f"❌ Nessun batch registrato in {args.dir}")
+        return 1
+
+    for entry in runner.state.values():
+        batch = client.batches.retrieve(entry['id'])
+        if args.command == 'cancel' and batch.status not in FINAL_STATES:
+            batch = client.batches.cancel(entry['id'])
+        runner._record_status(batch)
+        counts = batch.request_counts
+        print(f"  • {entry['input']}: {batch.id} {batch.status} "
+              f"({counts.completed}/{counts.total} ok, {counts.failed} falliti)" if counts else
+              f"  • {entry['input']}: {batch.id} {batch.status}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+# page_classifier.py
+# Classificazione delle pagine per Vision a partire dalla struttura PDF (PyPDF2)
+# Misura area delle immagini disegnate, densità dei tracciati vettoriali e area del testo
+
+import math
+from typing import Dict, List, Tuple
+
+from PyPDF2.generic import ContentStream
+
+Matrix = Tuple[float, float, float, float, float, float]
+IDENTITY: Matrix = (1.0, 0.0, 0.0, 1.0, 0.0, 0.0)
+
+# Operatori di costruzione tracciato (linee, curve, rettangoli)
+PATH_OPERATORS = {b'm', b'l', b'c', b'v', b'y', b're'}
+# Operatori che disegnano testo
+TEXT_OPERATORS = {b'Tj', b'TJ', b"'", b'"'}
+
+
+def multiply(m1: Matrix, m2: Matrix) -> Matrix:
+    """Prodotto di matrici PDF (m1 applicata prima di m2)"""
+    a1, b1, c1, d1, e1, f1 = m1
+    a2, b2, c2, d2, e2, f2 = m2
+    return (
+        a1 * a2 + b1 * c2,
+        a1 * b2 + b1 * d2,
+        c1 * a2 + d1 * c2,
+        c1 * b2 + d1 * d2,
+        e1 * a2 + f1 * c2 + e2,
+        e1 * b2 + f1 * d2 + f2
+    )
+
+
+def matrix_area(m: Matrix) -> float:
+    """Area del quadrato unitario trasformato (immagini e form sono disegnati su [0,1]x[0,1])"""
+    return abs(m[0] * m[3] - m[1] * m[2])
+
+
+class PageStats:
+    """Misure strutturali di una pagina"""
+
+    def __init__(self):
+        self.image_count = 0
+        self.image_area = 0.0
+        self.path_ops = 0
+        self.rectangles = 0
+        self.text_chars = 0
+        self.text_area = 0.0
+        self.image_keys = set()
+
+
+class PageVisualClassifier:
+    """Assegna a ogni pagina un punteggio visuale e i motivi della selezione"""
+
+    def __init__(self, min_score: float = 0.35, min_image_area: float = 0.15,
+                 path_ops_saturation: int = 400, min_text_chars: int = 200, max_form_depth: int = 3,
+                 template_pages: int = 3):
+        self.min_score = min_score
+        self.min_image_area = min_image_area
+        self.path_ops_saturation = path_ops_saturation
+        self.min_text_chars = min_text_chars
+        self.max_form_depth = max_form_depth
+        self.template_pages = template_pages
+        self.image_pages: Dict[int, int] = {}  # Pagine già viste per ogni immagine (idnum)
+
+    @staticmethod
+    def _resources(page) -> Dict:
+        """Risorse della pagina, anche ereditate dai nodi /Pages"""
+        node = page
+        while node is not None:
+            resources = node.get('/Resources')
+            if resources is not None:
+                return resources.get_object()
+            parent = node.get('/Parent')
+            node = parent.get_object() if parent is not None else None
+        return {}
+
+    def _scan(self, operations: List, resources: Dict, ctm: Matrix, stats: PageStats, pdf, depth: int):
+        """Percorre gli operatori tenendo traccia della CTM (q/Q/cm) e del testo (Tf/Tm)"""
+        stack = []
+        font_size = 0.0
+        text_matrix = IDENTITY
+        xobjects = resources.get('/XObject')
+        xobjects = xobjects.get_object() if xobjects is not None else {}
+
+        for operands, operator in operations:
+            if operator == b'q':
+                stack.append(ctm)
+            elif operator == b'Q':
+                if stack:
+                    ctm = stack.pop()
+            elif operator == b'cm' and len(operands) == 6:
+                ctm = multiply(tuple(float(x) for x in operands), ctm)
+            elif operator in PATH_OPERATORS:
+                stats.path_ops += 1
+                if operator == b're':
+                    stats.rectangles += 1
+            elif operator == b'BT':
+                text_matrix = IDENTITY
+            elif operator == b'Tf' and len(operands) == 2:
+                font_size = abs(float(operands[1]))
+            elif operator == b'Tm' and len(operands) == 6:
+                text_matrix = tuple(float(x) for x in operands)
+            elif operator in TEXT_OPERATORS and operands:
+                chars = self._text_length(operands[-1] if operator != b'"' else operands[2])
+                scale = math.sqrt(matrix_area(multiply(text_matrix, ctm)))
+                stats.text_chars += chars
+                # Glifo medio ~ metà della dimensione del font in larghezza
+                stats.text_area += chars * 0.5 * (font_size * scale) ** 2
+            elif operator == b'INLINE IMAGE':
+                stats.image_count += 1
+                stats.image_area += matrix_area(ctm)
+            elif operator == b'Do' and operands:
+                reference = xobjects.raw_get(operands[0]) if operands[0] in xobjects else None
+                if reference is None:
+                    continue
+                xobject = reference.get_object()
+                subtype = xobject.get('/Subtype')
+                if subtype == '/Image':
+                    # Immagini condivise da molte pagine (logo, sfondo del template) non contano
+                    key = getattr(reference, 'idnum', None)
+                    if key is not None:
+                        stats.image_keys.add(key)
+                        if self.image_pages.get(key, 0) >= self.template_pages:
+                            continue
+                    stats.image_count += 1
+                    stats.image_area += matrix_area(ctm)
+                elif subtype == '/Form' and depth < self.max_form_depth:
+                    form_matrix = tuple(float(x) for x in xobject.get('/Matrix', IDENTITY))
+                    form_resources = xobject.get('/Resources')
+                    form_resources = form_resources.get_object() if form_resources is not None else resources
+                    self._scan(ContentStream(xobject, pdf).operations, form_resources,
+                               multiply(form_matrix, ctm), stats, pdf, depth + 1)
+
+    @staticmethod
+    def _text_length(operand) -> int:
+        if isinstance(operand, list):
+            return sum(len(item) for item in operand if isinstance(item, (str, bytes)))
+        return len(operand) if isinstance(operand, (str, bytes)) else 0
+
+    def measure(self, page) -> PageStats:
+        """Misura immagini, tracciati e testo dal content stream della pagina"""
+        stats = PageStats()
+        contents = page.get_contents()
+        if contents is None:
+            return stats
+        self._scan(contents.operations, self._resources(page), IDENTITY, stats, page.pdf, 0)
+        for key in stats.image_keys:
+            self.image_pages[key] = self.image_pages.get(key, 0) + 1
+        return stats
+
+    def classify(self, page, page_text: str) -> Dict:
+        """Punteggio visuale (0-1), decisione e motivi per una pagina"""
+        width = float(page.mediabox.width)
+        height = float(page.mediabox.height)
+        page_area = max(width * height, 1.0)
+
+        stats = self.measure(page)
+        image_ratio = min(1.0, stats.image_area / page_area)
+        text_ratio = min(1.0, stats.text_area / page_area)
+        path_density = min(1.0, stats.path_ops / self.path_ops_saturation)
+        text_chars = len(page_text.strip())
+
+        # Contenuto grafico pesato per quanto spazio lascia il testo
+        score = max(image_ratio, path_density) * (1.0 - 0.5 * text_ratio)
+        if text_chars < self.min_text_chars and (stats.image_count or stats.path_ops):
+            score = max(score, 0.5)
+        score = round(min(1.0, score), 3)
+
+        reasons = []
+        if image_ratio >= self.min_image_area:
+            reasons.append(f"{stats.image_count} immagini sul {image_ratio:.0%} della pagina")
+        if path_density >= 0.5:
+            reasons.append(f"{stats.path_ops} operatori vettoriali ({stats.rectangles} rettangoli)")
+        if text_chars < self.min_text_chars:
+            reasons.append(f"poco testo ({text_chars} caratteri)")
+
+        return {
+            'score': score,
+            'selected': score >= self.min_score,
+            'reasons': reasons,
+            'image_count': stats.image_count,
+            'image_ratio': round(image_ratio, 3),
+            'path_ops': stats.path_ops,
+            'text_ratio': round(text_ratio, 3)
+        }
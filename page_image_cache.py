@@ -0,0 +1,153 @@
+# page_image_cache.py
+# Cache binaria delle pagine PDF rasterizzate per Vision
+# Chiave = (hash contenuto PDF, pagina, dpi, dimensione massima, formato): niente immagini obsolete
+
+import os
+import sys
+import base64
+import hashlib
+import argparse
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+# Cartella dei dati della pipeline (default dei comandi), relativa allo script
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'processed-v4')
+
+# Estensione e MIME type per ogni formato supportato da GPT-4o
+IMAGE_FORMATS = {
+    'png': ('png', 'image/png'),
+    'jpeg': ('jpg', 'image/jpeg'),
+    'webp': ('webp', 'image/webp')
+}
+
+_pdf_hashes: Dict[Tuple[str, int, float], str] = {}
+
+
+def pdf_content_hash(pdf_path: str) -> str:
+    """SHA-256 del contenuto del PDF (memorizzato per path, dimensione e mtime)"""
+    stat = os.stat(pdf_path)
+    signature = (os.path.abspath(pdf_path), stat.st_size, stat.st_mtime)
+    if signature not in _pdf_hashes:
+        digest = hashlib.sha256()
+        with open(pdf_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        _pdf_hashes[signature] = digest.hexdigest()
+    return _pdf_hashes[signature]
+
+
+class PageImageCache:
+    """Immagini delle pagine salvate come file binari, con budget totale ed eviction LRU"""
+
+    def __init__(self, cache_dir: str, max_bytes: Optional[int] = None):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.total_bytes = sum(f.stat().st_size for f in self._entries())
+
+    def _entries(self) -> List[Path]:
+        return [f for f in self.cache_dir.iterdir()
+                if f.is_file() and f.suffix.lstrip('.') in {ext for ext, _ in IMAGE_FORMATS.values()}]
+
+    def _path(self, pdf_hash: str, page_num: int, dpi: int, max_size: int, image_format: str) -> Path:
+        ext = IMAGE_FORMATS[image_format][0]
+        return self.cache_dir / f"{pdf_hash[:16]}_p{page_num}_d{dpi}_s{max_size}.{ext}"
+
+    def get(self, pdf_hash: str, page_num: int, dpi: int, max_size: int, image_format: str) -> Optional[bytes]:
+        """Restituisce i byte dell'immagine o None; l'accesso aggiorna l'ordine LRU (mtime)"""
+        path = self._path(pdf_hash, page_num, dpi, max_size, image_format)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+
+        os.utime(path, None)
+        self.hits += 1
+        return data
+
+    def put(self, pdf_hash: str, page_num: int, dpi: int, max_size: int, image_format: str, data: bytes):
+        """Salva l'immagine (scrittura atomica) e rispetta il budget di spazio"""
+        path = self._path(pdf_hash, page_num, dpi, max_size, image_format)
+        if path.exists():
+            self.total_bytes -= path.stat().st_size
+
+        tmp = path.with_name(path.name + '.tmp')
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+        self.total_bytes += len(data)
+
+        if self.max_bytes and self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self) -> int:
+        """Elimina le immagini usate meno di recente fino al 90% del budget"""
+        target = int(self.max_bytes * 0.9)
+        evicted = 0
+        for f in sorted(self._entries(), key=lambda f: f.stat().st_mtime):
+            if self.total_bytes <= target:
+                break
+            self.total_bytes -= f.stat().st_size
+            f.unlink()
+            evicted += 1
+        return evicted
+
+    def migrate_legacy(self, pdf_hash: str, dpi: int, max_size: int) -> int:
+        """Converte una volta sola i vecchi page_{n}.txt (PNG in base64) in file binari.
+
+        I vecchi file erano indicizzati solo per numero di pagina: si assume che
+        provengano dal PDF e dai parametri correnti, poi vengono eliminati.
+        """
+        migrated = 0
+        for legacy in sorted(self.cache_dir.glob('page_*.txt')):
+            try:
+                page_num = int(legacy.stem.split('_', 1)[1])
+                data = base64.b64decode(legacy.read_text())
+            except (ValueError, IndexError) as e:
+                print(f"  ⚠️ Cache legacy non valida {legacy.name}: {e}")
+                continue
+
+            self.put(pdf_hash, page_num, dpi, max_size, 'png', data)
+            legacy.unlink()
+            migrated += 1
+
+        if migrated:
+            print(f"  📦 Migrate {migrated} immagini dalla cache legacy .txt")
+        return migrated
+
+    def stats(self) -> Dict:
+        return {
+            'entries': len(self._entries()),
+            'total_bytes': self.total_bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+
+def main(argv: List[str] = None):
+    """Comandi: stats | migrate --pdf PATH [--dpi N] [--max-size N]"""
+    parser = argparse.ArgumentParser(description="Gestione cache immagini Vision")
+    parser.add_argument('command', choices=['stats', 'migrate'])
+    parser.add_argument('--dir', default=os.path.join(DATA_DIR, 'vision_cache'), help="Cartella della cache")
+    parser.add_argument('--pdf', help="PDF a cui appartengono le immagini legacy")
+    parser.add_argument('--dpi', type=int, default=150)
+    parser.add_argument('--max-size', type=int, default=2000)
+    args = parser.parse_args(argv)
+
+    cache = PageImageCache(args.dir)
+    if args.command == 'stats':
+        print(cache.stats())
+        return 0
+
+    if not args.pdf or not os.path.exists(args.pdf):
+        print("❌ Indicare con --pdf il PDF da cui provengono le immagini legacy")
+        return 1
+    cache.migrate_legacy(pdf_content_hash(args.pdf), args.dpi, args.max_size)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
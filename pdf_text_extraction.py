@@ -0,0 +1,226 @@
+# pdf_text_extraction.py
+# Estrazione del testo del PDF: backend intercambiabili (PyPDF2, PyMuPDF, pdfium, pdfminer)
+# e intervalli di pagine distribuiti su un pool di processi, ognuno con il proprio documento aperto
+
+import importlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import PyPDF2
+
+
+def _require(module: str, package: str):
+    """Import di una dipendenza opzionale con l'indicazione del pacchetto da installare"""
+    try:
+        return importlib.import_module(module)
+    except ImportError as e:
+        raise ImportError(f"Backend di estrazione non disponibile: pip install {package}") from e
+
+
+class TextExtractor:
+    """Un PDF aperto con un backend: numero di pagine, testo per pagina, info del documento"""
+
+    name = ''
+    module = ''   # Modulo da importare
+    package = ''  # Pacchetto pip che lo fornisce
+
+    def __init__(self, pdf_path: str):
+        self.pdf_path = pdf_path
+
+    def __len__(self) -> int:
+        raise NotImplementedError
+
+    def page_text(self, index: int) -> str:
+        raise NotImplementedError
+
+    def info(self) -> Dict[str, str]:
+        return {}
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PyPDF2Extractor(TextExtractor):
+    """Python puro: nessuna dipendenza nativa, ma lento e con lettere spaziate su alcuni font"""
+
+    name = 'pypdf2'
+    module = 'PyPDF2'
+    package = 'PyPDF2'
+
+    def __init__(self, pdf_path: str):
+        super().__init__(pdf_path)
+        self.reader = PyPDF2.PdfReader(pdf_path)
+
+    def __len__(self) -> int:
+        return len(self.reader.pages)
+
+    def page_text(self, index: int) -> str:
+        return self.reader.pages[index].extract_text()
+
+    def info(self) -> Dict[str, str]:
+        return {str(key): str(value) for key, value in (self.reader.metadata or {}).items()}
+
+
+class PyMuPDFExtractor(TextExtractor):
+    """MuPDF (C): veloce, spazi tra le parole ricostruiti dalle posizioni dei glifi"""
+
+    name = 'pymupdf'
+    module = 'pymupdf'
+    package = 'pymupdf'
+
+    def __init__(self, pdf_path: str):
+        super().__init__(pdf_path)
+        self.document = _require(self.module, self.package).open(pdf_path)
+
+    def __len__(self) -> int:
+        return self.document.page_count
+
+    def page_text(self, index: int) -> str:
+        return self.document[index].get_text('text')
+
+    def info(self) -> Dict[str, str]:
+        return {key: str(value) for key, value in (self.document.metadata or {}).items() if value}
+
+    def close(self):
+        self.document.close()
+
+
+class PdfiumExtractor(TextExtractor):
+    """PDFium (il motore di Chrome) tramite pypdfium2"""
+
+    name = 'pdfium'
+    module = 'pypdfium2'
+    package = 'pypdfium2'
+
+    def __init__(self, pdf_path: str):
+        super().__init__(pdf_path)
+        self.document = _require(self.module, self.package).PdfDocument(pdf_path)
+
+    def __len__(self) -> int:
+        return len(self.document)
+
+    def page_text(self, index: int) -> str:
+        page = self.document[index]
+        textpage = page.get_textpage()
+        try:
+            # PDFium usa \r\n come fine riga
+            return textpage.get_text_range().replace('\r\n', '\n')
+        finally:
+            textpage.close()
+            page.close()
+
+    def info(self) -> Dict[str, str]:
+        return {key: str(value) for key, value in self.document.get_metadata_dict().items() if value}
+
+    def close(self):
+        self.document.close()
+
+
+class PdfminerExtractor(TextExtractor):
+    """pdfminer.six: Python puro con analisi del layout, lento ma utile come riferimento di qualità"""
+
+    name = 'pdfminer'
+    module = 'pdfminer.high_level'
+    package = 'pdfminer.six'
+
+    def __init__(self, pdf_path: str):
+        super().__init__(pdf_path)
+        self.high_level = _require(self.module, self.package)
+        pdfpage = _require('pdfminer.pdfpage', self.package)
+        with open(pdf_path, 'rb') as f:
+            self.page_count = sum(1 for _ in pdfpage.PDFPage.get_pages(f))
+
+    def __len__(self) -> int:
+        return self.page_count
+
+    def page_text(self, index: int) -> str:
+        return self.high_level.extract_text(self.pdf_path, page_numbers=[index])
+
+
+EXTRACTORS = {cls.name: cls for cls in (PyPDF2Extractor, PyMuPDFExtractor, PdfiumExtractor, PdfminerExtractor)}
+
+
+def open_extractor(backend: str, pdf_path: str) -> TextExtractor:
+    if backend not in EXTRACTORS:
+        raise ValueError(f"Backend di estrazione sconosciuto: {backend} (disponibili: {', '.join(EXTRACTORS)})")
+    return EXTRACTORS[backend](pdf_path)
+
+
+def extractor_available(backend: str) -> bool:
+    """True se le dipendenze del backend sono installate"""
+    try:
+        importlib.import_module(EXTRACTORS[backend].module)
+        return True
+    except ImportError:
+        return False
+
+
+def _page_text(extractor: TextExtractor, index: int) -> str:
+    try:
+        return extractor.page_text(index)
+    except Exception as e:
+        print(f"  ⚠️ Estrazione pagina {index + 1} fallita: {e}")
+        return ''
+
+
+def iter_pages(extractor: TextExtractor) -> Iterator[Dict]:
+    """Pagine in ordine estratte nel processo corrente"""
+    for index in range(len(extractor)):
+        yield {'page_num': index + 1, 'text': _page_text(extractor, index)}
+
+
+# Documento aperto dal processo worker: aperto una volta per PDF e riusato per tutti gli intervalli
+_worker_extractor: Tuple[Optional[Tuple[str, str]], Optional[TextExtractor]] = (None, None)
+
+
+def _extractor_for(backend: str, pdf_path: str) -> TextExtractor:
+    global _worker_extractor
+    if _worker_extractor[0] != (backend, pdf_path):
+        if _worker_extractor[1]:
+            _worker_extractor[1].close()
+        _worker_extractor = ((backend, pdf_path), open_extractor(backend, pdf_path))
+    return _worker_extractor[1]
+
+
+def extract_page_range(pdf_path: str, first_page: int, last_page: int, backend: str = 'pypdf2') -> List[Dict]:
+    """Worker del process pool: testo delle pagine first_page..last_page (numerate da 1)"""
+    extractor = _extractor_for(backend, pdf_path)
+    return [{'page_num': page_num, 'text': _page_text(extractor, page_num - 1)}
+            for page_num in range(first_page, last_page + 1)]
+
+
+def page_ranges(total_pages: int, range_size: int) -> List[Tuple[int, int]]:
+    """Intervalli contigui di al massimo range_size pagine (piccoli: bilanciano pagine lente e veloci)"""
+    return [(first, min(first + range_size - 1, total_pages))
+            for first in range(1, total_pages + 1, max(range_size, 1))]
+
+
+def iter_pages_parallel(pdf_path: str, total_pages: int, workers: int, range_size: int = 25,
+                        backend: str = 'pypdf2') -> Iterator[Dict]:
+    """Pagine nell'ordine del documento, estratte da `workers` processi.
+
+    Restano in volo al massimo 2 * workers intervalli: la memoria non cresce con
+    il numero di pagine e in streaming il chunking procede insieme all'estrazione.
+    """
+    ranges = page_ranges(total_pages, range_size)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        queued = iter(ranges)
+        for first, last in queued:
+            pending.append(executor.submit(extract_page_range, pdf_path, first, last, backend))
+            if len(pending) >= workers * 2:
+                break
+
+        while pending:
+            pages = pending.popleft().result()
+            next_range = next(queued, None)
+            if next_range:
+                pending.append(executor.submit(extract_page_range, pdf_path, *next_range, backend))
+            yield from pages
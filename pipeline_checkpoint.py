@@ -0,0 +1,111 @@
+# pipeline_checkpoint.py
+# Checkpoint della pipeline: journal JSONL dei risultati completati e marker di fine stage
+# Con --resume una pipeline interrotta riparte pagando solo il lavoro non ancora fatto
+
+import os
+import json
+import time
+import shutil
+from typing import Any, Dict, Optional
+
+JOURNAL_FILE = 'journal.jsonl'
+STAGES_FILE = 'stages.json'
+
+
+class PipelineCheckpoint:
+    """Journal append-only (chunk, embedding, pagine Vision) più marker degli stage completati"""
+
+    def __init__(self, checkpoint_dir: str, signature: Dict, resume: bool = False):
+        self.checkpoint_dir = checkpoint_dir
+        self.signature = signature
+        self.stages: Dict[str, Any] = {}
+        self.chunks: Dict[str, Dict] = {}
+        self.vision: Dict[int, Dict] = {}
+
+        if resume and self._load():
+            print(f"♻️ Ripresa da checkpoint: {len(self.chunks)} chunks, {len(self.vision)} pagine Vision, "
+                  f"stage completati: {', '.join(self.stages) or 'nessuno'}\n")
+        else:
+            # Nuova esecuzione: il vecchio checkpoint non serve più
+            shutil.rmtree(checkpoint_dir, ignore_errors=True)
+            self.stages = {}
+            self.chunks = {}
+            self.vision = {}
+
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        self._save_stages()
+        self._journal = open(os.path.join(checkpoint_dir, JOURNAL_FILE), 'a', encoding='utf-8')
+
+    def _load(self) -> bool:
+        """Carica stage e journal; False se assenti o di un'esecuzione diversa"""
+        stages_path = os.path.join(self.checkpoint_dir, STAGES_FILE)
+        if not os.path.exists(stages_path):
+            print("⚠️ Nessun checkpoint da riprendere, parto da zero\n")
+            return False
+
+        with open(stages_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('signature') != self.signature:
+            print("⚠️ Il checkpoint appartiene a un PDF o a una configurazione diversa, parto da zero\n")
+            return False
+        self.stages = data.get('stages', {})
+
+        journal_path = os.path.join(self.checkpoint_dir, JOURNAL_FILE)
+        if os.path.exists(journal_path):
+            with open(journal_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Ultima riga troncata da un'interruzione: si ignora
+                        continue
+                    self._apply(record)
+        return True
+
+    def _apply(self, record: Dict):
+        kind = record.get('type')
+        if kind == 'chunk':
+            self.chunks[record['chunk']['id']] = record['chunk']
+        elif kind == 'embedding' and record['id'] in self.chunks:
+            self.chunks[record['id']]['embedding'] = record['embedding']
+        elif kind == 'vision':
+            self.vision[record['page']] = record['result']
+
+    def _append(self, record: Dict):
+        self._journal.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self._journal.flush()
+
+    def _save_stages(self):
+        path = os.path.join(self.checkpoint_dir, STAGES_FILE)
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'signature': self.signature, 'stages': self.stages}, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, path)
+
+    def append_chunk(self, chunk: Dict):
+        """Registra un chunk analizzato (con embedding se già calcolato)"""
+        self.chunks[chunk['id']] = chunk
+        self._append({'type': 'chunk', 'chunk': chunk})
+
+    def append_embedding(self, chunk_id: str, embedding):
+        if chunk_id in self.chunks:
+            self.chunks[chunk_id]['embedding'] = embedding
+        self._append({'type': 'embedding', 'id': chunk_id, 'embedding': embedding})
+
+    def append_vision(self, page_num: int, result: Dict):
+        self.vision[page_num] = result
+        self._append({'type': 'vision', 'page': page_num, 'result': result})
+
+    def is_done(self, stage: str) -> bool:
+        return stage in self.stages
+
+    def stage_info(self, stage: str) -> Optional[Dict]:
+        return self.stages.get(stage)
+
+    def mark_done(self, stage: str, **info):
+        """Marker di stage completato (con eventuali informazioni per la ripresa)"""
+        self.stages[stage] = dict(info, completed_at=time.strftime('%Y-%m-%d %H:%M:%S'))
+        self._save_stages()
+
+    def close(self):
+        self._journal.close()
@@ -0,0 +1,333 @@
+# pipeline_metrics.py
+# Metriche di un'esecuzione della pipeline: tempo reale e CPU per fase, istogrammi di latenza per endpoint,
+# contatori di retry ed errori, profondità delle code; esportate in JSON e nel formato testuale di Prometheus
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Cartella dei dati della pipeline (default dei comandi), relativa allo script
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'processed-v4')
+
+# Limiti superiori dei bucket di latenza (secondi): da richieste Pinecone veloci a Vision lente
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _label_text(labels: Labels) -> str:
+    return ','.join(f'{key}={value}' for key, value in labels)
+
+
+class Histogram:
+    """Conteggi per bucket cumulativi alla Prometheus, con somma e numero di osservazioni"""
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # L'ultimo è +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[int]:
+        total, result = 0, []
+        for count in self.counts:
+            total += count
+            result.append(total)
+        return result
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Stima per interpolazione lineare nel bucket (come histogram_quantile di Prometheus)"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        lower, previous = 0.0, 0
+        for bound, total in zip(self.buckets, self.cumulative()):
+            if total >= rank:
+                within = (rank - previous) / (total - previous) if total > previous else 0
+                return lower + (bound - lower) * within
+            lower, previous = bound, total
+        return self.buckets[-1]
+
+    def to_dict(self) -> Dict:
+        def ms(value):
+            return round(value * 1000, 1) if value is not None else None
+        return {
+            'count': self.count,
+            'sum_seconds': round(self.sum, 4),
+            'mean_ms': ms(self.sum / self.count) if self.count else None,
+            'p50_ms': ms(self.quantile(0.5)),
+            'p95_ms': ms(self.quantile(0.95)),
+            'p99_ms': ms(self.quantile(0.99)),
+            'buckets': {str(bound): total for bound, total in
+                        zip(list(self.buckets) + ['+Inf'], self.cumulative())}
+        }
+
+
+class PipelineMetrics:
+    """Raccoglie le metriche di un'esecuzione; thread-safe (upsert e rendering usano più thread)"""
+
+    def __init__(self, pipeline: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.pipeline = pipeline
+        self.buckets = buckets
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._stacks: Dict[int, List[List]] = {}  # Fasi aperte per thread: [nome, inizio reale, inizio CPU]
+        self.stages: Dict[str, Dict] = {}
+        self.histograms: Dict[Labels, Histogram] = {}
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.gauges: Dict[str, Dict[str, float]] = {}
+        self._snapshot_thread = None
+        self._snapshot_stop = threading.Event()
+
+    # ---- fasi ----
+
+    def _charge(self, frame: List, now: float, cpu: float):
+        entry = self.stages.setdefault(frame[0], {'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'calls': 0})
+        entry['wall_seconds'] += now - frame[1]
+        entry['cpu_seconds'] += cpu - frame[2]
+
+    @contextmanager
+    def stage(self, name: str):
+        """Tempo esclusivo della fase: una fase annidata (es. l'estrazione consumata dall'analisi
+        in streaming) sospende quella esterna, così ogni secondo è attribuito a una sola fase"""
+        # Le pile si modificano sotto lock: gli snapshot le leggono da un altro thread
+        with self._lock:
+            stack = self._stacks.setdefault(threading.get_ident(), [])
+            now, cpu = time.perf_counter(), time.process_time()
+            if stack:
+                self._charge(stack[-1], now, cpu)
+            stack.append([name, now, cpu])
+        try:
+            yield
+        finally:
+            with self._lock:
+                now, cpu = time.perf_counter(), time.process_time()
+                self._charge(stack.pop(), now, cpu)
+                self.stages[name]['calls'] += 1
+                if stack:
+                    stack[-1][1], stack[-1][2] = now, cpu
+
+    def timed_iter(self, name: str, items: Iterable) -> Iterator:
+        """Attribuisce alla fase il tempo speso a produrre ogni elemento di un generatore"""
+        iterator = iter(items)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    # ---- richieste, contatori, code ----
+
+    def observe(self, endpoint: str, seconds: float):
+        """Latenza di una richiesta HTTP (un tentativo, retry compresi come richieste separate)"""
+        key = _labels({'endpoint': endpoint})
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(self.buckets)
+            self.histograms[key].observe(seconds)
+
+    def increment(self, name: str, amount: float = 1, **labels):
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            key = _labels(labels)
+            series[key] = series.get(key, 0) + amount
+
+    def set_gauge(self, name: str, value: float):
+        """Valore corrente e massimo raggiunto (es. richieste in volo, batch in coda)"""
+        with self._lock:
+            gauge = self.gauges.setdefault(name, {'value': 0, 'max': 0})
+            gauge['value'] = value
+            gauge['max'] = max(gauge['max'], value)
+
+    # ---- esportazione ----
+
+    def _stage_totals(self) -> Dict[str, Dict]:
+        """Totali per fase compreso il tempo della fase in corso (per gli snapshot periodici)"""
+        totals = {name: dict(entry) for name, entry in self.stages.items()}
+        now, cpu = time.perf_counter(), time.process_time()
+        for stack in self._stacks.values():
+            if stack:
+                name, wall_start, cpu_start = stack[-1]
+                entry = totals.setdefault(name, {'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'calls': 0})
+                entry['wall_seconds'] += now - wall_start
+                entry['cpu_seconds'] += cpu - cpu_start
+        return totals
+
+    def summary(self) -> Dict:
+        with self._lock:
+            return {
+                'pipeline': self.pipeline,
+                'started_at': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started)),
+                'elapsed_seconds': round(time.time() - self.started, 3),
+                'stages': {name: {'wall_seconds': round(entry['wall_seconds'], 3),
+                                  'cpu_seconds': round(entry['cpu_seconds'], 3), 'calls': entry['calls']}
+                           for name, entry in self._stage_totals().items()},
+                'requests': {dict(key)['endpoint']: histogram.to_dict()
+                             for key, histogram in sorted(self.histograms.items())},
+                'counters': {name: {_label_text(key): value for key, value in sorted(series.items())}
+                             for name, series in self.counters.items()},
+                'queues': {name: dict(gauge) for name, gauge in self.gauges.items()}
+            }
+
+    def prometheus(self) -> str:
+        """Formato testuale di Prometheus (per il textfile collector di node_exporter)"""
+        base = {'pipeline': self.pipeline}
+
+        def series(name: str, labels: Dict, value) -> str:
+            text = ','.join(f'{key}="{_escape(value)}"' for key, value in {**base, **labels}.items())
+            return f'{name}{{{text}}} {value}'
+
+        lines = []
+        with self._lock:
+            for metric, key, help_text in (('pipeline_stage_wall_seconds', 'wall_seconds', 'Tempo reale per fase'),
+                                           ('pipeline_stage_cpu_seconds', 'cpu_seconds', 'Tempo CPU del processo per fase')):
+                lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} counter']
+                lines += [series(metric, {'stage': name}, round(entry[key], 6))
+                          for name, entry in self._stage_totals().items()]
+
+            metric = 'pipeline_request_duration_seconds'
+            lines += [f'# HELP {metric} Latenza delle richieste HTTP per endpoint', f'# TYPE {metric} histogram']
+            for key, histogram in sorted(self.histograms.items()):
+                labels = dict(key)
+                for bound, total in zip(list(histogram.buckets) + ['+Inf'], histogram.cumulative()):
+                    lines.append(series(f'{metric}_bucket', {**labels, 'le': bound}, total))
+                lines.append(series(f'{metric}_sum', labels, round(histogram.sum, 6)))
+                lines.append(series(f'{metric}_count', labels, histogram.count))
+
+            for name, values in self.counters.items():
+                metric = f'pipeline_{name}_total'
+                lines += [f'# TYPE {metric} counter']
+                lines += [series(metric, dict(key), value) for key, value in sorted(values.items())]
+
+            if self.gauges:
+                lines += ['# HELP pipeline_queue_depth Elementi in coda o in volo', '# TYPE pipeline_queue_depth gauge']
+                lines += [series('pipeline_queue_depth', {'queue': name}, gauge['value'])
+                          for name, gauge in self.gauges.items()]
+                lines += ['# TYPE pipeline_queue_depth_max gauge']
+                lines += [series('pipeline_queue_depth_max', {'queue': name}, gauge['max'])
+                          for name, gauge in self.gauges.items()]
+        return '\n'.join(lines) + '\n'
+
+    def write(self, json_path: Optional[str], prometheus_path: Optional[str] = None):
+        """Scrittura atomica: un lettore (o Prometheus) non vede mai un file a metà"""
+        for path, content in ((json_path, lambda: json.dumps(self.summary(), indent=2)),
+                              (prometheus_path, self.prometheus)):
+            if not path:
+                continue
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            tmp = path + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                f.write(content())
+            os.replace(tmp, path)
+
+    def start_snapshots(self, json_path: str, prometheus_path: Optional[str], interval: float):
+        """Riscrive i file ogni `interval` secondi durante l'esecuzione (0 = disattivato)"""
+        if interval <= 0 or self._snapshot_thread:
+            return
+
+        def loop():
+            while not self._snapshot_stop.wait(interval):
+                try:
+                    self.write(json_path, prometheus_path)
+                except OSError as e:
+                    print(f"  ⚠️ Snapshot metriche non scritto: {e}", file=sys.stderr)
+
+        self._snapshot_thread = threading.Thread(target=loop, daemon=True)
+        self._snapshot_thread.start()
+
+    def stop_snapshots(self):
+        if self._snapshot_thread:
+            self._snapshot_stop.set()
+            self._snapshot_thread.join()
+            self._snapshot_thread = None
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def endpoint_name(service: str, path: str) -> str:
+    """Endpoint senza versione e ID (es. /v1/batches/batch_abc -> openai /batches/{id})"""
+    path = re.sub(r'^/v\d+', '', path)
+    path = re.sub(r'/(file|batch|chatcmpl)[-_][^/]+', '/{id}', path)
+    return f'{service} {path}'
+
+
+def httpx_event_hooks(metrics: PipelineMetrics, service: str = 'openai', asynchronous: bool = False) -> Dict:
+    """Hook di httpx per i client OpenAI: latenza di ogni tentativo, errori per status e retry.
+
+    L'SDK ritenta da sé 429 e 5xx: ogni tentativo passa dagli hook e l'header
+    x-stainless-retry-count dice quanti retry lo hanno preceduto.
+    """
+    def on_request(request):
+        request.extensions['metrics_start'] = time.perf_counter()
+
+    def on_response(response):
+        request = response.request
+        endpoint = endpoint_name(service, request.url.path)
+        start = request.extensions.get('metrics_start')
+        if start is not None:
+            metrics.observe(endpoint, time.perf_counter() - start)
+        if response.status_code >= 400:
+            metrics.increment('errors', endpoint=endpoint, status=response.status_code)
+        if request.headers.get('x-stainless-retry-count', '0') not in ('', '0'):
+            metrics.increment('retries', endpoint=endpoint)
+
+    if not asynchronous:
+        return {'request': [on_request], 'response': [on_response]}
+
+    async def on_request_async(request):
+        on_request(request)
+
+    async def on_response_async(response):
+        on_response(response)
+
+    return {'request': [on_request_async], 'response': [on_response_async]}
+
+
+def main(argv: List[str] = None):
+    """Riassunto leggibile di un file di metriche JSON"""
+    parser = argparse.ArgumentParser(description="Metriche di un'esecuzione della pipeline")
+    parser.add_argument('path', nargs='?', default=os.path.join(DATA_DIR, 'metrics.json'))
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.path):
+        print(f"❌ File di metriche non trovato: {args.path}")
+        return 1
+    with open(args.path, 'r', encoding='utf-8') as f:
+        summary = json.load(f)
+
+    print(f"📊 Pipeline {summary['pipeline']} del {summary['started_at']}: {summary['elapsed_seconds']} s")
+    for name, stage in sorted(summary['stages'].items(), key=lambda item: -item[1]['wall_seconds']):
+        print(f"  • {name}: {stage['wall_seconds']} s reali, {stage['cpu_seconds']} s CPU")
+    for endpoint, histogram in summary['requests'].items():
+        print(f"  • {endpoint}: {histogram['count']} richieste, p50 {histogram['p50_ms']} ms, "
+              f"p95 {histogram['p95_ms']} ms, p99 {histogram['p99_ms']} ms")
+    for name, series in summary['counters'].items():
+        for labels, value in series.items():
+            print(f"  • {name} [{labels}]: {value:g}")
+    for name, gauge in summary['queues'].items():
+        print(f"  • coda {name}: massimo {gauge['max']:g}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
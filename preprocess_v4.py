@@ -3,88 +3,189 @@
 # Ottimizzato per Windows 11
 
 import os
+import io
 import json
+import asyncio
 import time
-from typing import List, Dict, Any
+import random
+import argparse
+import shutil
+import hashlib
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import islice
+from typing import List, Dict, Any, Optional, Tuple, Iterable, Iterator
 from pathlib import Path
 
 # Dipendenze esterne
 from dotenv import load_dotenv
 import openai
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
 from pinecone import Pinecone
-import PyPDF2
 import tiktoken
 
+from content_cache import ContentCache
+from upsert_engine import UpsertEngine
+from index_manifest import IndexManifest
+from page_image_cache import pdf_content_hash
+from pipeline_checkpoint import PipelineCheckpoint
+from embedding_store import EmbeddingStore
+from local_vector_index import LocalVectorIndex
+from bm25_index import BM25Index
+from sparse_encoder import SparseEncoder
+from token_budget import TokenBudget
+from near_duplicates import NearDuplicateDetector
+from openai_batch import BatchRunner
+from pdf_text_extraction import TextExtractor, open_extractor, extractor_available, iter_pages, iter_pages_parallel, EXTRACTORS
+from corpus import discover_documents
+from pipeline_metrics import PipelineMetrics, httpx_event_hooks
+from usage_ledger import UsageLedger
+
 # Carica configurazione da .env.local
 load_dotenv('.env.local')
 
 # ============ CONFIGURAZIONE ============
+# Percorsi costruiti a partire dalla cartella dello script: validi da qualsiasi directory e sistema
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+OUTPUT_DIR = os.path.join(BASE_DIR, 'data', 'processed-v4')
+
 CONFIG = {
     'openai': {
         'api_key': os.getenv('OPENAI_API_KEY'),
+        'base_url': os.getenv('OPENAI_BASE_URL'),  # None = API ufficiale (utile per server stub locali)
         'model': 'gpt-3.5-turbo',  # Usa gpt-4 se vuoi più accuratezza
         'embedding_model': 'text-embedding-3-small',  # Più economico
+        'embedding_max_input_tokens': 8191,  # Limite per singolo input di embedding
         'max_tokens': 500,
-        'temperature': 0.1
+        'analysis_prompt_tokens': 1000,  # Budget esatto del prompt di analisi (il testo viene accorciato)
+        'temperature': 0.1,
+        'batch_completion_window': '24h',  # Finestra di completamento della Batch API
+        'batch_poll_seconds': 30  # Intervallo di controllo dello stato dei batch
     },
     'pinecone': {
         'api_key': os.getenv('PINECONE_API_KEY'),
         'environment': os.getenv('PINECONE_ENVIRONMENT', 'us-east-1'),
         'index_name': 'quiz-course-v4',
+        'host': os.getenv('PINECONE_HOST'),  # Host data-plane diretto (es. fake locale), salta creazione e lookup
+        'controller_host': os.getenv('PINECONE_CONTROLLER_HOST'),  # Host control-plane (None = API Pinecone)
+        'metric': os.getenv('PINECONE_METRIC'),  # Metrica dell'indice se describe_index non è raggiungibile
+        'backend': os.getenv('VECTOR_BACKEND', 'pinecone'),  # pinecone | local (indice NumPy su disco)
+        'local_ivf_lists': 0,  # Liste IVF dell'indice locale (0 = sempre ricerca esatta)
+        # Vettori sparse BM25 insieme ai dense (richiede metrica dotproduct): opt-in finché
+        # le query lato JS non inviano anche il vettore sparse
+        'sparse_vectors': False,
         'dimension': 1536  # Dimensione per text-embedding-3-small
     },
     'processing': {
-        'chunk_size': 1000,  # Caratteri per chunk
+        # chars = chunk e overlap in caratteri, tokens = in token (--chunk-unit tokens). Cambiare unità
+        # cambia i chunks e i loro ID: con l'indice incrementale tutti i vettori vengono riscritti
+        'chunk_unit': 'chars',
+        'chunk_size': 1000,  # Caratteri per chunk (chunk_unit = chars)
         'chunk_overlap': 200,
+        'chunk_tokens': 300,  # Token per chunk (chunk_unit = tokens)
+        'chunk_overlap_tokens': 50,
         'max_chunks_to_process': 100,  # Limita per test (rimuovi per processare tutto)
-        'batch_size': 10
+        'corpus_workers': None,  # Processi per estrazione e chunking in modalità corpus (None = tutti i core)
+        'upsert_concurrency': 4,  # Richieste di upsert Pinecone in parallelo
+        'upsert_max_batch_bytes': 2 * 1024 * 1024,  # Limite payload per richiesta
+        'upsert_max_batch_records': 1000,  # Limite vettori per richiesta
+        'upsert_max_retries': 5,  # Retry con backoff sugli errori transitori
+        'incremental_index': True,  # Sincronizza l'indice col manifest locale (solo vettori cambiati)
+        'streaming': False,  # True = estrazione a pagine, memoria limitata a poche pagine
+        'extractor': 'pypdf2',  # Backend di estrazione del testo: pypdf2 | pymupdf | pdfium | pdfminer
+        'extract_workers': max(1, (os.cpu_count() or 2) - 1),  # Processi per l'estrazione del testo (1 = seriale)
+        'extract_range_pages': 25,  # Pagine per intervallo assegnato a un processo
+        'async_analysis': False,  # Analisi ed embedding concorrenti con AsyncOpenAI (--async-analysis)
+        'concurrency': 8,  # Richieste OpenAI in volo contemporaneamente
+        'batch_embeddings': True,  # Più testi per ogni richiesta embeddings.create
+        'embedding_batch_max_items': 2048,  # Input massimi per richiesta
+        'embedding_batch_max_tokens': 300000,  # Token massimi per richiesta
+        'embedding_max_retries': 3,  # Retry del batch intero su 429/5xx/rete (dopo quelli dell'SDK)
+        'embedding_backoff_seconds': 2.0,  # Attesa base del backoff esponenziale
+        'embedding_dtype': 'float16',  # Precisione dell'archivio locale degli embedding (float16 | float32)
+        'batch_api': False,  # True = analisi ed embedding con la Batch API (metà costo, risultati differiti)
+        'dedup': False,  # Chunks quasi identici (MinHash/LSH): analisi ed embedding solo del rappresentante (--dedup)
+        'dedup_threshold': 0.85,  # Similarità Jaccard stimata minima per considerare due chunks duplicati
+        'metrics_snapshot_seconds': 0  # Riscrive i file delle metriche ogni N secondi durante l'esecuzione (0 = solo alla fine)
+    },
+    'cache': {
+        'enable': True,  # Cache locale di analisi ed embedding (content-addressed)
+        'max_mb': 1024,  # Oltre questa dimensione elimina le voci meno usate (LRU)
+        'prompt_version': 'v4-text-2'  # Incrementare quando cambia il prompt di analisi
     },
     'paths': {
-        'pdf_source': r'data\source\corso_completo.pdf',
-        'output_dir': r'data\processed-v4',
-        'chunks_file': r'data\processed-v4\chunks.json',
-        'metadata_file': r'data\processed-v4\metadata.json'
+        'pdf_source': os.path.join(BASE_DIR, 'data', 'source', 'corso_completo.pdf'),
+        'corpus_source': None,  # Cartella o manifest di PDF: se impostato sostituisce pdf_source
+        'output_dir': OUTPUT_DIR,
+        'chunks_file': os.path.join(OUTPUT_DIR, 'chunks.json'),
+        'metadata_file': os.path.join(OUTPUT_DIR, 'metadata.json'),
+        'cache_db': os.path.join(OUTPUT_DIR, 'cache.sqlite'),
+        'index_manifest': os.path.join(OUTPUT_DIR, 'index_manifest.json'),
+        'checkpoint_dir': os.path.join(OUTPUT_DIR, 'checkpoint'),
+        'batch_dir': os.path.join(OUTPUT_DIR, 'batch'),
+        'embedding_store': os.path.join(OUTPUT_DIR, 'embeddings'),
+        'local_index': os.path.join(OUTPUT_DIR, 'local_index'),
+        'bm25_index': os.path.join(OUTPUT_DIR, 'bm25.json'),
+        'sparse_vocabulary': os.path.join(OUTPUT_DIR, 'sparse_vocabulary.json'),
+        'metrics_json': os.path.join(OUTPUT_DIR, 'metrics.json'),
+        'metrics_prometheus': os.path.join(OUTPUT_DIR, 'metrics.prom')
     }
 }
 
 class PDFProcessor:
     """Gestisce l'estrazione e il processing del PDF"""
     
-    def __init__(self):
+    def __init__(self, tokens: TokenBudget):
         self.text = ""
         self.metadata = {}
         self.pages = []
+        self.tokens = tokens
     
-    def extract_pdf(self, pdf_path: str) -> str:
-        """Estrae testo dal PDF"""
+    def iter_pages(self, pdf_path: str) -> Iterator[Dict]:
+        """Estrae le pagine una alla volta (generatore)"""
         print(f"📚 Estrazione PDF: {pdf_path}")
         
         if not os.path.exists(pdf_path):
             raise FileNotFoundError(f"PDF non trovato: {pdf_path}")
         
-        with open(pdf_path, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            
+        with open_extractor(CONFIG['processing']['extractor'], pdf_path) as extractor:
             self.metadata = {
-                'total_pages': len(pdf_reader.pages),
-                'info': pdf_reader.metadata if pdf_reader.metadata else {}
+                'total_pages': len(extractor),
+                'info': extractor.info(),
+                'extractor': extractor.name
             }
             
             print(f"  📄 Totale pagine: {self.metadata['total_pages']}")
             
-            # Estrai testo pagina per pagina
-            for i, page in enumerate(pdf_reader.pages):
-                page_text = page.extract_text()
-                self.pages.append({
-                    'page_num': i + 1,
-                    'text': page_text,
-                    'char_count': len(page_text)
-                })
-                self.text += page_text + "\n\n"
+            # Estrai testo pagina per pagina (intervalli di pagine in parallelo se ci sono più core)
+            for i, page_data in enumerate(self._extracted_pages(pdf_path, extractor)):
+                page_text = page_data['text']
                 
                 if (i + 1) % 10 == 0:
                     print(f"  ✓ Processate {i + 1}/{self.metadata['total_pages']} pagine")
+                
+                yield {
+                    'page_num': i + 1,
+                    'text': page_text,
+                    'char_count': len(page_text)
+                }
+    
+    def _extracted_pages(self, pdf_path: str, extractor: TextExtractor) -> Iterator[Dict]:
+        """Testo delle pagine in ordine: processi worker con il proprio documento o, con un solo worker, seriale"""
+        workers = CONFIG['processing'].get('extract_workers', 1)
+        range_size = CONFIG['processing']['extract_range_pages']
+        if workers > 1 and len(extractor) > range_size:
+            return iter_pages_parallel(pdf_path, len(extractor), workers, range_size, extractor.name)
+        return iter_pages(extractor)
+    
+    def extract_pdf(self, pdf_path: str) -> str:
+        """Estrae testo dal PDF"""
+        parts = []
+        for page_data in self.iter_pages(pdf_path):
+            self.pages.append(page_data)
+            parts.append(page_data['text'])
+            parts.append("\n\n")
+        self.text = ''.join(parts)
         
         print(f"✅ Estratti {len(self.text)} caratteri totali\n")
         return self.text
@@ -93,24 +194,53 @@ class PDFProcessor:
         """Divide il testo in chunks intelligenti"""
         print("🧩 Creazione chunks semantici...")
         
-        chunks = []
+        # Dividi per paragrafi
+        chunks = list(self._chunk_paragraphs(text.split('\n\n')))
+        
+        print(f"✅ Creati {len(chunks)} chunks\n")
+        return chunks
+    
+    def iter_chunks(self, pages: Iterable[Dict]) -> Iterator[Dict]:
+        """Versione streaming di create_chunks: consuma le pagine ed emette chunks man mano"""
+        print("🧩 Creazione chunks semantici (streaming)...")
+        return self._chunk_paragraphs(self._iter_paragraphs(pages))
+    
+    @staticmethod
+    def _iter_paragraphs(pages: Iterable[Dict]) -> Iterator[str]:
+        """Restituisce gli stessi paragrafi di text.split('\\n\\n') senza costruire il testo completo"""
+        pending = ""
+        for page_data in pages:
+            parts = (pending + page_data['text'] + "\n\n").split('\n\n')
+            pending = parts.pop()
+            yield from parts
+        yield pending
+    
+    def _make_chunk(self, chunk_id: int, text: str) -> Dict:
+        text = text.strip()
+        return {
+            'id': f'chunk_{chunk_id}',
+            'text': text,
+            'char_count': len(text),
+            'token_count': self.tokens.count(text),
+            'chunk_index': chunk_id
+        }
+    
+    def _chunk_paragraphs(self, paragraphs: Iterable[str]) -> Iterator[Dict]:
+        """Raggruppa i paragrafi in chunks con overlap (dimensioni in token o in caratteri)"""
+        if CONFIG['processing']['chunk_unit'] == 'tokens':
+            yield from self._chunk_paragraphs_by_tokens(paragraphs)
+            return
+        
         chunk_size = CONFIG['processing']['chunk_size']
         overlap = CONFIG['processing']['chunk_overlap']
         
-        # Dividi per paragrafi
-        paragraphs = text.split('\n\n')
         current_chunk = ""
         chunk_id = 0
         
         for para in paragraphs:
             # Se aggiungere questo paragrafo supera la dimensione
             if len(current_chunk) + len(para) > chunk_size and current_chunk:
-                chunks.append({
-                    'id': f'chunk_{chunk_id}',
-                    'text': current_chunk.strip(),
-                    'char_count': len(current_chunk),
-                    'chunk_index': chunk_id
-                })
+                yield self._make_chunk(chunk_id, current_chunk)
                 chunk_id += 1
                 
                 # Overlap: prendi ultime frasi del chunk precedente
@@ -125,89 +255,444 @@ class PDFProcessor:
         
         # Aggiungi ultimo chunk
         if current_chunk.strip():
-            chunks.append({
-                'id': f'chunk_{chunk_id}',
-                'text': current_chunk.strip(),
-                'char_count': len(current_chunk),
-                'chunk_index': chunk_id
-            })
+            yield self._make_chunk(chunk_id, current_chunk)
+    
+    def _chunk_paragraphs_by_tokens(self, paragraphs: Iterable[str]) -> Iterator[Dict]:
+        """Come _chunk_paragraphs, ma chunk e overlap misurati in token (paragrafi codificati a blocchi)"""
+        chunk_tokens = CONFIG['processing']['chunk_tokens']
+        overlap = CONFIG['processing']['chunk_overlap_tokens']
         
-        print(f"✅ Creati {len(chunks)} chunks\n")
-        return chunks
+        current_chunk = ""
+        current_tokens = 0
+        chunk_id = 0
+        
+        for para, para_tokens in self.tokens.measure(paragraphs):
+            if current_tokens + para_tokens > chunk_tokens and current_chunk:
+                yield self._make_chunk(chunk_id, current_chunk)
+                chunk_id += 1
+                
+                # Overlap: gli ultimi `overlap` token del chunk precedente (se ci stanno col paragrafo)
+                tail_tokens = overlap if overlap + para_tokens + 1 <= chunk_tokens else 0
+                tail = current_chunk[self.tokens.tail_start(current_chunk, tail_tokens):]
+                current_chunk = tail + " " + para if tail else para
+                current_tokens = min(tail_tokens, current_tokens) + para_tokens + (1 if tail else 0)
+            else:
+                # Il separatore "\n\n" vale un token
+                current_tokens += para_tokens + 1 if current_chunk else para_tokens
+                current_chunk += "\n\n" + para if current_chunk else para
+        
+        if current_chunk.strip():
+            yield self._make_chunk(chunk_id, current_chunk)
+
+# Encoder del processo worker, caricato una volta da _init_corpus_worker
+_worker_tokens = None
+
+def _init_corpus_worker(processing: Dict, model: str):
+    """Inizializza un processo del pool: configurazione del chunking del processo principale ed encoder"""
+    global _worker_tokens
+    CONFIG['processing'].update(processing)
+    CONFIG['processing']['extract_workers'] = 1  # Il parallelismo è già tra i documenti
+    _worker_tokens = TokenBudget(tiktoken.encoding_for_model(model))
+
+def extract_document(document: Dict) -> Dict:
+    """Estrazione e chunking di un documento del corpus (eseguito in un processo del pool)"""
+    processor = PDFProcessor(_worker_tokens)
+    # L'avanzamento lo stampa il processo principale, un documento alla volta
+    with contextlib.redirect_stdout(io.StringIO()):
+        chunks = processor.create_chunks(processor.extract_pdf(document['path']))
+    for chunk in chunks:
+        chunk['id'] = f"{document['id']}:{chunk['id']}"
+        chunk['document'] = document['id']
+    
+    info = processor.metadata.get('info') or {}
+    return {
+        'id': document['id'],
+        'pages': processor.metadata.get('total_pages', 0),
+        'info': {str(key): str(value) for key, value in info.items()},
+        'chunks': chunks
+    }
 
 class SemanticAnalyzer:
     """Analisi semantica con OpenAI"""
     
-    def __init__(self):
-        self.client = OpenAI(api_key=CONFIG['openai']['api_key'])
-        self.encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+    def __init__(self, metrics: PipelineMetrics):
+        self.metrics = metrics
+        self.usage = UsageLedger()  # Token reali dal campo usage di ogni risposta
+        self.client = OpenAI(**self._client_options())
+        self.async_client = None  # Creato da open_async_client() dentro l'event loop
+        self.encoding = tiktoken.encoding_for_model(CONFIG['openai']['model'])
+        self.tokens = TokenBudget(self.encoding)
+        self.fallback_ids = set()  # Chunks con analisi di default: non vanno nel journal
+        self.cache = None
+        if CONFIG['cache']['enable']:
+            self.cache = ContentCache(CONFIG['paths']['cache_db'], CONFIG['cache']['max_mb'] * 1024 * 1024)
     
-    def analyze_chunk(self, chunk: Dict) -> Dict:
-        """Analizza semanticamente un chunk"""
-        try:
-            prompt = f"""Analizza questo estratto di un corso di informatica e estrai:
+    def _client_options(self, asynchronous: bool = False) -> Dict:
+        """Opzioni comuni ai client sync/async (base_url permette server stub locali)"""
+        options = {'api_key': CONFIG['openai']['api_key']}
+        if CONFIG['openai'].get('base_url'):
+            options['base_url'] = CONFIG['openai']['base_url']
+        # Gli hook di httpx vedono ogni tentativo, compresi i retry interni dell'SDK
+        hooks = httpx_event_hooks(self.metrics, 'openai', asynchronous)
+        options['http_client'] = (DefaultAsyncHttpxClient(event_hooks=hooks) if asynchronous
+                                  else DefaultHttpxClient(event_hooks=hooks))
+        return options
+    
+    def open_async_client(self) -> AsyncOpenAI:
+        """Crea il client asincrono per lo stage concorrente"""
+        self.async_client = AsyncOpenAI(**self._client_options(asynchronous=True))
+        return self.async_client
+    
+    def _analysis_request(self, chunk: Dict) -> Dict:
+        """Parametri della richiesta di analisi per un chunk (prompt entro il budget di token)"""
+        prefix = """Analizza questo estratto di un corso di informatica e estrai:
 1. L'argomento principale
 2. I concetti chiave (max 5)
 3. Il tipo di contenuto
 
 Testo:
-{chunk['text'][:2000]}
+"""
+        suffix = """
 
 Rispondi in JSON:
-{{
+{
   "topic": "argomento principale",
   "concepts": ["concetto1", "concetto2"],
   "content_type": "theory|practice|example|definition",
   "importance": 1-10,
   "summary": "riassunto in una frase"
-}}"""
-
-            response = self.client.chat.completions.create(
-                model=CONFIG['openai']['model'],
-                messages=[{"role": "user", "content": prompt}],
-                temperature=CONFIG['openai']['temperature'],
-                max_tokens=CONFIG['openai']['max_tokens'],
-                response_format={"type": "json_object"}
-            )
+}"""
+        prompt = self.tokens.fit(prefix, chunk['text'], suffix, CONFIG['openai']['analysis_prompt_tokens'])
+        return {
+            'model': CONFIG['openai']['model'],
+            'messages': [{"role": "user", "content": prompt}],
+            'temperature': CONFIG['openai']['temperature'],
+            'max_tokens': CONFIG['openai']['max_tokens'],
+            'response_format': {"type": "json_object"}
+        }
+    
+    def _analysis_key(self, chunk: Dict) -> str:
+        """Chiave di cache per l'analisi: testo, modello, versione e budget del prompt, unità di chunking"""
+        # Il budget decide quanto testo entra nel prompt: cambiarlo deve invalidare le analisi
+        return ContentCache.make_key('analysis', chunk['text'], CONFIG['openai']['model'],
+                                     CONFIG['cache']['prompt_version'],
+                                     {'prompt_tokens': CONFIG['openai']['analysis_prompt_tokens'],
+                                      'chunk_unit': CONFIG['processing']['chunk_unit']})
+    
+    def _embedding_key(self, text: str) -> str:
+        """Chiave di cache per l'embedding di un testo"""
+        return ContentCache.make_key('embedding', text, CONFIG['openai']['embedding_model'])
+    
+    def _cache_get(self, namespace: str, key: str) -> Optional[Any]:
+        return self.cache.get(namespace, key) if self.cache else None
+    
+    def _cache_put(self, namespace: str, key: str, value: Any, model: str):
+        if self.cache and value is not None:
+            self.cache.put(namespace, key, value, model)
+    
+    def _fallback_analysis(self, chunk: Dict) -> Dict:
+        """Analisi di default in caso di errore"""
+        self.fallback_ids.add(chunk['id'])
+        return {
+            'topic': 'Unknown',
+            'concepts': [],
+            'content_type': 'text',
+            'importance': 5,
+            'summary': chunk['text'][:100]
+        }
+    
+    def analyze_chunk(self, chunk: Dict) -> Dict:
+        """Analizza semanticamente un chunk"""
+        key = self._analysis_key(chunk)
+        cached = self._cache_get('analysis', key)
+        if cached is not None:
+            return cached
+        
+        try:
+            response = self.client.chat.completions.create(**self._analysis_request(chunk))
+            self.usage.record_response('analysis', response, CONFIG['openai']['model'])
             
             analysis = json.loads(response.choices[0].message.content)
+            self._cache_put('analysis', key, analysis, CONFIG['openai']['model'])
             return analysis
             
         except Exception as e:
             print(f"  ⚠️ Errore analisi: {e}")
-            return {
-                'topic': 'Unknown',
-                'concepts': [],
-                'content_type': 'text',
-                'importance': 5,
-                'summary': chunk['text'][:100]
-            }
+            return self._fallback_analysis(chunk)
+    
+    async def analyze_chunk_async(self, chunk: Dict) -> Dict:
+        """Versione asincrona di analyze_chunk (stessa gestione errori)"""
+        key = self._analysis_key(chunk)
+        cached = self._cache_get('analysis', key)
+        if cached is not None:
+            return cached
+        
+        try:
+            response = await self.async_client.chat.completions.create(**self._analysis_request(chunk))
+            self.usage.record_response('analysis', response, CONFIG['openai']['model'])
+            
+            analysis = json.loads(response.choices[0].message.content)
+            self._cache_put('analysis', key, analysis, CONFIG['openai']['model'])
+            return analysis
+            
+        except Exception as e:
+            print(f"  ⚠️ Errore analisi: {e}")
+            return self._fallback_analysis(chunk)
     
     def generate_embedding(self, text: str) -> List[float]:
         """Genera embedding per il testo"""
+        key = self._embedding_key(text)
+        cached = self._cache_get('embedding', key)
+        if cached is not None:
+            return cached
+        
         try:
             response = self.client.embeddings.create(
                 model=CONFIG['openai']['embedding_model'],
-                input=text[:8000]  # Limita lunghezza
+                input=self.tokens.truncate(text, CONFIG['openai']['embedding_max_input_tokens'])
             )
-            return response.data[0].embedding
+            self.usage.record_response('embedding', response, CONFIG['openai']['embedding_model'])
+            embedding = response.data[0].embedding
+            self._cache_put('embedding', key, embedding, CONFIG['openai']['embedding_model'])
+            return embedding
         except Exception as e:
             print(f"  ⚠️ Errore embedding: {e}")
             return None
+    
+    async def generate_embedding_async(self, text: str) -> List[float]:
+        """Versione asincrona di generate_embedding"""
+        key = self._embedding_key(text)
+        cached = self._cache_get('embedding', key)
+        if cached is not None:
+            return cached
+        
+        try:
+            response = await self.async_client.embeddings.create(
+                model=CONFIG['openai']['embedding_model'],
+                input=self.tokens.truncate(text, CONFIG['openai']['embedding_max_input_tokens'])
+            )
+            self.usage.record_response('embedding', response, CONFIG['openai']['embedding_model'])
+            embedding = response.data[0].embedding
+            self._cache_put('embedding', key, embedding, CONFIG['openai']['embedding_model'])
+            return embedding
+        except Exception as e:
+            print(f"  ⚠️ Errore embedding: {e}")
+            return None
+    
+    def analyze_chunks_batch_api(self, chunks: List[Dict]) -> Dict:
+        """Analisi ed embedding di tutti i chunks con la Batch API; le richieste fallite si ripetono sincrone"""
+        runner = BatchRunner(self.client, CONFIG['paths']['batch_dir'],
+                             CONFIG['openai']['batch_poll_seconds'], CONFIG['openai']['batch_completion_window'])
+        by_id = {chunk['id']: chunk for chunk in chunks}
+        analysis_requests, embedding_requests = [], []
+        
+        # Le risposte già in cache non vanno nel batch
+        for chunk in chunks:
+            cached = self._cache_get('analysis', self._analysis_key(chunk))
+            if cached is not None:
+                chunk['analysis'] = cached
+            else:
+                analysis_requests.append((chunk['id'], self._analysis_request(chunk)))
+            
+            cached = self._cache_get('embedding', self._embedding_key(chunk['text']))
+            if cached is not None:
+                chunk['embedding'] = cached
+            else:
+                embedding_requests.append((chunk['id'], {
+                    'model': CONFIG['openai']['embedding_model'],
+                    'input': self.tokens.truncate(chunk['text'], CONFIG['openai']['embedding_max_input_tokens'])
+                }))
+        
+        print(f"📦 Batch API: {len(analysis_requests)} analisi e {len(embedding_requests)} embedding "
+              f"({len(chunks) - len(analysis_requests)} analisi dalla cache)")
+        outcome = runner.run({
+            'analysis': ('/v1/chat/completions', analysis_requests),
+            'embedding': ('/v1/embeddings', embedding_requests)
+        })
+        
+        analyses, analysis_errors = outcome['analysis']
+        for chunk_id, body in analyses.items():
+            chunk = by_id[chunk_id]
+            self.usage.record_response('analysis', body, CONFIG['openai']['model'], batch=True)
+            try:
+                analysis = json.loads(body['choices'][0]['message']['content'])
+            except (KeyError, IndexError, TypeError, ValueError):
+                analysis_errors[chunk_id] = 'risposta JSON non valida'
+                continue
+            chunk['analysis'] = analysis
+            self._cache_put('analysis', self._analysis_key(chunk), analysis, CONFIG['openai']['model'])
+        
+        embeddings, embedding_errors = outcome['embedding']
+        for chunk_id, body in embeddings.items():
+            chunk = by_id[chunk_id]
+            self.usage.record_response('embedding', body, CONFIG['openai']['embedding_model'], batch=True)
+            chunk['embedding'] = body['data'][0]['embedding']
+            self._cache_put('embedding', self._embedding_key(chunk['text']), chunk['embedding'],
+                            CONFIG['openai']['embedding_model'])
+        
+        # Fallimenti parziali: chiamate sincrone per i soli chunks rimasti senza risultato
+        if analysis_errors or embedding_errors:
+            print(f"  ⚠️ Falliti nel batch: {len(analysis_errors)} analisi, {len(embedding_errors)} embedding "
+                  f"(ripetuti con chiamate sincrone)")
+        for chunk_id in analysis_errors:
+            by_id[chunk_id]['analysis'] = self.analyze_chunk(by_id[chunk_id])
+        for chunk_id in embedding_errors:
+            by_id[chunk_id]['embedding'] = self.generate_embedding(by_id[chunk_id]['text'])
+        
+        return {
+            'analysis_requests': len(analysis_requests),
+            'embedding_requests': len(embedding_requests),
+            'analysis_retried': len(analysis_errors),
+            'embedding_retried': len(embedding_errors)
+        }
+    
+    def _pack_embedding_batches(self, texts: List[str]) -> Tuple[List[str], List[List[int]]]:
+        """Tronca i testi al limite di token e li raggruppa in batch (liste di indici)"""
+        max_input = CONFIG['openai']['embedding_max_input_tokens']
+        max_items = CONFIG['processing']['embedding_batch_max_items']
+        max_tokens = CONFIG['processing']['embedding_batch_max_tokens']
+        
+        inputs = []
+        batches = []
+        current, current_tokens = [], 0
+        
+        for i, tokens in enumerate(self.encoding.encode_batch(texts, disallowed_special=())):
+            # Un input troppo lungo viene troncato invece di far fallire il batch
+            if len(tokens) > max_input:
+                tokens = tokens[:max_input]
+                inputs.append(self.encoding.decode(tokens))
+            else:
+                inputs.append(texts[i] or " ")
+            
+            if current and (len(current) >= max_items or current_tokens + len(tokens) > max_tokens):
+                batches.append(current)
+                current, current_tokens = [], 0
+            current.append(i)
+            current_tokens += len(tokens)
+        
+        if current:
+            batches.append(current)
+        return inputs, batches
+    
+    @staticmethod
+    def _transient_error(error: Exception) -> bool:
+        """Rate limit, errori del server e di rete: si ritenta lo stesso batch"""
+        if isinstance(error, (openai.RateLimitError, openai.APIConnectionError)):
+            return True
+        return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+    
+    def _embed_batch(self, inputs: List[str], indices: List[int], results: List[Optional[List[float]]]):
+        """Invia un batch; gli errori transitori si ritentano con backoff, solo un 400 lo divide a metà
+        per isolare l'input problematico (dividere sotto rate limit moltiplicherebbe le richieste)"""
+        max_retries = CONFIG['processing']['embedding_max_retries']
+        for attempt in range(max_retries + 1):
+            try:
+                response = self.client.embeddings.create(
+                    model=CONFIG['openai']['embedding_model'],
+                    input=[inputs[i] for i in indices]
+                )
+                self.usage.record_response('embedding', response, CONFIG['openai']['embedding_model'])
+                # data[].index è la posizione nell'input della richiesta
+                for item in response.data:
+                    results[indices[item.index]] = item.embedding
+                return
+            except openai.BadRequestError as e:
+                if len(indices) == 1:
+                    print(f"  ⚠️ Input rifiutato dall'API embedding (input {indices[0]}): {e}")
+                    return
+                middle = len(indices) // 2
+                self._embed_batch(inputs, indices[:middle], results)
+                self._embed_batch(inputs, indices[middle:], results)
+                return
+            except Exception as e:
+                if not self._transient_error(e) or attempt == max_retries:
+                    print(f"  ⚠️ Errore embedding, batch di {len(indices)} input non riuscito "
+                          f"dopo {attempt + 1} tentativi: {e}")
+                    return
+                delay = CONFIG['processing']['embedding_backoff_seconds'] * (2 ** attempt)
+                time.sleep(delay + random.uniform(0, delay))
+    
+    def generate_embeddings_batch(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """Genera gli embedding di molti testi con poche richieste (None per gli input falliti)"""
+        results = [None] * len(texts)
+        
+        # Solo i testi non in cache vanno all'API
+        keys = [self._embedding_key(text) for text in texts]
+        missing = []
+        for i, key in enumerate(keys):
+            results[i] = self._cache_get('embedding', key)
+            if results[i] is None:
+                missing.append(i)
+        
+        if missing:
+            inputs, batches = self._pack_embedding_batches([texts[i] for i in missing])
+            fresh = [None] * len(missing)
+            
+            for n, indices in enumerate(batches):
+                print(f"\r  Batch embedding {n+1}/{len(batches)} ({len(indices)} testi)...", end='')
+                self._embed_batch(inputs, indices, fresh)
+            print()
+            
+            for i, embedding in zip(missing, fresh):
+                results[i] = embedding
+                self._cache_put('embedding', keys[i], embedding, CONFIG['openai']['embedding_model'])
+        
+        return results
 
 class VectorIndexer:
-    """Gestisce l'indicizzazione in Pinecone"""
+    """Gestisce l'indicizzazione in Pinecone o nell'indice locale"""
     
-    def __init__(self):
-        self.pc = Pinecone(api_key=CONFIG['pinecone']['api_key'])
+    def __init__(self, metrics: PipelineMetrics):
+        self.backend = CONFIG['pinecone'].get('backend', 'pinecone')
         self.index_name = CONFIG['pinecone']['index_name']
         self.index = None
+        self.failed_ids = []
+        self.sparse = {}
+        # L'indice locale è solo dense: la ricerca lessicale locale usa l'indice BM25
+        self.sparse_encoder = None
+        if CONFIG['pinecone']['sparse_vectors'] and self.backend != 'local':
+            self.sparse_encoder = SparseEncoder(CONFIG['paths']['sparse_vocabulary'])
+        if self.backend == 'local':
+            # Il manifest sta dentro l'indice locale: non si mescola con lo stato di Pinecone
+            self.pc = None
+            self.manifest = IndexManifest(os.path.join(CONFIG['paths']['local_index'], 'manifest.json'), self.index_name)
+        else:
+            options = {'api_key': CONFIG['pinecone']['api_key']}
+            if CONFIG['pinecone'].get('controller_host'):
+                options['host'] = CONFIG['pinecone']['controller_host']
+            self.pc = Pinecone(**options)
+            self.manifest = IndexManifest(CONFIG['paths']['index_manifest'], self.index_name)
         self._setup_index()
+        self.upsert_engine = UpsertEngine(
+            self.index,
+            max_batch_bytes=CONFIG['processing']['upsert_max_batch_bytes'],
+            max_batch_records=CONFIG['processing']['upsert_max_batch_records'],
+            concurrency=CONFIG['processing']['upsert_concurrency'],
+            max_retries=CONFIG['processing']['upsert_max_retries'],
+            metrics=metrics,
+            service=self.backend
+        )
     
     def _setup_index(self):
         """Crea o connette all'indice Pinecone"""
+        if self.backend == 'local':
+            self.index = LocalVectorIndex.load(
+                CONFIG['paths']['local_index'],
+                CONFIG['pinecone']['dimension'],
+                nlist=CONFIG['pinecone']['local_ivf_lists']
+            )
+            print(f"✅ Indice locale: {CONFIG['paths']['local_index']} ({self.index.count} vettori esistenti)\n")
+            return
+        
         print("🔗 Configurazione Pinecone...")
         
+        # Host esplicito: connessione diretta al data-plane (la metrica va comunque verificata)
+        if CONFIG['pinecone'].get('host'):
+            self.index = self.pc.Index(self.index_name, host=CONFIG['pinecone']['host'])
+            self._check_sparse_metric()
+            print(f"✅ Indice connesso: {CONFIG['pinecone']['host']}\n")
+            return
+        
         # Lista indici esistenti
         existing_indexes = [idx.name for idx in self.pc.list_indexes()]
         
@@ -216,7 +701,8 @@ class VectorIndexer:
             self.pc.create_index(
                 name=self.index_name,
                 dimension=CONFIG['pinecone']['dimension'],
-                metric='cosine',
+                # I vettori sparse si combinano solo con dotproduct (embedding OpenAI normalizzati: = coseno)
+                metric='dotproduct' if self.sparse_encoder else 'cosine',
                 spec={
                     'serverless': {
                         'cloud': 'aws',
@@ -228,52 +714,159 @@ class VectorIndexer:
             time.sleep(30)
         
         self.index = self.pc.Index(self.index_name)
+        self._check_sparse_metric()
         stats = self.index.describe_index_stats()
         print(f"✅ Indice pronto: {stats['total_vector_count']} vettori esistenti\n")
     
+    def _check_sparse_metric(self):
+        """Disabilita i vettori sparse se l'indice non usa dotproduct (Pinecone rifiuterebbe ogni upsert)"""
+        if not self.sparse_encoder:
+            return
+        metric = CONFIG['pinecone'].get('metric')
+        if not metric:
+            try:
+                metric = self.pc.describe_index(self.index_name).metric
+            except Exception as e:
+                print(f"  ⚠️ Metrica dell'indice non verificabile ({e}): vettori sparse disabilitati "
+                      f"(imposta PINECONE_METRIC=dotproduct se l'indice la usa)")
+                self.sparse_encoder = None
+                return
+        if metric != 'dotproduct':
+            print(f"  ⚠️ L'indice usa la metrica {metric}: i vettori sparse richiedono dotproduct "
+                  f"(crea un nuovo indice), disabilitati")
+            self.sparse_encoder = None
+    
+    def _build_vector(self, chunk: Dict) -> Dict:
+        """Vettore Pinecone di un chunk con metadata"""
+        vector = {
+            'id': chunk['id'],
+            'values': chunk['embedding'],
+            'metadata': {
+                'text': chunk['text'][:500],  # Limita per metadata
+                'topic': chunk.get('analysis', {}).get('topic', 'Unknown'),
+                'concepts': ', '.join(chunk.get('analysis', {}).get('concepts', [])),
+                'importance': chunk.get('analysis', {}).get('importance', 5),
+                'chunk_index': chunk['chunk_index']
+            }
+        }
+        if chunk.get('document'):
+            vector['metadata']['document'] = chunk['document']
+        
+        sparse = self.sparse.get(chunk['id'])
+        if sparse and sparse['indices']:
+            vector['sparse_values'] = sparse
+        return vector
+    
+    def _encode_sparse(self, chunks: List[Dict]):
+        """Vettori sparse BM25 dei chunks con embedding; il vocabolario resta stabile tra le esecuzioni"""
+        if not self.sparse_encoder:
+            return
+        embedded = [chunk for chunk in chunks if chunk.get('embedding')]
+        # Le statistiche dei chunks si fondono con quelle salvate: IDF coerente anche in esecuzioni parziali
+        vectors = self.sparse_encoder.encode_documents([chunk['text'] for chunk in embedded],
+                                                       ids=[chunk['id'] for chunk in embedded])
+        self.sparse = {chunk['id']: vector for chunk, vector in zip(embedded, vectors)}
+        self.sparse_encoder.save()
+        print(f"  🔤 Vettori sparse: {len(self.sparse)} chunks, vocabolario di {len(self.sparse_encoder.vocabulary)} termini")
+    
     def index_chunks(self, chunks: List[Dict]) -> int:
         """Indicizza i chunks in Pinecone"""
-        print("🚀 Indicizzazione in Pinecone...")
+        print(f"🚀 Indicizzazione in {self.target}...")
+        self._encode_sparse(chunks)
         
-        indexed = 0
-        batch_size = CONFIG['processing']['batch_size']
+        vectors = [self._build_vector(chunk) for chunk in chunks if chunk.get('embedding')]
         
-        for i in range(0, len(chunks), batch_size):
-            batch = chunks[i:i + batch_size]
-            vectors = []
-            
-            for chunk in batch:
-                if chunk.get('embedding'):
-                    vectors.append({
-                        'id': chunk['id'],
-                        'values': chunk['embedding'],
-                        'metadata': {
-                            'text': chunk['text'][:500],  # Limita per metadata
-                            'topic': chunk.get('analysis', {}).get('topic', 'Unknown'),
-                            'concepts': ', '.join(chunk.get('analysis', {}).get('concepts', [])),
-                            'importance': chunk.get('analysis', {}).get('importance', 5),
-                            'chunk_index': chunk['chunk_index']
-                        }
-                    })
-            
-            if vectors:
-                try:
-                    self.index.upsert(vectors)
-                    indexed += len(vectors)
-                    print(f"  ✓ Indicizzati {indexed} chunks")
-                except Exception as e:
-                    print(f"  ❌ Errore batch: {e}")
+        result = self.upsert_engine.upsert(vectors)
+        self.failed_ids = result.failed_ids
+        
+        failed = set(result.failed)
+        self.manifest.record(v for v in vectors if v['id'] not in failed)
+        self.manifest.save()
+        self._persist()
+        
+        if self.failed_ids:
+            print(f"  ❌ {len(self.failed_ids)} vettori non indicizzati dopo {result.retries} retry: {', '.join(self.failed_ids[:20])}")
+        
+        print(f"✅ Indicizzazione completata: {result.upserted} vettori in {result.batches} batch\n")
+        return result.upserted
+
+    @property
+    def target(self) -> str:
+        return "l'indice locale" if self.backend == 'local' else "Pinecone"
+    
+    def _persist(self):
+        """L'indice locale vive in memoria: lo scrive su disco dopo ogni indicizzazione"""
+        if self.backend == 'local':
+            self.index.save()
+    
+    def _list_index_ids(self) -> List[str]:
+        """ID attualmente nell'indice (solo indici serverless supportano list)"""
+        try:
+            ids = []
+            for page in self.index.list():
+                # Secondo la versione dell'SDK le pagine contengono ID o oggetti con attributo id
+                ids.extend(getattr(item, 'id', item) for item in page)
+            return ids
+        except Exception as e:
+            print(f"  ⚠️ Impossibile elencare gli ID dell'indice ({e}): i vettori obsoleti non verranno rilevati")
+            return []
+    
+    def sync_chunks(self, chunks: List[Dict], allow_delete: bool = True) -> int:
+        """Sincronizza l'indice con i chunks: scrive solo ciò che è cambiato ed elimina i vettori spariti"""
+        print(f"🔄 Sincronizzazione incrementale con {self.target}...")
+        self._encode_sparse(chunks)
+        
+        vectors = [self._build_vector(chunk) for chunk in chunks if chunk.get('embedding')]
+        
+        # Primo sync: registra gli ID già presenti per poter eliminare quelli obsoleti
+        if not self.manifest.exists:
+            self.manifest.bootstrap(self._list_index_ids())
+        
+        # I chunks senza embedding (chiamata fallita) conservano il vettore già indicizzato
+        diff = self.manifest.diff(vectors, present_ids=[chunk['id'] for chunk in chunks])
+        if not allow_delete:
+            diff.deletes = []
+        print(f"  📋 Nuovi/modificati: {len(diff.upserts)} • Solo metadata: {len(diff.metadata_updates)} "
+              f"• Da eliminare: {len(diff.deletes)} • Invariati: {diff.unchanged}")
+        
+        upserted = self.upsert_engine.upsert(diff.upserts)
+        updated = self.upsert_engine.update_metadata(diff.metadata_updates)
+        deleted = self.upsert_engine.delete(diff.deletes)
         
-        print(f"✅ Indicizzazione completata: {indexed} vettori\n")
+        # Il manifest registra solo le operazioni riuscite: le altre verranno ritentate
+        failed = set(upserted.failed) | set(updated.failed)
+        self.manifest.record(v for v in diff.upserts + diff.metadata_updates if v['id'] not in failed)
+        removed = [vector_id for vector_id in diff.deletes if vector_id not in deleted.failed]
+        self.manifest.forget(removed)
+        self.manifest.save()
+        if self.sparse_encoder and removed:
+            self.sparse_encoder.forget(removed)
+            self.sparse_encoder.save()
+        self._persist()
+        
+        self.failed_ids = sorted(failed | set(deleted.failed))
+        if self.failed_ids:
+            print(f"  ❌ {len(self.failed_ids)} operazioni fallite: {', '.join(self.failed_ids[:20])}")
+        
+        indexed = diff.unchanged + upserted.upserted + updated.upserted
+        print(f"✅ Sincronizzazione completata: {indexed} vettori allineati, {deleted.upserted} eliminati\n")
         return indexed
 
 class PreprocessingPipeline:
     """Pipeline completa di preprocessing"""
     
-    def __init__(self):
-        self.pdf_processor = PDFProcessor()
-        self.semantic_analyzer = SemanticAnalyzer()
-        self.vector_indexer = VectorIndexer()
+    def __init__(self, resume: bool = False, corpus: Optional[str] = None):
+        self.metrics = PipelineMetrics('text')
+        self.semantic_analyzer = SemanticAnalyzer(self.metrics)
+        # Il chunking usa lo stesso encoder tiktoken dell'analisi
+        self.pdf_processor = PDFProcessor(self.semantic_analyzer.tokens)
+        self.vector_indexer = VectorIndexer(self.metrics)
+        self.resume = resume
+        self.checkpoint = None
+        self.deduplicator = None
+        self.batch_stats = None
+        self.corpus = corpus
+        self.documents = None
         
     def run(self):
         """Esegue il preprocessing completo"""
@@ -282,59 +875,319 @@ class PreprocessingPipeline:
         print("╚════════════════════════════════════════╝\n")
         
         start_time = time.time()
+        metrics = self.metrics
+        metrics.start_snapshots(CONFIG['paths']['metrics_json'], CONFIG['paths']['metrics_prometheus'],
+                                CONFIG['processing'].get('metrics_snapshot_seconds', 0))
         
         try:
-            # 1. Estrai PDF
-            pdf_text = self.pdf_processor.extract_pdf(CONFIG['paths']['pdf_source'])
-            
-            # 2. Crea chunks
-            chunks = self.pdf_processor.create_chunks(pdf_text)
-            
-            # Limita chunks per test
+            # In modalità corpus l'estrazione è parallela per documento, non in streaming
+            streaming = CONFIG['processing'].get('streaming', False) and not self.corpus
             max_chunks = CONFIG['processing'].get('max_chunks_to_process')
-            if max_chunks and len(chunks) > max_chunks:
-                print(f"⚠️ Limitato a {max_chunks} chunks per test\n")
-                chunks = chunks[:max_chunks]
-            
-            # 3. Analisi semantica e embeddings
-            print("🧠 Analisi semantica con OpenAI...")
-            analyzed_chunks = []
+            self.checkpoint = PipelineCheckpoint(
+                CONFIG['paths']['checkpoint_dir'], self._run_signature(), resume=self.resume
+            )
             
-            for i, chunk in enumerate(chunks):
-                print(f"\r  Analisi chunk {i+1}/{len(chunks)}...", end='')
-                
-                # Analisi semantica
-                analysis = self.semantic_analyzer.analyze_chunk(chunk)
-                chunk['analysis'] = analysis
+            if streaming:
+                # 1-2. Estrazione e chunking in streaming (memoria limitata a poche pagine)
+                print("🌊 Modalità streaming: estrazione e chunking procedono insieme\n")
+                # Il tempo di ogni fase è quello speso a produrre i suoi elementi
+                pages = metrics.timed_iter('extraction', self.pdf_processor.iter_pages(CONFIG['paths']['pdf_source']))
+                chunks = metrics.timed_iter('chunking', self.pdf_processor.iter_chunks(pages))
+                if max_chunks:
+                    chunks = islice(chunks, max_chunks)
+            elif self.corpus:
+                # 1-2. Estrazione e chunking dei documenti in parallelo su tutti i core
+                with metrics.stage('extraction'):
+                    chunks = self._extract_corpus(self.corpus)
                 
-                # Genera embedding
-                embedding = self.semantic_analyzer.generate_embedding(chunk['text'])
-                chunk['embedding'] = embedding
+                if max_chunks and len(chunks) > max_chunks:
+                    print(f"⚠️ Limitato a {max_chunks} chunks per test\n")
+                    chunks = chunks[:max_chunks]
+            else:
+                # 1. Estrai PDF
+                with metrics.stage('extraction'):
+                    pdf_text = self.pdf_processor.extract_pdf(CONFIG['paths']['pdf_source'])
                 
-                analyzed_chunks.append(chunk)
+                # 2. Crea chunks
+                with metrics.stage('chunking'):
+                    chunks = self.pdf_processor.create_chunks(pdf_text)
                 
-                # Pausa per evitare rate limiting
-                if (i + 1) % 10 == 0:
-                    time.sleep(1)
+                # Limita chunks per test
+                if max_chunks and len(chunks) > max_chunks:
+                    print(f"⚠️ Limitato a {max_chunks} chunks per test\n")
+                    chunks = chunks[:max_chunks]
             
-            print(f"\n✅ Analizzati {len(analyzed_chunks)} chunks\n")
+            # Quasi duplicati: solo un rappresentante per gruppo va alle API
+            if CONFIG['processing'].get('dedup'):
+                self.deduplicator = NearDuplicateDetector(CONFIG['processing']['dedup_threshold'])
+                chunks = metrics.timed_iter('dedup', self.deduplicator.filter(chunks))
+                if not streaming:
+                    chunks = list(chunks)
+                    self._print_dedup()
+            
+            # 3. Analisi semantica e embeddings (i chunks nel journal non si rianalizzano)
+            print("🧠 Analisi semantica con OpenAI...")
+            order = []
+            restored = dict(self.checkpoint.chunks)
+            pending = self._pending_chunks(chunks, restored, order)
+            batch_embeddings = CONFIG['processing'].get('batch_embeddings', False)
+            with metrics.stage('analysis'):
+                if CONFIG['processing'].get('batch_api'):
+                    fresh = self._analyze_chunks_batch_api(pending)
+                elif CONFIG['processing'].get('async_analysis'):
+                    fresh = asyncio.run(self._analyze_chunks_async(pending, embed=not batch_embeddings))
+                else:
+                    total = '?' if streaming else len(chunks) - sum(1 for c in chunks if c['id'] in restored)
+                    fresh = self._analyze_chunks(pending, total, embed=not batch_embeddings)
+            
+            by_id = {chunk['id']: chunk for chunk in fresh}
+            analyzed_chunks = [by_id.get(chunk_id) or restored[chunk_id] for chunk_id in order]
+            self.checkpoint.mark_done('analysis', chunks=len(analyzed_chunks))
+            
+            print(f"\n✅ Analizzati {len(fresh)} chunks ({len(analyzed_chunks) - len(fresh)} dal checkpoint)\n")
+            if self.deduplicator and streaming:
+                self._print_dedup()
+            
+            if batch_embeddings:
+                with metrics.stage('embedding'):
+                    self._embed_chunks_batched(analyzed_chunks)
+                self.checkpoint.mark_done('embedding')
             
             # 4. Indicizza in Pinecone
-            indexed = self.vector_indexer.index_chunks(analyzed_chunks)
+            if self.checkpoint.is_done('indexing'):
+                indexed = self.checkpoint.stage_info('indexing')['indexed']
+                print(f"♻️ Indicizzazione già completata: {indexed} vettori\n")
+            else:
+                with metrics.stage('upsert'):
+                    if CONFIG['processing'].get('incremental_index'):
+                        # Con un limite di chunks l'insieme è parziale: non eliminare il resto dell'indice
+                        # Anche un documento del corpus non estratto rende l'insieme parziale
+                        partial = max_chunks or (self.documents is not None and self.pdf_processor.metadata['failed'])
+                        indexed = self.vector_indexer.sync_chunks(analyzed_chunks, allow_delete=not partial)
+                    else:
+                        indexed = self.vector_indexer.index_chunks(analyzed_chunks)
+                self.checkpoint.mark_done('indexing', indexed=indexed)
             
             # 5. Salva dati locali
-            self._save_data(analyzed_chunks, indexed)
+            all_chunks = self.deduplicator.link(analyzed_chunks) if self.deduplicator else analyzed_chunks
+            with metrics.stage('save'):
+                self._save_data(all_chunks, indexed)
+            self.checkpoint.mark_done('save')
             
             # Report finale
             elapsed = time.time() - start_time
-            self._print_report(len(chunks), indexed, elapsed)
+            self._print_report(len(all_chunks), indexed, elapsed)
             
         except Exception as e:
             print(f"\n❌ ERRORE: {e}")
             print("\nVerifica:")
             print("1. Le API keys in .env.local")
-            print("2. Il file corso_completo.pdf in data\\source\\")
+            print(f"2. Il file PDF {CONFIG['paths']['pdf_source']}")
             print("3. La connessione internet")
+            if self.checkpoint:
+                print("\n♻️ Il lavoro completato è nel checkpoint: rilancia con --resume per riprendere")
+        finally:
+            if self.checkpoint:
+                self.checkpoint.close()
+            # Anche un'esecuzione fallita lascia le metriche di ciò che è stato fatto
+            metrics.stop_snapshots()
+            metrics.write(CONFIG['paths']['metrics_json'], CONFIG['paths']['metrics_prometheus'])
+    
+    def _run_signature(self) -> Dict:
+        """Identifica l'esecuzione: il checkpoint vale solo per lo stesso PDF e la stessa configurazione"""
+        return {
+            'pdf': self._source_hash(),
+            'chunk_size': CONFIG['processing']['chunk_size'],
+            'chunk_overlap': CONFIG['processing']['chunk_overlap'],
+            'extractor': CONFIG['processing']['extractor'],
+            'chunk_unit': CONFIG['processing']['chunk_unit'],
+            'chunk_tokens': CONFIG['processing']['chunk_tokens'],
+            'chunk_overlap_tokens': CONFIG['processing']['chunk_overlap_tokens'],
+            'max_chunks': CONFIG['processing'].get('max_chunks_to_process'),
+            'dedup': CONFIG['processing'].get('dedup') and CONFIG['processing']['dedup_threshold'],
+            'prompt_version': CONFIG['cache']['prompt_version']
+        }
+    
+    def _source_hash(self) -> str:
+        """Hash del PDF sorgente o, in modalità corpus, di tutti i documenti con i loro ID"""
+        if not self.corpus:
+            return pdf_content_hash(CONFIG['paths']['pdf_source'])
+        digest = hashlib.sha256()
+        for document in discover_documents(self.corpus):
+            digest.update(f"{document['id']}={pdf_content_hash(document['path'])}\n".encode('utf-8'))
+        return digest.hexdigest()
+    
+    def _extract_corpus(self, source: str) -> List[Dict]:
+        """Estrae e divide in chunks tutti i documenti con un pool di processi.
+        
+        I documenti più grandi partono per primi, così il tempo totale dipende dal
+        numero di core e non da un PDF lungo rimasto in coda; i chunks tornano
+        nell'ordine del corpus.
+        """
+        documents = discover_documents(source)
+        workers = min(CONFIG['processing'].get('corpus_workers') or os.cpu_count() or 1, len(documents))
+        print(f"📚 Corpus: {len(documents)} documenti su {workers} processi")
+        
+        results = {}
+        failed = []
+        queue = sorted(documents, key=lambda doc: os.path.getsize(doc['path']), reverse=True)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_corpus_worker,
+                                 initargs=(CONFIG['processing'], CONFIG['openai']['model'])) as pool:
+            futures = {pool.submit(extract_document, document): document for document in queue}
+            for future in as_completed(futures):
+                document = futures[future]
+                try:
+                    results[document['id']] = future.result()
+                except Exception as e:
+                    print(f"  ⚠️ {document['path']}: {e}")
+                    failed.append(document['id'])
+                    continue
+                print(f"  ✓ {document['id']}: {len(results[document['id']]['chunks'])} chunks "
+                      f"({len(results) + len(failed)}/{len(documents)})")
+        
+        self.documents = [{'id': doc['id'], 'path': doc['path'], 'pages': results[doc['id']]['pages'],
+                           'chunks': len(results[doc['id']]['chunks']), 'info': results[doc['id']]['info']}
+                          for doc in documents if doc['id'] in results]
+        self.pdf_processor.metadata = {
+            'documents': len(self.documents),
+            'total_pages': sum(doc['pages'] for doc in self.documents),
+            'failed': failed
+        }
+        
+        chunks = [chunk for doc in documents if doc['id'] in results for chunk in results[doc['id']]['chunks']]
+        print(f"✅ Creati {len(chunks)} chunks da {len(self.documents)} documenti\n")
+        return chunks
+    
+    def _dedup_stats(self) -> Optional[Dict]:
+        """Gruppi di quasi duplicati e chiamate API evitate (un'analisi e un embedding per duplicato)"""
+        if not self.deduplicator:
+            return None
+        stats = self.deduplicator.stats()
+        stats['api_calls_avoided'] = {'analysis': stats['duplicates'], 'embedding': stats['duplicates']}
+        return stats
+    
+    def _print_dedup(self):
+        stats = self._dedup_stats()
+        print(f"🔁 Quasi duplicati: {stats['duplicates']} chunks collegati a {stats['clusters']} rappresentanti "
+              f"({2 * stats['duplicates']} chiamate API evitate)\n")
+    
+    @staticmethod
+    def _pending_chunks(chunks: Iterable[Dict], restored: Dict[str, Dict], order: List[str]) -> Iterator[Dict]:
+        """Registra l'ordine di tutti i chunks e passa avanti solo quelli non ancora nel journal"""
+        for chunk in chunks:
+            order.append(chunk['id'])
+            if chunk['id'] not in restored:
+                yield chunk
+    
+    def _journal_chunk(self, chunk: Dict, embed: bool):
+        """Registra nel journal solo il lavoro riuscito: con --resume i fallback si rifanno.
+        
+        Restano fuori le analisi di default e gli embedding falliti, a meno che non li
+        recuperi lo stage di embedding batch.
+        """
+        if chunk['id'] in self.semantic_analyzer.fallback_ids:
+            return
+        if embed and chunk.get('embedding') is None:
+            return
+        self.checkpoint.append_chunk(chunk)
+    
+    def _analyze_chunks(self, chunks: Iterable[Dict], total, embed: bool = True) -> List[Dict]:
+        """Analisi ed embedding sequenziali, un chunk alla volta"""
+        analyzed_chunks = []
+        
+        for i, chunk in enumerate(chunks):
+            print(f"\r  Analisi chunk {i+1}/{total}...", end='')
+            
+            # Analisi semantica
+            analysis = self.semantic_analyzer.analyze_chunk(chunk)
+            chunk['analysis'] = analysis
+            
+            # Genera embedding (altrimenti in batch dopo l'analisi)
+            if embed:
+                embedding = self.semantic_analyzer.generate_embedding(chunk['text'])
+                chunk['embedding'] = embedding
+            
+            analyzed_chunks.append(chunk)
+            self._journal_chunk(chunk, embed)
+            
+            # Pausa per evitare rate limiting
+            if (i + 1) % 10 == 0:
+                time.sleep(1)
+        
+        return analyzed_chunks
+    
+    async def _analyze_chunks_async(self, chunks: Iterable[Dict], embed: bool = True) -> List[Dict]:
+        """Analisi ed embedding concorrenti con al massimo N richieste in volo.
+        
+        L'ordine dell'output è quello dei chunks in ingresso; il prelievo dai
+        chunks (anche un generatore in streaming) è limitato da una finestra,
+        così l'estrazione procede insieme alle richieste di rete.
+        """
+        concurrency = CONFIG['processing']['concurrency']
+        analyzer = self.semantic_analyzer
+        requests = asyncio.Semaphore(concurrency)
+        window = asyncio.Semaphore(concurrency * 2)
+        completed = 0
+        
+        async def process(chunk: Dict) -> Dict:
+            nonlocal completed
+            try:
+                async with requests:
+                    chunk['analysis'] = await analyzer.analyze_chunk_async(chunk)
+                if embed:
+                    async with requests:
+                        chunk['embedding'] = await analyzer.generate_embedding_async(chunk['text'])
+                self._journal_chunk(chunk, embed)
+                completed += 1
+                self.metrics.set_gauge('analysis_window', len(tasks) - completed)
+                print(f"\r  Analizzati {completed} chunks ({concurrency} richieste in parallelo)...", end='')
+                return chunk
+            finally:
+                window.release()
+        
+        tasks = []
+        analyzer.open_async_client()
+        try:
+            for chunk in chunks:
+                await window.acquire()
+                tasks.append(asyncio.create_task(process(chunk)))
+                # Chunks prelevati e non ancora completati (al massimo 2 * concurrency)
+                self.metrics.set_gauge('analysis_window', len(tasks) - completed)
+            return list(await asyncio.gather(*tasks))
+        finally:
+            # Input fallito, errore o interruzione: le richieste ancora in volo non devono proseguire
+            pending = [task for task in tasks if not task.done()]
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            await analyzer.async_client.close()
+    
+    def _analyze_chunks_batch_api(self, chunks: Iterable[Dict]) -> List[Dict]:
+        """Analisi ed embedding differiti con la Batch API: raccoglie tutti i chunks e attende i risultati"""
+        chunks = list(chunks)
+        if chunks:
+            self.batch_stats = self.semantic_analyzer.analyze_chunks_batch_api(chunks)
+        embed = not CONFIG['processing'].get('batch_embeddings', False)
+        for chunk in chunks:
+            self._journal_chunk(chunk, embed)
+        return chunks
+    
+    def _embed_chunks_batched(self, chunks: List[Dict]):
+        """Embedding con richieste batch dei chunks che ancora non ne hanno uno"""
+        missing = [chunk for chunk in chunks if not chunk.get('embedding')]
+        if not missing:
+            print("♻️ Embedding già presenti per tutti i chunks\n")
+            return
+        
+        print(f"🔢 Embedding batch di {len(missing)} chunks...")
+        embeddings = self.semantic_analyzer.generate_embeddings_batch([c['text'] for c in missing])
+        for chunk, embedding in zip(missing, embeddings):
+            chunk['embedding'] = embedding
+            if embedding is not None:
+                self.checkpoint.append_embedding(chunk['id'], embedding)
+        
+        done = sum(1 for e in embeddings if e is not None)
+        print(f"✅ Embedding generati: {done}/{len(missing)}\n")
     
     def _save_data(self, chunks: List[Dict], indexed: int):
         """Salva i dati processati"""
@@ -344,11 +1197,11 @@ class PreprocessingPipeline:
         output_dir = Path(CONFIG['paths']['output_dir'])
         output_dir.mkdir(parents=True, exist_ok=True)
         
-        # Rimuovi embeddings per salvare spazio
+        # Gli embedding vanno nell'archivio binario, non nel JSON
         chunks_to_save = []
         for chunk in chunks:
             chunk_copy = chunk.copy()
-            chunk_copy.pop('embedding', None)  # Rimuovi embedding
+            chunk_copy.pop('embedding', None)
             chunks_to_save.append(chunk_copy)
         
         # Salva chunks
@@ -357,18 +1210,37 @@ class PreprocessingPipeline:
             json.dump(chunks_to_save, f, ensure_ascii=False, indent=2)
         print(f"  ✓ Chunks salvati: {chunks_file}")
         
+        embeddings = self._save_embeddings(chunks)
+        
+        # Indice lessicale BM25 per le ricerche per parola chiave esatta
+        bm25 = BM25Index.build((chunk['id'], chunk['text']) for chunk in chunks if 'duplicate_of' not in chunk)
+        bm25.save(CONFIG['paths']['bm25_index'])
+        print(f"  ✓ Indice BM25 salvato: {CONFIG['paths']['bm25_index']} ({len(bm25.terms)} termini)")
+        
         # Salva metadata
         metadata = {
             'version': '4.0',
             'created_at': time.strftime('%Y-%m-%d %H:%M:%S'),
             'pdf_metadata': self.pdf_processor.metadata,
+            'documents': self.documents,
             'processing': {
                 'total_chunks': len(chunks),
                 'indexed_vectors': indexed,
+                'failed_vector_ids': self.vector_indexer.failed_ids,
+                'sparse_vectors': bool(self.vector_indexer.sparse_encoder),
+                'chunk_unit': CONFIG['processing']['chunk_unit'],
                 'chunk_size': CONFIG['processing']['chunk_size'],
+                'chunk_tokens': CONFIG['processing']['chunk_tokens'],
+                'total_tokens': sum(c.get('token_count', 0) for c in chunks),
                 'model': CONFIG['openai']['model'],
                 'embedding_model': CONFIG['openai']['embedding_model']
             },
+            'deduplication': self._dedup_stats(),
+            'batch_api': self.batch_stats,
+            'embeddings': embeddings,
+            'bm25': bm25.stats(),
+            'cache': self.semantic_analyzer.cache.stats() if self.semantic_analyzer.cache else None,
+            'usage': self.semantic_analyzer.usage.to_dict(),
             'topics': list(set(c.get('analysis', {}).get('topic', '') 
                              for c in chunks if c.get('analysis', {}).get('topic')))
         }
@@ -378,6 +1250,31 @@ class PreprocessingPipeline:
             json.dump(metadata, f, ensure_ascii=False, indent=2)
         print(f"  ✓ Metadata salvato: {metadata_file}\n")
     
+    def _save_embeddings(self, chunks: List[Dict]) -> Optional[Dict]:
+        """Salva gli embedding nell'archivio memory-mapped, allineati agli ID dei chunks"""
+        embedded = [chunk for chunk in chunks if chunk.get('embedding')]
+        if not embedded:
+            return None
+        
+        path = CONFIG['paths']['embedding_store']
+        options = (CONFIG['pinecone']['dimension'], CONFIG['processing']['embedding_dtype'],
+                   CONFIG['openai']['embedding_model'])
+        try:
+            store = EmbeddingStore(path, *options)
+        except ValueError as e:
+            # Modello, dimensione o precisione cambiati: i vecchi vettori non sono confrontabili
+            print(f"  ⚠️ {e}: archivio ricreato")
+            shutil.rmtree(path, ignore_errors=True)
+            store = EmbeddingStore(path, *options)
+        
+        added = store.upsert([chunk['id'] for chunk in embedded], [chunk['embedding'] for chunk in embedded])
+        if not CONFIG['processing'].get('max_chunks_to_process'):
+            # Insieme completo: via le righe dei chunks che non esistono più
+            store.compact([chunk['id'] for chunk in chunks])
+        
+        print(f"  ✓ Embedding salvati: {path} ({len(store)} vettori {store.dtype}, {added} nuovi)")
+        return store.stats()
+    
     def _print_report(self, total_chunks: int, indexed: int, elapsed: float):
         """Stampa report finale"""
         print("╔════════════════════════════════════════╗")
@@ -388,21 +1285,80 @@ class PreprocessingPipeline:
         print(f"  • Vettori indicizzati: {indexed}")
         print(f"  • Tempo totale: {elapsed:.1f} secondi")
         print(f"  • Dati salvati in: {CONFIG['paths']['output_dir']}")
+        
+        cache = self.semantic_analyzer.cache
+        if cache:
+            stats = cache.stats()
+            print(f"  • Cache hit/miss: {stats['hits']}/{stats['misses']} ({stats['hit_rate']:.0%})")
+        usage = self.semantic_analyzer.usage.to_dict()
+        for stage, totals in usage['by_stage'].items():
+            print(f"  • Token {stage}: {totals['prompt_tokens']} prompt ({totals['cached_tokens']} in cache) + "
+                  f"{totals['completion_tokens']} output in {totals['calls']} chiamate → ${totals['cost_usd']:.4f}")
+        print(f"  • Costo OpenAI: ${usage['total_cost_usd']:.4f}")
+        print(f"  • Metriche: {CONFIG['paths']['metrics_json']} • {CONFIG['paths']['metrics_prometheus']}")
         print(f"\n✨ Il corso è pronto per l'analisi semantica dei quiz!")
 
-def main():
+def main(argv: List[str] = None):
     """Funzione principale"""
+    parser = argparse.ArgumentParser(description="Preprocessing v4 del corso")
+    parser.add_argument('--resume', action='store_true',
+                        help="Riprende un'esecuzione interrotta saltando il lavoro già nel checkpoint")
+    parser.add_argument('--backend', choices=['pinecone', 'local'],
+                        help="Indice di destinazione (default: VECTOR_BACKEND o pinecone)")
+    parser.add_argument('--batch-api', action='store_true',
+                        help="Analisi ed embedding con la Batch API di OpenAI (risultati entro 24h, metà costo)")
+    parser.add_argument('--corpus', help="Cartella o manifest di PDF da elaborare insieme (modalità corpus)")
+    parser.add_argument('--workers', type=int, help="Processi per estrazione e chunking del corpus")
+    parser.add_argument('--sparse', action='store_true',
+                        help="Vettori sparse BM25 insieme ai dense (l'indice deve usare la metrica dotproduct)")
+    parser.add_argument('--chunk-unit', choices=['chars', 'tokens'],
+                        help="Unità di chunk e overlap (default: processing.chunk_unit; cambiarla reindicizza tutto)")
+    parser.add_argument('--async-analysis', action='store_true',
+                        help="Analisi ed embedding concorrenti (processing.concurrency richieste in volo)")
+    parser.add_argument('--dedup', action='store_true',
+                        help="Analizza ed indicizza un solo rappresentante per gruppo di chunks quasi identici")
+    parser.add_argument('--extractor', choices=list(EXTRACTORS),
+                        help="Backend di estrazione del testo (default: processing.extractor)")
+    parser.add_argument('--metrics-interval', type=float,
+                        help="Secondi tra due snapshot delle metriche durante l'esecuzione (default: solo alla fine)")
+    args = parser.parse_args(argv)
+    if args.metrics_interval:
+        CONFIG['processing']['metrics_snapshot_seconds'] = args.metrics_interval
+    if args.extractor:
+        CONFIG['processing']['extractor'] = args.extractor
+    if args.corpus:
+        CONFIG['paths']['corpus_source'] = args.corpus
+    if args.workers:
+        CONFIG['processing']['corpus_workers'] = args.workers
+    if args.backend:
+        CONFIG['pinecone']['backend'] = args.backend
+    if args.batch_api:
+        CONFIG['processing']['batch_api'] = True
+    if args.sparse:
+        CONFIG['pinecone']['sparse_vectors'] = True
+    if args.chunk_unit:
+        CONFIG['processing']['chunk_unit'] = args.chunk_unit
+    if args.async_analysis:
+        CONFIG['processing']['async_analysis'] = True
+    if args.dedup:
+        CONFIG['processing']['dedup'] = True
+    
     # Verifica configurazione
     if not CONFIG['openai']['api_key']:
         print("❌ ERRORE: OPENAI_API_KEY mancante in .env.local")
         return
     
-    if not CONFIG['pinecone']['api_key']:
+    if not CONFIG['pinecone']['api_key'] and CONFIG['pinecone']['backend'] != 'local':
         print("❌ ERRORE: PINECONE_API_KEY mancante in .env.local")
         return
     
+    if not extractor_available(CONFIG['processing']['extractor']):
+        backend = EXTRACTORS[CONFIG['processing']['extractor']]
+        print(f"❌ ERRORE: backend di estrazione '{backend.name}' non installato (pip install {backend.package})")
+        return
+    
     # Esegui pipeline
-    pipeline = PreprocessingPipeline()
+    pipeline = PreprocessingPipeline(resume=args.resume, corpus=CONFIG['paths']['corpus_source'])
     pipeline.run()
 
 if __name__ == "__main__":
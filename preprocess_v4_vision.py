@@ -4,19 +4,44 @@
 
 import os
 import json
+import asyncio
 import time
+import random
 import base64
+import hashlib
 import io
-from typing import List, Dict, Any, Optional
+import argparse
+import shutil
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from bisect import bisect_left, bisect_right
+from typing import List, Dict, Any, Tuple, Optional, Iterable, Iterator, Callable
 from pathlib import Path
 
 # Dipendenze esterne
 from dotenv import load_dotenv
 import openai
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
 from pinecone import Pinecone
 import PyPDF2
 import tiktoken
+
+from content_cache import ContentCache
+from upsert_engine import UpsertEngine
+from page_classifier import PageVisualClassifier
+from index_manifest import IndexManifest
+from pipeline_checkpoint import PipelineCheckpoint
+from embedding_store import EmbeddingStore
+from local_vector_index import LocalVectorIndex
+from bm25_index import BM25Index
+from sparse_encoder import SparseEncoder
+from token_budget import TokenBudget
+from near_duplicates import NearDuplicateDetector
+from openai_batch import BatchRunner
+from pdf_text_extraction import TextExtractor, open_extractor, extractor_available, iter_pages, iter_pages_parallel, EXTRACTORS
+from page_image_cache import PageImageCache, IMAGE_FORMATS, pdf_content_hash
+from pipeline_metrics import PipelineMetrics, httpx_event_hooks
+from usage_ledger import UsageLedger, image_tokens, model_price
 from PIL import Image
 from pdf2image import convert_from_path
 
@@ -24,41 +49,108 @@ from pdf2image import convert_from_path
 load_dotenv('.env.local')
 
 # ============ CONFIGURAZIONE ============
+# Percorsi costruiti a partire dalla cartella dello script: validi da qualsiasi directory e sistema
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+OUTPUT_DIR = os.path.join(BASE_DIR, 'data', 'processed-v4')
+
 CONFIG = {
     'openai': {
         'api_key': os.getenv('OPENAI_API_KEY'),
+        'base_url': os.getenv('OPENAI_BASE_URL'),  # None = API ufficiale (utile per server stub locali)
         'model': 'gpt-3.5-turbo',
         'vision_model': 'gpt-4o',  # Modello Vision
         'embedding_model': 'text-embedding-3-small',
+        'embedding_max_input_tokens': 8191,  # Limite per singolo input di embedding
         'max_tokens': 500,
-        'temperature': 0.1
+        'analysis_prompt_tokens': 1200,  # Budget esatto del prompt di analisi (il testo viene accorciato)
+        'temperature': 0.1,
+        'batch_completion_window': '24h',  # Finestra di completamento della Batch API
+        'batch_poll_seconds': 30  # Intervallo di controllo dello stato dei batch
     },
     'pinecone': {
         'api_key': os.getenv('PINECONE_API_KEY'),
         'environment': os.getenv('PINECONE_ENVIRONMENT', 'us-east-1'),
         'index_name': 'quiz-course-v4-vision',
+        'host': os.getenv('PINECONE_HOST'),  # Host data-plane diretto (es. fake locale), salta creazione e lookup
+        'controller_host': os.getenv('PINECONE_CONTROLLER_HOST'),  # Host control-plane (None = API Pinecone)
+        'metric': os.getenv('PINECONE_METRIC'),  # Metrica dell'indice se describe_index non è raggiungibile
+        'backend': os.getenv('VECTOR_BACKEND', 'pinecone'),  # pinecone | local (indice NumPy su disco)
+        'local_ivf_lists': 0,  # Liste IVF dell'indice locale (0 = sempre ricerca esatta)
+        # Vettori sparse BM25 insieme ai dense (richiede metrica dotproduct): opt-in finché
+        # le query lato JS non inviano anche il vettore sparse
+        'sparse_vectors': False,
         'dimension': 1536
     },
     'vision': {
         'enable': True,  # Abilita/disabilita Vision
         'dpi': 150,  # Risoluzione conversione PDF->immagine
+        'max_size': 2000,  # Lato massimo dell'immagine inviata (pixel)
+        'image_format': 'png',  # png | jpeg | webp (jpeg/webp molto più compatti)
+        'image_quality': 85,  # Qualità per jpeg/webp
+        'cache_max_mb': 512,  # Budget della cache immagini (eviction LRU)
+        'render_workers': max(1, (os.cpu_count() or 2) - 1),  # Processi per rasterizzazione (0 = seriale)
+        'render_range_size': 8,  # Pagine contigue rasterizzate per task
         'max_pages': 300,  # Max pagine da analizzare con Vision
         'min_text_threshold': 200,  # Se meno caratteri, usa Vision
+        'selection': 'structure',  # structure = analisi struttura PDF, text = solo euristiche testuali
+        'min_visual_score': 0.35,  # Punteggio visuale minimo per la selezione strutturale
+        'min_image_area': 0.15,  # Frazione di pagina coperta da immagini considerata rilevante
         'keywords': ['figura', 'diagramma', 'tabella', 'grafico', 'algoritmo', 'schema'],
-        'cost_per_page': 0.01  # Stima costo per pagina
+        'detail': 'high',  # Dettaglio immagine per GPT-4o (fa parte della chiave di cache)
+        'max_output_tokens': 1500  # Risposta massima per pagina (limite anche della stima di costo)
     },
     'processing': {
-        'chunk_size': 1000,
+        # chars = chunk e overlap in caratteri, tokens = in token (--chunk-unit tokens). Cambiare unità
+        # cambia i chunks e i loro ID: con l'indice incrementale tutti i vettori vengono riscritti
+        'chunk_unit': 'chars',
+        'chunk_size': 1000,  # Caratteri per chunk (chunk_unit = chars)
         'chunk_overlap': 200,
+        'chunk_tokens': 300,  # Token per chunk (chunk_unit = tokens)
+        'chunk_overlap_tokens': 50,
         'max_chunks_to_process': None,  # None = processa tutto
-        'batch_size': 10
+        'upsert_concurrency': 4,  # Richieste di upsert Pinecone in parallelo
+        'upsert_max_batch_bytes': 2 * 1024 * 1024,  # Limite payload per richiesta
+        'upsert_max_batch_records': 1000,  # Limite vettori per richiesta
+        'upsert_max_retries': 5,  # Retry con backoff sugli errori transitori
+        'incremental_index': True,  # Sincronizza l'indice col manifest locale (solo vettori cambiati)
+        'streaming': False,  # True = estrazione a pagine, memoria limitata a poche pagine
+        'extractor': 'pypdf2',  # Backend di estrazione del testo: pypdf2 | pymupdf | pdfium | pdfminer
+        'extract_workers': max(1, (os.cpu_count() or 2) - 1),  # Processi per l'estrazione del testo (1 = seriale)
+        'extract_range_pages': 25,  # Pagine per intervallo assegnato a un processo
+        'async_analysis': False,  # Analisi ed embedding concorrenti con AsyncOpenAI (--async-analysis)
+        'concurrency': 8,  # Richieste OpenAI in volo contemporaneamente
+        'batch_embeddings': True,  # Più testi per ogni richiesta embeddings.create
+        'embedding_batch_max_items': 2048,  # Input massimi per richiesta
+        'embedding_batch_max_tokens': 300000,  # Token massimi per richiesta
+        'embedding_max_retries': 3,  # Retry del batch intero su 429/5xx/rete (dopo quelli dell'SDK)
+        'embedding_backoff_seconds': 2.0,  # Attesa base del backoff esponenziale
+        'embedding_dtype': 'float16',  # Precisione dell'archivio locale degli embedding (float16 | float32)
+        'batch_api': False,  # True = analisi ed embedding con la Batch API (metà costo, risultati differiti)
+        'dedup': False,  # Chunks quasi identici (MinHash/LSH): analisi ed embedding solo del rappresentante (--dedup)
+        'dedup_threshold': 0.85,  # Similarità Jaccard stimata minima per considerare due chunks duplicati
+        'metrics_snapshot_seconds': 0  # Riscrive i file delle metriche ogni N secondi durante l'esecuzione (0 = solo alla fine)
+    },
+    'cache': {
+        'enable': True,  # Cache locale di analisi ed embedding (content-addressed)
+        'max_mb': 1024,  # Oltre questa dimensione elimina le voci meno usate (LRU)
+        'prompt_version': 'v4-vision-2'  # Incrementare quando cambia il prompt di analisi
     },
     'paths': {
-        'pdf_source': r'data\source\corso_completo.pdf',
-        'output_dir': r'data\processed-v4',
-        'chunks_file': r'data\processed-v4\chunks_vision.json',
-        'metadata_file': r'data\processed-v4\metadata_vision.json',
-        'vision_cache': r'data\processed-v4\vision_cache'
+        'pdf_source': os.path.join(BASE_DIR, 'data', 'source', 'corso_completo.pdf'),
+        'output_dir': OUTPUT_DIR,
+        'chunks_file': os.path.join(OUTPUT_DIR, 'chunks_vision.json'),
+        'metadata_file': os.path.join(OUTPUT_DIR, 'metadata_vision.json'),
+        'cache_db': os.path.join(OUTPUT_DIR, 'cache.sqlite'),
+        'index_manifest': os.path.join(OUTPUT_DIR, 'index_manifest_vision.json'),
+        'checkpoint_dir': os.path.join(OUTPUT_DIR, 'checkpoint_vision'),
+        'batch_dir': os.path.join(OUTPUT_DIR, 'batch_vision'),
+        'embedding_store': os.path.join(OUTPUT_DIR, 'embeddings_vision'),
+        'local_index': os.path.join(OUTPUT_DIR, 'local_index_vision'),
+        'bm25_index': os.path.join(OUTPUT_DIR, 'bm25_vision.json'),
+        'sparse_vocabulary': os.path.join(OUTPUT_DIR, 'sparse_vocabulary_vision.json'),
+        'vision_cache': os.path.join(OUTPUT_DIR, 'vision_cache'),
+        'metrics_json': os.path.join(OUTPUT_DIR, 'metrics_vision.json'),
+        'metrics_prometheus': os.path.join(OUTPUT_DIR, 'metrics_vision.prom')
     },
     'poppler': {
         'path': r'C:\poppler\Library\bin'  # Path di Poppler per Windows
@@ -72,58 +164,110 @@ if os.name == 'nt' and CONFIG['poppler']['path']:
 class PDFProcessor:
     """Gestisce l'estrazione e il processing del PDF"""
     
-    def __init__(self):
+    def __init__(self, tokens: TokenBudget):
         self.text = ""
         self.metadata = {}
         self.pages = []
+        self.tokens = tokens
+        self.page_offsets = []  # Offset di inizio di ogni pagina in self.text
         self.vision_candidates = []
+        self.vision_report = {}  # pagina -> punteggio visuale e motivi della selezione
+        self.classifier = PageVisualClassifier(
+            min_score=CONFIG['vision']['min_visual_score'],
+            min_image_area=CONFIG['vision']['min_image_area'],
+            min_text_chars=CONFIG['vision']['min_text_threshold']
+        )
     
-    def extract_pdf(self, pdf_path: str) -> str:
-        """Estrae testo dal PDF e identifica pagine per Vision"""
+    def iter_pages(self, pdf_path: str) -> Iterator[Dict]:
+        """Estrae le pagine una alla volta (generatore) e identifica pagine per Vision"""
         print(f"📚 Estrazione PDF: {pdf_path}")
         
         if not os.path.exists(pdf_path):
             raise FileNotFoundError(f"PDF non trovato: {pdf_path}")
         
-        with open(pdf_path, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            
+        with open_extractor(CONFIG['processing']['extractor'], pdf_path) as extractor:
             self.metadata = {
-                'total_pages': len(pdf_reader.pages),
-                'info': pdf_reader.metadata if pdf_reader.metadata else {}
+                'total_pages': len(extractor),
+                'info': extractor.info(),
+                'extractor': extractor.name
             }
             
             print(f"  📄 Totale pagine: {self.metadata['total_pages']}")
             
-            # Estrai testo e identifica candidati per Vision
-            for i, page in enumerate(pdf_reader.pages):
-                page_text = page.extract_text()
+            # La selezione strutturale legge immagini e tracciati con PyPDF2, qualunque sia il backend del testo
+            structure = CONFIG['vision']['enable'] and CONFIG['vision']['selection'] == 'structure'
+            pdf_reader = PyPDF2.PdfReader(pdf_path) if structure else None
+            
+            # Estrai testo e identifica candidati per Vision (intervalli di pagine in parallelo)
+            offset = 0
+            for i, extracted in enumerate(self._extracted_pages(pdf_path, extractor)):
+                page_text = extracted['text']
+                self.page_offsets.append(offset)
+                offset += len(page_text) + 2  # + separatore "\n\n"
                 page_data = {
                     'page_num': i + 1,
                     'text': page_text,
                     'char_count': len(page_text),
-                    'needs_vision': self._should_use_vision(page_text, i + 1)
+                    'needs_vision': self._should_use_vision(page_text, i + 1,
+                                                            pdf_reader.pages[i] if pdf_reader else None)
                 }
                 
-                self.pages.append(page_data)
-                self.text += page_text + "\n\n"
-                
                 if page_data['needs_vision']:
                     self.vision_candidates.append(i + 1)
                 
                 if (i + 1) % 50 == 0:
                     print(f"  ✓ Processate {i + 1}/{self.metadata['total_pages']} pagine")
+                
+                yield page_data
+    
+    def _extracted_pages(self, pdf_path: str, extractor: TextExtractor) -> Iterator[Dict]:
+        """Testo delle pagine in ordine: processi worker con il proprio documento o, con un solo worker, seriale.
+        
+        La classificazione strutturale resta nel processo principale: ricorda le immagini
+        già viste (logo, template) e dipende quindi dall'ordine delle pagine.
+        """
+        workers = CONFIG['processing'].get('extract_workers', 1)
+        range_size = CONFIG['processing']['extract_range_pages']
+        if workers > 1 and len(extractor) > range_size:
+            return iter_pages_parallel(pdf_path, len(extractor), workers, range_size, extractor.name)
+        return iter_pages(extractor)
+    
+    def extract_pdf(self, pdf_path: str) -> str:
+        """Estrae testo dal PDF e identifica pagine per Vision"""
+        parts = []
+        for page_data in self.iter_pages(pdf_path):
+            self.pages.append(page_data)
+            parts.append(page_data['text'])
+            parts.append("\n\n")
+        self.text = ''.join(parts)
         
         print(f"✅ Estratti {len(self.text)} caratteri totali")
-        print(f"👁️ {len(self.vision_candidates)} pagine candidate per Vision\n")
+        print(f"👁️ {len(self.vision_candidates)} pagine candidate per Vision")
+        if self.vision_report:
+            print(f"   selezione strutturale: motivi per pagina salvati nei metadata")
+        print()
         
         return self.text
     
-    def _should_use_vision(self, page_text: str, page_num: int) -> bool:
+    def _should_use_vision(self, page_text: str, page_num: int, page=None) -> bool:
         """Determina se una pagina necessita analisi Vision"""
         if not CONFIG['vision']['enable']:
             return False
         
+        # Selezione strutturale: immagini, tracciati vettoriali e area del testo dal PDF
+        if CONFIG['vision']['selection'] == 'structure' and page is not None:
+            try:
+                result = self.classifier.classify(page, page_text)
+                if result['selected']:
+                    self.vision_report[page_num] = result
+                return result['selected']
+            except Exception as e:
+                print(f"  ⚠️ Analisi struttura pagina {page_num} fallita ({e}), uso euristiche testuali")
+        
+        return self._text_heuristics(page_text)
+    
+    def _text_heuristics(self, page_text: str) -> bool:
+        """Criteri testuali (keyword, tabelle, formule) usati dalla selezione 'text'"""
         # Criteri per usare Vision
         text_lower = page_text.lower()
         
@@ -150,117 +294,361 @@ class PDFProcessor:
         
         return False
     
+    def top_vision_candidates(self, limit: int) -> List[int]:
+        """Le `limit` pagine candidate con punteggio visuale più alto, in ordine di pagina"""
+        if len(self.vision_candidates) <= limit or not self.vision_report:
+            return self.vision_candidates[:limit]
+        ranked = sorted(self.vision_candidates,
+                        key=lambda p: self.vision_report.get(p, {}).get('score', 0), reverse=True)
+        return sorted(ranked[:limit])
+    
+    def _page_at(self, char_position: int) -> int:
+        """Restituisce la pagina (1-based) che contiene l'offset indicato"""
+        if not self.page_offsets:
+            return 1
+        return max(1, bisect_right(self.page_offsets, char_position))
+    
+    def _make_chunk(self, chunk_id: int, text: str, start: int, end: int, candidates: List[int]) -> Dict:
+        """Costruisce un chunk con lo span di pagine esatto"""
+        page_start = self._page_at(start)
+        page_end = max(page_start, self._page_at(max(start, end - 1)))
+        text = text.strip()
+        return {
+            'id': f'chunk_{chunk_id}',
+            'text': text,
+            'char_count': len(text),
+            'token_count': self.tokens.count(text),
+            'chunk_index': chunk_id,
+            'page_num': page_start,
+            'page_start': page_start,
+            'page_end': page_end,
+            # I candidati sono ordinati: basta una ricerca binaria sullo span
+            'needs_vision': bisect_left(candidates, page_start) < bisect_left(candidates, page_end + 1)
+        }
+    
     def create_chunks(self, text: str) -> List[Dict]:
         """Divide il testo in chunks intelligenti"""
         print("🧩 Creazione chunks semantici...")
         
-        chunks = []
+        chunks = list(self._chunk_paragraphs(text.split('\n\n')))
+        
+        vision_chunks = sum(1 for c in chunks if c.get('needs_vision'))
+        print(f"✅ Creati {len(chunks)} chunks")
+        print(f"   di cui {vision_chunks} richiedono Vision\n")
+        
+        return chunks
+    
+    def iter_chunks(self, pages: Iterable[Dict]) -> Iterator[Dict]:
+        """Versione streaming di create_chunks: consuma le pagine ed emette chunks man mano"""
+        print("🧩 Creazione chunks semantici (streaming)...")
+        return self._chunk_paragraphs(self._iter_paragraphs(pages))
+    
+    @staticmethod
+    def _iter_paragraphs(pages: Iterable[Dict]) -> Iterator[str]:
+        """Restituisce gli stessi paragrafi di text.split('\\n\\n') senza costruire il testo completo"""
+        pending = ""
+        for page_data in pages:
+            parts = (pending + page_data['text'] + "\n\n").split('\n\n')
+            pending = parts.pop()
+            yield from parts
+        yield pending
+    
+    def _chunk_paragraphs(self, paragraphs: Iterable[str]) -> Iterator[Dict]:
+        """Raggruppa i paragrafi in chunks con overlap (dimensioni in token o in caratteri)"""
+        if CONFIG['processing']['chunk_unit'] == 'tokens':
+            yield from self._chunk_paragraphs_by_tokens(paragraphs)
+            return
+        
         chunk_size = CONFIG['processing']['chunk_size']
         overlap = CONFIG['processing']['chunk_overlap']
         
-        paragraphs = text.split('\n\n')
         current_chunk = ""
         chunk_id = 0
-        current_page = 1
+        # Lista condivisa: in streaming i candidati crescono man mano che arrivano le pagine
+        candidates = self.vision_candidates
+        
+        # Posizione corrente nel testo: evita text.find() e somme ripetute
+        position = 0
+        chunk_start = 0
+        chunk_end = 0
         
         for para in paragraphs:
-            # Stima pagina corrente
-            char_position = self.text.find(para)
-            for page in self.pages:
-                if char_position < sum(p['char_count'] for p in self.pages[:page['page_num']]):
-                    current_page = page['page_num']
-                    break
+            para_start = position
+            position += len(para) + 2
             
             if len(current_chunk) + len(para) > chunk_size and current_chunk:
-                chunks.append({
-                    'id': f'chunk_{chunk_id}',
-                    'text': current_chunk.strip(),
-                    'char_count': len(current_chunk),
-                    'chunk_index': chunk_id,
-                    'page_num': current_page,
-                    'needs_vision': current_page in self.vision_candidates
-                })
+                yield self._make_chunk(chunk_id, current_chunk, chunk_start, chunk_end, candidates)
                 chunk_id += 1
                 
                 # Overlap
                 sentences = current_chunk.split('. ')
                 if len(sentences) > 2:
-                    overlap_text = '. '.join(sentences[-2:])[:overlap]
+                    tail = '. '.join(sentences[-2:])
+                    overlap_text = tail[:overlap]
                     current_chunk = overlap_text + " " + para
+                    chunk_start = max(chunk_start, chunk_end - len(tail))
                 else:
                     current_chunk = para
+                    chunk_start = para_start
             else:
+                if not current_chunk:
+                    chunk_start = para_start
                 current_chunk += "\n\n" + para if current_chunk else para
+            
+            chunk_end = para_start + len(para)
         
         # Aggiungi ultimo chunk
         if current_chunk.strip():
-            chunks.append({
-                'id': f'chunk_{chunk_id}',
-                'text': current_chunk.strip(),
-                'char_count': len(current_chunk),
-                'chunk_index': chunk_id,
-                'page_num': current_page,
-                'needs_vision': current_page in self.vision_candidates
-            })
+            yield self._make_chunk(chunk_id, current_chunk, chunk_start, chunk_end, candidates)
+    
+    def _chunk_paragraphs_by_tokens(self, paragraphs: Iterable[str]) -> Iterator[Dict]:
+        """Come _chunk_paragraphs, ma chunk e overlap misurati in token (paragrafi codificati a blocchi)"""
+        chunk_tokens = CONFIG['processing']['chunk_tokens']
+        overlap = CONFIG['processing']['chunk_overlap_tokens']
         
-        vision_chunks = sum(1 for c in chunks if c.get('needs_vision'))
-        print(f"✅ Creati {len(chunks)} chunks")
-        print(f"   di cui {vision_chunks} richiedono Vision\n")
+        current_chunk = ""
+        current_tokens = 0
+        chunk_id = 0
+        candidates = self.vision_candidates
         
-        return chunks
+        position = 0
+        chunk_start = 0
+        chunk_end = 0
+        
+        for para, para_tokens in self.tokens.measure(paragraphs):
+            para_start = position
+            position += len(para) + 2
+            
+            if current_tokens + para_tokens > chunk_tokens and current_chunk:
+                yield self._make_chunk(chunk_id, current_chunk, chunk_start, chunk_end, candidates)
+                chunk_id += 1
+                
+                # Overlap: gli ultimi `overlap` token del chunk precedente (se ci stanno col paragrafo)
+                tail_tokens = overlap if overlap + para_tokens + 1 <= chunk_tokens else 0
+                tail = current_chunk[self.tokens.tail_start(current_chunk, tail_tokens):]
+                current_chunk = tail + " " + para if tail else para
+                current_tokens = min(tail_tokens, current_tokens) + para_tokens + (1 if tail else 0)
+                chunk_start = max(chunk_start, chunk_end - len(tail)) if tail else para_start
+            else:
+                if not current_chunk:
+                    chunk_start = para_start
+                # Il separatore "\n\n" vale un token
+                current_tokens += para_tokens + 1 if current_chunk else para_tokens
+                current_chunk += "\n\n" + para if current_chunk else para
+            
+            chunk_end = para_start + len(para)
+        
+        if current_chunk.strip():
+            yield self._make_chunk(chunk_id, current_chunk, chunk_start, chunk_end, candidates)
+
+# Prompt Vision (fa parte della chiave della cache dei risultati)
+VISION_PROMPT = """Analizza questa pagina di un corso di informatica.
+
+Identifica elementi visuali e testo importante.
+
+Rispondi SOLO con un JSON valido in questo formato esatto:
+{
+  "visual_elements": [],
+  "extracted_text": "",
+  "tables": [],
+  "code_blocks": [],
+  "key_concepts": [],
+  "importance": 5,
+  "summary": "riassunto breve"
+}"""
+
+def encode_page_image(img: Image.Image, max_size: int, image_format: str, quality: int) -> bytes:
+    """Ridimensiona e codifica l'immagine di una pagina nel formato richiesto"""
+    # Riduci dimensione se troppo grande
+    img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
+    
+    buffer = io.BytesIO()
+    if image_format == 'png':
+        img.save(buffer, format='PNG', optimize=True)
+    else:
+        # Formati compatti: JPEG/WEBP con perdita controllata
+        img.convert('RGB').save(buffer, format=image_format.upper(), quality=quality)
+    return buffer.getvalue()
+
+def render_page_range(pdf_path: str, first_page: int, last_page: int, dpi: int, max_size: int,
+                      image_format: str, quality: int, poppler_path: Optional[str]) -> List[Tuple[int, Optional[bytes], str]]:
+    """Worker del process pool: una sola invocazione di poppler per un intervallo contiguo di pagine.
+    
+    Restituisce (pagina, byte immagine o None, messaggio di errore).
+    """
+    try:
+        images = convert_from_path(
+            pdf_path,
+            first_page=first_page,
+            last_page=last_page,
+            dpi=dpi,
+            poppler_path=poppler_path
+        )
+    except Exception as e:
+        return [(page_num, None, str(e)) for page_num in range(first_page, last_page + 1)]
+    
+    results = []
+    for page_num, img in zip(range(first_page, last_page + 1), images):
+        try:
+            results.append((page_num, encode_page_image(img, max_size, image_format, quality), ''))
+        except Exception as e:
+            results.append((page_num, None, str(e)))
+        finally:
+            img.close()
+    return results
+
+def contiguous_ranges(pages: List[int], max_length: int) -> List[Tuple[int, int]]:
+    """Raggruppa le pagine in intervalli contigui di al massimo max_length pagine"""
+    ranges = []
+    for page_num in sorted(set(pages)):
+        if ranges and page_num == ranges[-1][1] + 1 and page_num - ranges[-1][0] < max_length:
+            ranges[-1] = (ranges[-1][0], page_num)
+        else:
+            ranges.append((page_num, page_num))
+    return ranges
 
 class VisionAnalyzer:
     """Analisi pagine PDF con GPT-4 Vision"""
     
-    def __init__(self, openai_client: OpenAI):
+    def __init__(self, openai_client: OpenAI, results_cache: Optional[ContentCache] = None,
+                 metrics: Optional[PipelineMetrics] = None, usage: Optional[UsageLedger] = None):
         self.client = openai_client
+        self.results_cache = results_cache  # Risultati Vision persistenti tra le esecuzioni
+        self.metrics = metrics or PipelineMetrics('vision')
+        self.usage = usage or UsageLedger()  # Token reali delle chiamate Vision
         self.vision_model = CONFIG['openai']['vision_model']
-        self.cache_dir = Path(CONFIG['paths']['vision_cache'])
-        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.image_format = CONFIG['vision']['image_format']
+        self.image_cache = PageImageCache(
+            CONFIG['paths']['vision_cache'],
+            CONFIG['vision']['cache_max_mb'] * 1024 * 1024
+        )
+        self.legacy_checked = False
         self.vision_calls = 0
-        self.vision_cost = 0.0
+        self.cached_pages = 0
+        self.fallback_pages = set()  # Pagine con risultato di default: non vanno nel journal
     
-    def convert_pdf_page_to_image(self, pdf_path: str, page_num: int) -> Optional[str]:
-        """Converte una pagina PDF in base64"""
-        cache_file = self.cache_dir / f"page_{page_num}.txt"
+    @property
+    def vision_cost(self) -> float:
+        """Costo reale delle chiamate Vision dal campo usage delle risposte"""
+        return self.usage.total_cost('vision')
+    
+    def _cache_key(self, pdf_path: str) -> Tuple[str, int, int]:
+        """Parte comune della chiave di cache; alla prima chiamata migra la vecchia cache"""
+        pdf_hash = pdf_content_hash(pdf_path)
+        dpi = CONFIG['vision']['dpi']
+        max_size = CONFIG['vision']['max_size']
+        
+        # Migrazione una tantum della vecchia cache base64 (page_{n}.txt)
+        if not self.legacy_checked:
+            self.image_cache.migrate_legacy(pdf_hash, dpi, max_size)
+            self.legacy_checked = True
+        
+        return pdf_hash, dpi, max_size
+    
+    def get_page_image(self, pdf_path: str, page_num: int) -> Optional[bytes]:
+        """Restituisce i byte dell'immagine della pagina, dalla cache o rasterizzando"""
+        pdf_hash, dpi, max_size = self._cache_key(pdf_path)
         
         # Usa cache se disponibile
-        if cache_file.exists():
+        cached = self.image_cache.get(pdf_hash, page_num, dpi, max_size, self.image_format)
+        if cached is not None:
             print(f"    📁 Usando cache per pagina {page_num}")
-            return cache_file.read_text()
+            return cached
         
-        try:
-            # Converte PDF in immagine
-            images = convert_from_path(
-                pdf_path,
-                first_page=page_num,
-                last_page=page_num,
-                dpi=CONFIG['vision']['dpi'],
-                poppler_path=CONFIG['poppler']['path'] if os.name == 'nt' else None
-            )
-            
-            if images:
-                img = images[0]
-                
-                # Riduci dimensione se troppo grande
-                max_size = (2000, 2000)
-                img.thumbnail(max_size, Image.Resampling.LANCZOS)
-                
-                # Converti in base64
-                buffer = io.BytesIO()
-                img.save(buffer, format='PNG', optimize=True)
-                img_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
-                
-                # Salva in cache
-                cache_file.write_text(img_base64)
-                
-                return img_base64
-        except Exception as e:
-            print(f"    ❌ Errore conversione pagina {page_num}: {e}")
+        page_num, data, error = render_page_range(
+            pdf_path, page_num, page_num, dpi, max_size, self.image_format,
+            CONFIG['vision']['image_quality'],
+            CONFIG['poppler']['path'] if os.name == 'nt' else None
+        )[0]
+        if data is None:
+            print(f"    ❌ Errore conversione pagina {page_num}: {error}")
+            return None
+        
+        # Salva in cache
+        self.image_cache.put(pdf_hash, page_num, dpi, max_size, self.image_format, data)
+        return data
+    
+    def iter_page_images(self, pdf_path: str, pages: List[int]) -> Iterator[Tuple[int, Optional[bytes]]]:
+        """Restituisce (pagina, immagine) man mano che sono pronte.
+        
+        Le pagine in cache escono subito; le altre vengono rasterizzate e codificate
+        da un process pool, un intervallo contiguo di pagine per task.
+        """
+        workers = CONFIG['vision']['render_workers']
+        if not workers:
+            for page_num in pages:
+                yield page_num, self.get_page_image(pdf_path, page_num)
+            return
+        
+        pdf_hash, dpi, max_size = self._cache_key(pdf_path)
+        
+        missing = []
+        for page_num in pages:
+            cached = self.image_cache.get(pdf_hash, page_num, dpi, max_size, self.image_format)
+            if cached is None:
+                missing.append(page_num)
+            else:
+                yield page_num, cached
+        
+        if not missing:
+            return
+        
+        ranges = contiguous_ranges(missing, CONFIG['vision']['render_range_size'])
+        print(f"  🖼️ Rasterizzazione di {len(missing)} pagine in {len(ranges)} blocchi ({workers} processi)")
+        
+        wanted = set(missing)
+        pending = len(ranges)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    render_page_range, pdf_path, first, last, dpi, max_size, self.image_format,
+                    CONFIG['vision']['image_quality'],
+                    CONFIG['poppler']['path'] if os.name == 'nt' else None
+                )
+                for first, last in ranges
+            ]
+            self.metrics.set_gauge('render_ranges', pending)
+            for future in as_completed(futures):
+                pending -= 1
+                self.metrics.set_gauge('render_ranges', pending)
+                for page_num, data, error in future.result():
+                    if page_num not in wanted:
+                        continue
+                    if data is None:
+                        print(f"    ❌ Errore conversione pagina {page_num}: {error}")
+                    else:
+                        self.image_cache.put(pdf_hash, page_num, dpi, max_size, self.image_format, data)
+                    yield page_num, data
+    
+    def convert_pdf_page_to_image(self, pdf_path: str, page_num: int) -> Optional[str]:
+        """Converte una pagina PDF in base64 (codifica solo al momento della richiesta)"""
+        data = self.get_page_image(pdf_path, page_num)
+        if data is None:
             return None
+        return base64.b64encode(data).decode('utf-8')
+    
+    def _vision_key(self, page_image_base64: str) -> str:
+        """Chiave dei risultati Vision: hash immagine, prompt, modello e detail"""
+        image_hash = hashlib.sha256(page_image_base64.encode('ascii')).hexdigest()
+        return ContentCache.make_key('vision', image_hash, self.vision_model,
+                                     VISION_PROMPT, CONFIG['vision']['detail'])
+    
+    def _store_result(self, key: str, result: Dict, fallback: bool):
+        """Salva il risultato; i fallback (default/errore) in un namespace separato, così vengono ritentati"""
+        if self.results_cache:
+            namespace = 'vision_fallback' if fallback else 'vision'
+            self.results_cache.put(namespace, key, result, self.vision_model)
     
     def analyze_page_with_vision(self, page_image_base64: str, page_text: str, page_num: int) -> Optional[Dict]:
         """Analizza una pagina con GPT-4 Vision"""
+        key = self._vision_key(page_image_base64)
+        if self.results_cache:
+            cached = self.results_cache.get('vision', key)
+            if cached is not None:
+                self.cached_pages += 1
+                print(f"    📁 Risultato Vision in cache per pagina {page_num}")
+                return cached
+        
         try:
             print(f"    🔍 Analisi Vision pagina {page_num}...")
             
@@ -271,33 +659,21 @@ class VisionAnalyzer:
                     "content": [
                         {
                             "type": "text",
-                            "text": """Analizza questa pagina di un corso di informatica.
-
-Identifica elementi visuali e testo importante.
-
-Rispondi SOLO con un JSON valido in questo formato esatto:
-{
-  "visual_elements": [],
-  "extracted_text": "",
-  "tables": [],
-  "code_blocks": [],
-  "key_concepts": [],
-  "importance": 5,
-  "summary": "riassunto breve"
-}"""
+                            "text": VISION_PROMPT
                         },
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"data:image/png;base64,{page_image_base64}",
-                                "detail": "high"
+                                "url": f"data:{IMAGE_FORMATS[self.image_format][1]};base64,{page_image_base64}",
+                                "detail": CONFIG['vision']['detail']
                             }
                         }
                     ]
                 }],
-                max_tokens=1500,
+                max_tokens=CONFIG['vision']['max_output_tokens'],
                 temperature=0
             )
+            self.usage.record_response('vision', response, self.vision_model)
             
             # Estrai e pulisci la risposta
             response_text = response.choices[0].message.content
@@ -312,9 +688,11 @@ Rispondi SOLO con un JSON valido in questo formato esatto:
             response_text = response_text.strip()
             
             # Prova a parsare il JSON
+            fallback = False
             try:
                 result = json.loads(response_text)
             except json.JSONDecodeError as je:
+                fallback = True
                 print(f"    ⚠️ JSON non valido, uso default. Errore: {je}")
                 # Ritorna struttura default
                 result = {
@@ -328,17 +706,19 @@ Rispondi SOLO con un JSON valido in questo formato esatto:
                 }
             
             self.vision_calls += 1
-            self.vision_cost += CONFIG['vision']['cost_per_page']
+            if fallback:
+                self.fallback_pages.add(page_num)
             
             elements_count = len(result.get('visual_elements', []))
             print(f"    ✅ Vision completata: {elements_count} elementi trovati")
             
+            self._store_result(key, result, fallback)
             return result
             
         except Exception as e:
             print(f"    ⚠️ Errore Vision: {e}")
             # Ritorna struttura base invece di None
-            return {
+            result = {
                 "visual_elements": [],
                 "extracted_text": "",
                 "tables": [],
@@ -347,76 +727,107 @@ Rispondi SOLO con un JSON valido in questo formato esatto:
                 "importance": 5,
                 "summary": f"Errore analisi pagina {page_num}"
             }
+            self._store_result(key, result, fallback=True)
+            self.fallback_pages.add(page_num)
+            return result
+    
+    def analyze_page(self, pdf_path: str, page_num: int, page_text: str = "") -> Optional[Dict]:
+        """Converte e analizza con Vision una singola pagina"""
+        with self.metrics.stage('render'):
+            img_base64 = self.convert_pdf_page_to_image(pdf_path, page_num)
+        if not img_base64:
+            return None
+        return self.analyze_page_with_vision(img_base64, page_text, page_num)
     
-    def process_vision_pages(self, pdf_path: str, pages_to_analyze: List[int], pages_data: List[Dict] = None) -> Dict[int, Dict]:
-        """Processa tutte le pagine che richiedono Vision"""
+    def process_vision_pages(self, pdf_path: str, pages_to_analyze: List[int], pages_data: List[Dict] = None,
+                             on_result: Optional[Callable[[int, Dict], None]] = None) -> Dict[int, Dict]:
+        """Processa tutte le pagine che richiedono Vision (on_result riceve ogni pagina appena completata)"""
         results = {}
         
         # Limita numero di pagine per costi
         max_pages = min(len(pages_to_analyze), CONFIG['vision']['max_pages'])
         if max_pages < len(pages_to_analyze):
-            print(f"⚠️ Limitato a {max_pages} pagine per Vision (costo stimato: ${max_pages * CONFIG['vision']['cost_per_page']:.2f})")
+            print(f"⚠️ Limitato a {max_pages} pagine per Vision")
             pages_to_analyze = pages_to_analyze[:max_pages]
         
         print(f"👁️ Analisi Vision di {len(pages_to_analyze)} pagine...")
         
-        for i, page_num in enumerate(pages_to_analyze):
+        # Testo OCR base per pagina, se disponibile
+        page_texts = {page['page_num']: page['text'] for page in pages_data} if pages_data else {}
+        
+        # Le immagini arrivano appena pronte: la rasterizzazione procede in parallelo alle richieste
+        images = self.metrics.timed_iter('render', self.iter_page_images(pdf_path, pages_to_analyze))
+        for i, (page_num, image) in enumerate(images):
             print(f"  [{i+1}/{len(pages_to_analyze)}] Pagina {page_num}")
             
-            # Converti pagina in immagine
-            img_base64 = self.convert_pdf_page_to_image(pdf_path, page_num)
-            
-            if img_base64:
-                # Ottieni testo OCR base se disponibile
-                page_text = ""
-                if pages_data:
-                    for page in pages_data:
-                        if page['page_num'] == page_num:
-                            page_text = page['text']
-                            break
-                
-                # Analizza con Vision
-                vision_result = self.analyze_page_with_vision(img_base64, page_text, page_num)
-                
+            if image:
+                img_base64 = base64.b64encode(image).decode('utf-8')
+                vision_result = self.analyze_page_with_vision(img_base64, page_texts.get(page_num, ""), page_num)
                 if vision_result:
                     results[page_num] = vision_result
+                    if on_result and page_num not in self.fallback_pages:
+                        on_result(page_num, vision_result)
             
             # Pausa per evitare rate limiting
             if (i + 1) % 5 == 0 and i < len(pages_to_analyze) - 1:
                 time.sleep(2)
         
-        print(f"✅ Vision completata: {self.vision_calls} chiamate, costo stimato: ${self.vision_cost:.2f}\n")
+        print(f"✅ Vision completata: {self.vision_calls} chiamate, {self.cached_pages} pagine da cache, costo: ${self.vision_cost:.4f}\n")
         
         return results
 
 class SemanticAnalyzer:
     """Analisi semantica con OpenAI"""
     
-    def __init__(self):
-        self.client = OpenAI(api_key=CONFIG['openai']['api_key'])
-        self.encoding = tiktoken.encoding_for_model("gpt-3.5-turbo")
+    def __init__(self, metrics: PipelineMetrics):
+        self.metrics = metrics
+        self.usage = UsageLedger()  # Token reali dal campo usage di ogni risposta (anche Vision)
+        self.client = OpenAI(**self._client_options())
+        self.async_client = None  # Creato da open_async_client() dentro l'event loop
+        self.encoding = tiktoken.encoding_for_model(CONFIG['openai']['model'])
+        self.tokens = TokenBudget(self.encoding)
+        self.fallback_ids = set()  # Chunks con analisi di default: non vanno nel journal
+        self.cache = None
+        if CONFIG['cache']['enable']:
+            self.cache = ContentCache(CONFIG['paths']['cache_db'], CONFIG['cache']['max_mb'] * 1024 * 1024)
     
-    def analyze_chunk(self, chunk: Dict, vision_data: Optional[Dict] = None) -> Dict:
-        """Analizza semanticamente un chunk, integrando dati Vision se disponibili"""
-        try:
-            # Prepara testo arricchito se abbiamo dati Vision
-            enriched_text = chunk['text']
-            
-            if vision_data:
-                # Aggiungi testo estratto da Vision
-                if vision_data.get('extracted_text'):
-                    enriched_text += f"\n\n[VISION ENHANCED]\n{vision_data['extracted_text']}"
-                
-                # Aggiungi descrizioni di elementi visuali
-                for element in vision_data.get('visual_elements', []):
-                    enriched_text += f"\n[{element['type'].upper()}]: {element.get('description', '')}"
+    def _client_options(self, asynchronous: bool = False) -> Dict:
+        """Opzioni comuni ai client sync/async (base_url permette server stub locali)"""
+        options = {'api_key': CONFIG['openai']['api_key']}
+        if CONFIG['openai'].get('base_url'):
+            options['base_url'] = CONFIG['openai']['base_url']
+        # Gli hook di httpx vedono ogni tentativo, compresi i retry interni dell'SDK
+        hooks = httpx_event_hooks(self.metrics, 'openai', asynchronous)
+        options['http_client'] = (DefaultAsyncHttpxClient(event_hooks=hooks) if asynchronous
+                                  else DefaultHttpxClient(event_hooks=hooks))
+        return options
+    
+    def open_async_client(self) -> AsyncOpenAI:
+        """Crea il client asincrono per lo stage concorrente"""
+        self.async_client = AsyncOpenAI(**self._client_options(asynchronous=True))
+        return self.async_client
+    
+    def _analysis_request(self, chunk: Dict, vision_data: Optional[Dict] = None) -> Dict:
+        """Parametri della richiesta di analisi, con testo arricchito da Vision"""
+        # Prepara testo arricchito se abbiamo dati Vision
+        enriched_text = chunk['text']
+        
+        if vision_data:
+            # Aggiungi testo estratto da Vision
+            if vision_data.get('extracted_text'):
+                enriched_text += f"\n\n[VISION ENHANCED]\n{vision_data['extracted_text']}"
             
-            prompt = f"""Analizza questo estratto di un corso di informatica.
+            # Aggiungi descrizioni di elementi visuali
+            for element in vision_data.get('visual_elements', []):
+                enriched_text += f"\n[{element['type'].upper()}]: {element.get('description', '')}"
+        
+        prefix = f"""Analizza questo estratto di un corso di informatica.
             
 {'[ARRICCHITO CON VISION]' if vision_data else ''}
 
 Testo:
-{enriched_text[:2500]}
+"""
+        suffix = f"""
 
 Estrai:
 1. L'argomento principale
@@ -433,68 +844,361 @@ Rispondi in JSON:
   "has_visual": {str(vision_data is not None).lower()},
   "summary": "riassunto in una frase"
 }}"""
-
-            response = self.client.chat.completions.create(
-                model=CONFIG['openai']['model'],
-                messages=[{"role": "user", "content": prompt}],
-                temperature=CONFIG['openai']['temperature'],
-                max_tokens=CONFIG['openai']['max_tokens'],
-                response_format={"type": "json_object"}
-            )
+        prompt = self.tokens.fit(prefix, enriched_text, suffix, CONFIG['openai']['analysis_prompt_tokens'])
+        
+        return {
+            'model': CONFIG['openai']['model'],
+            'messages': [{"role": "user", "content": prompt}],
+            'temperature': CONFIG['openai']['temperature'],
+            'max_tokens': CONFIG['openai']['max_tokens'],
+            'response_format': {"type": "json_object"}
+        }
+    
+    def _merge_vision(self, analysis: Dict, vision_data: Optional[Dict]) -> Dict:
+        """Integra nell'analisi concetti e importanza provenienti da Vision"""
+        # Integra concetti da Vision
+        if vision_data and vision_data.get('key_concepts'):
+            existing = set(analysis.get('concepts', []))
+            existing.update(vision_data['key_concepts'])
+            analysis['concepts'] = list(existing)[:7]
+        
+        # Aumenta importanza se ha contenuti visuali importanti
+        if vision_data and vision_data.get('importance', 0) > 7:
+            analysis['importance'] = max(analysis.get('importance', 5), vision_data['importance'])
+        
+        return analysis
+    
+    def _analysis_key(self, chunk: Dict, vision_data: Optional[Dict] = None) -> str:
+        """Chiave di cache per l'analisi: testo, modello, versione e budget del prompt, unità di chunking
+        e dati Vision"""
+        # Il budget decide quanto testo entra nel prompt: cambiarlo deve invalidare le analisi
+        return ContentCache.make_key('analysis', chunk['text'], CONFIG['openai']['model'],
+                                     CONFIG['cache']['prompt_version'],
+                                     {'vision': vision_data,
+                                      'prompt_tokens': CONFIG['openai']['analysis_prompt_tokens'],
+                                      'chunk_unit': CONFIG['processing']['chunk_unit']})
+    
+    def _embedding_key(self, text: str) -> str:
+        """Chiave di cache per l'embedding di un testo"""
+        return ContentCache.make_key('embedding', text, CONFIG['openai']['embedding_model'])
+    
+    def _cache_get(self, namespace: str, key: str) -> Optional[Any]:
+        return self.cache.get(namespace, key) if self.cache else None
+    
+    def _cache_put(self, namespace: str, key: str, value: Any, model: str):
+        if self.cache and value is not None:
+            self.cache.put(namespace, key, value, model)
+    
+    def _fallback_analysis(self, chunk: Dict, vision_data: Optional[Dict] = None) -> Dict:
+        """Analisi di default in caso di errore"""
+        self.fallback_ids.add(chunk['id'])
+        return {
+            'topic': 'Unknown',
+            'concepts': vision_data.get('key_concepts', []) if vision_data else [],
+            'content_type': 'visual' if vision_data else 'text',
+            'importance': vision_data.get('importance', 5) if vision_data else 5,
+            'has_visual': vision_data is not None,
+            'summary': chunk['text'][:100]
+        }
+    
+    def analyze_chunk(self, chunk: Dict, vision_data: Optional[Dict] = None) -> Dict:
+        """Analizza semanticamente un chunk, integrando dati Vision se disponibili"""
+        key = self._analysis_key(chunk, vision_data)
+        cached = self._cache_get('analysis', key)
+        if cached is not None:
+            return cached
+        
+        try:
+            response = self.client.chat.completions.create(**self._analysis_request(chunk, vision_data))
+            self.usage.record_response('analysis', response, CONFIG['openai']['model'])
             
             analysis = json.loads(response.choices[0].message.content)
+            analysis = self._merge_vision(analysis, vision_data)
+            self._cache_put('analysis', key, analysis, CONFIG['openai']['model'])
+            return analysis
             
-            # Integra concetti da Vision
-            if vision_data and vision_data.get('key_concepts'):
-                existing = set(analysis.get('concepts', []))
-                existing.update(vision_data['key_concepts'])
-                analysis['concepts'] = list(existing)[:7]
-            
-            # Aumenta importanza se ha contenuti visuali importanti
-            if vision_data and vision_data.get('importance', 0) > 7:
-                analysis['importance'] = max(analysis.get('importance', 5), vision_data['importance'])
+        except Exception as e:
+            print(f"  ⚠️ Errore analisi: {e}")
+            return self._fallback_analysis(chunk, vision_data)
+    
+    async def analyze_chunk_async(self, chunk: Dict, vision_data: Optional[Dict] = None) -> Dict:
+        """Versione asincrona di analyze_chunk (stessa gestione errori)"""
+        key = self._analysis_key(chunk, vision_data)
+        cached = self._cache_get('analysis', key)
+        if cached is not None:
+            return cached
+        
+        try:
+            response = await self.async_client.chat.completions.create(**self._analysis_request(chunk, vision_data))
+            self.usage.record_response('analysis', response, CONFIG['openai']['model'])
             
+            analysis = json.loads(response.choices[0].message.content)
+            analysis = self._merge_vision(analysis, vision_data)
+            self._cache_put('analysis', key, analysis, CONFIG['openai']['model'])
             return analysis
             
         except Exception as e:
             print(f"  ⚠️ Errore analisi: {e}")
-            return {
-                'topic': 'Unknown',
-                'concepts': vision_data.get('key_concepts', []) if vision_data else [],
-                'content_type': 'visual' if vision_data else 'text',
-                'importance': vision_data.get('importance', 5) if vision_data else 5,
-                'has_visual': vision_data is not None,
-                'summary': chunk['text'][:100]
-            }
+            return self._fallback_analysis(chunk, vision_data)
     
     def generate_embedding(self, text: str, vision_enhanced: bool = False) -> Optional[List[float]]:
         """Genera embedding per il testo"""
+        key = self._embedding_key(text)
+        cached = self._cache_get('embedding', key)
+        if cached is not None:
+            return cached
+        
         try:
             # Usa modello diverso per testi con Vision?
             model = CONFIG['openai']['embedding_model']
             
             response = self.client.embeddings.create(
                 model=model,
-                input=text[:8000]
+                input=self.tokens.truncate(text, CONFIG['openai']['embedding_max_input_tokens'])
+            )
+            self.usage.record_response('embedding', response, model)
+            embedding = response.data[0].embedding
+            self._cache_put('embedding', key, embedding, model)
+            return embedding
+        except Exception as e:
+            print(f"  ⚠️ Errore embedding: {e}")
+            return None
+    
+    async def generate_embedding_async(self, text: str, vision_enhanced: bool = False) -> Optional[List[float]]:
+        """Versione asincrona di generate_embedding"""
+        key = self._embedding_key(text)
+        cached = self._cache_get('embedding', key)
+        if cached is not None:
+            return cached
+        
+        try:
+            response = await self.async_client.embeddings.create(
+                model=CONFIG['openai']['embedding_model'],
+                input=self.tokens.truncate(text, CONFIG['openai']['embedding_max_input_tokens'])
             )
-            return response.data[0].embedding
+            self.usage.record_response('embedding', response, CONFIG['openai']['embedding_model'])
+            embedding = response.data[0].embedding
+            self._cache_put('embedding', key, embedding, CONFIG['openai']['embedding_model'])
+            return embedding
         except Exception as e:
             print(f"  ⚠️ Errore embedding: {e}")
             return None
+    
+    def analyze_chunks_batch_api(self, chunks: List[Dict]) -> Dict:
+        """Analisi ed embedding di tutti i chunks con la Batch API; le richieste fallite si ripetono sincrone"""
+        runner = BatchRunner(self.client, CONFIG['paths']['batch_dir'],
+                             CONFIG['openai']['batch_poll_seconds'], CONFIG['openai']['batch_completion_window'])
+        by_id = {chunk['id']: chunk for chunk in chunks}
+        analysis_requests, embedding_requests = [], []
+        
+        # Le risposte già in cache non vanno nel batch
+        for chunk in chunks:
+            cached = self._cache_get('analysis', self._analysis_key(chunk, chunk.get('vision_data')))
+            if cached is not None:
+                chunk['analysis'] = cached
+            else:
+                analysis_requests.append((chunk['id'], self._analysis_request(chunk, chunk.get('vision_data'))))
+            
+            cached = self._cache_get('embedding', self._embedding_key(chunk['text']))
+            if cached is not None:
+                chunk['embedding'] = cached
+            else:
+                embedding_requests.append((chunk['id'], {
+                    'model': CONFIG['openai']['embedding_model'],
+                    'input': self.tokens.truncate(chunk['text'], CONFIG['openai']['embedding_max_input_tokens'])
+                }))
+        
+        print(f"📦 Batch API: {len(analysis_requests)} analisi e {len(embedding_requests)} embedding "
+              f"({len(chunks) - len(analysis_requests)} analisi dalla cache)")
+        outcome = runner.run({
+            'analysis': ('/v1/chat/completions', analysis_requests),
+            'embedding': ('/v1/embeddings', embedding_requests)
+        })
+        
+        analyses, analysis_errors = outcome['analysis']
+        for chunk_id, body in analyses.items():
+            chunk = by_id[chunk_id]
+            self.usage.record_response('analysis', body, CONFIG['openai']['model'], batch=True)
+            try:
+                analysis = json.loads(body['choices'][0]['message']['content'])
+                analysis = self._merge_vision(analysis, chunk.get('vision_data'))
+            except (KeyError, IndexError, TypeError, ValueError):
+                analysis_errors[chunk_id] = 'risposta JSON non valida'
+                continue
+            chunk['analysis'] = analysis
+            self._cache_put('analysis', self._analysis_key(chunk, chunk.get('vision_data')), analysis, CONFIG['openai']['model'])
+        
+        embeddings, embedding_errors = outcome['embedding']
+        for chunk_id, body in embeddings.items():
+            chunk = by_id[chunk_id]
+            self.usage.record_response('embedding', body, CONFIG['openai']['embedding_model'], batch=True)
+            chunk['embedding'] = body['data'][0]['embedding']
+            self._cache_put('embedding', self._embedding_key(chunk['text']), chunk['embedding'],
+                            CONFIG['openai']['embedding_model'])
+        
+        # Fallimenti parziali: chiamate sincrone per i soli chunks rimasti senza risultato
+        if analysis_errors or embedding_errors:
+            print(f"  ⚠️ Falliti nel batch: {len(analysis_errors)} analisi, {len(embedding_errors)} embedding "
+                  f"(ripetuti con chiamate sincrone)")
+        for chunk_id in analysis_errors:
+            by_id[chunk_id]['analysis'] = self.analyze_chunk(by_id[chunk_id], by_id[chunk_id].get('vision_data'))
+        for chunk_id in embedding_errors:
+            by_id[chunk_id]['embedding'] = self.generate_embedding(by_id[chunk_id]['text'])
+        
+        return {
+            'analysis_requests': len(analysis_requests),
+            'embedding_requests': len(embedding_requests),
+            'analysis_retried': len(analysis_errors),
+            'embedding_retried': len(embedding_errors)
+        }
+    
+    def _pack_embedding_batches(self, texts: List[str]) -> Tuple[List[str], List[List[int]]]:
+        """Tronca i testi al limite di token e li raggruppa in batch (liste di indici)"""
+        max_input = CONFIG['openai']['embedding_max_input_tokens']
+        max_items = CONFIG['processing']['embedding_batch_max_items']
+        max_tokens = CONFIG['processing']['embedding_batch_max_tokens']
+        
+        inputs = []
+        batches = []
+        current, current_tokens = [], 0
+        
+        for i, tokens in enumerate(self.encoding.encode_batch(texts, disallowed_special=())):
+            # Un input troppo lungo viene troncato invece di far fallire il batch
+            if len(tokens) > max_input:
+                tokens = tokens[:max_input]
+                inputs.append(self.encoding.decode(tokens))
+            else:
+                inputs.append(texts[i] or " ")
+            
+            if current and (len(current) >= max_items or current_tokens + len(tokens) > max_tokens):
+                batches.append(current)
+                current, current_tokens = [], 0
+            current.append(i)
+            current_tokens += len(tokens)
+        
+        if current:
+            batches.append(current)
+        return inputs, batches
+    
+    @staticmethod
+    def _transient_error(error: Exception) -> bool:
+        """Rate limit, errori del server e di rete: si ritenta lo stesso batch"""
+        if isinstance(error, (openai.RateLimitError, openai.APIConnectionError)):
+            return True
+        return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+    
+    def _embed_batch(self, inputs: List[str], indices: List[int], results: List[Optional[List[float]]]):
+        """Invia un batch; gli errori transitori si ritentano con backoff, solo un 400 lo divide a metà
+        per isolare l'input problematico (dividere sotto rate limit moltiplicherebbe le richieste)"""
+        max_retries = CONFIG['processing']['embedding_max_retries']
+        for attempt in range(max_retries + 1):
+            try:
+                response = self.client.embeddings.create(
+                    model=CONFIG['openai']['embedding_model'],
+                    input=[inputs[i] for i in indices]
+                )
+                self.usage.record_response('embedding', response, CONFIG['openai']['embedding_model'])
+                # data[].index è la posizione nell'input della richiesta
+                for item in response.data:
+                    results[indices[item.index]] = item.embedding
+                return
+            except openai.BadRequestError as e:
+                if len(indices) == 1:
+                    print(f"  ⚠️ Input rifiutato dall'API embedding (input {indices[0]}): {e}")
+                    return
+                middle = len(indices) // 2
+                self._embed_batch(inputs, indices[:middle], results)
+                self._embed_batch(inputs, indices[middle:], results)
+                return
+            except Exception as e:
+                if not self._transient_error(e) or attempt == max_retries:
+                    print(f"  ⚠️ Errore embedding, batch di {len(indices)} input non riuscito "
+                          f"dopo {attempt + 1} tentativi: {e}")
+                    return
+                delay = CONFIG['processing']['embedding_backoff_seconds'] * (2 ** attempt)
+                time.sleep(delay + random.uniform(0, delay))
+    
+    def generate_embeddings_batch(self, texts: List[str]) -> List[Optional[List[float]]]:
+        """Genera gli embedding di molti testi con poche richieste (None per gli input falliti)"""
+        results = [None] * len(texts)
+        
+        # Solo i testi non in cache vanno all'API
+        keys = [self._embedding_key(text) for text in texts]
+        missing = []
+        for i, key in enumerate(keys):
+            results[i] = self._cache_get('embedding', key)
+            if results[i] is None:
+                missing.append(i)
+        
+        if missing:
+            inputs, batches = self._pack_embedding_batches([texts[i] for i in missing])
+            fresh = [None] * len(missing)
+            
+            for n, indices in enumerate(batches):
+                print(f"\r  Batch embedding {n+1}/{len(batches)} ({len(indices)} testi)...", end='')
+                self._embed_batch(inputs, indices, fresh)
+            print()
+            
+            for i, embedding in zip(missing, fresh):
+                results[i] = embedding
+                self._cache_put('embedding', keys[i], embedding, CONFIG['openai']['embedding_model'])
+        
+        return results
 
 class VectorIndexer:
-    """Gestisce l'indicizzazione in Pinecone"""
+    """Gestisce l'indicizzazione in Pinecone o nell'indice locale"""
     
-    def __init__(self):
-        self.pc = Pinecone(api_key=CONFIG['pinecone']['api_key'])
+    def __init__(self, metrics: PipelineMetrics):
+        self.backend = CONFIG['pinecone'].get('backend', 'pinecone')
         self.index_name = CONFIG['pinecone']['index_name']
         self.index = None
+        self.failed_ids = []
+        self.sparse = {}
+        # L'indice locale è solo dense: la ricerca lessicale locale usa l'indice BM25
+        self.sparse_encoder = None
+        if CONFIG['pinecone']['sparse_vectors'] and self.backend != 'local':
+            self.sparse_encoder = SparseEncoder(CONFIG['paths']['sparse_vocabulary'])
+        if self.backend == 'local':
+            # Il manifest sta dentro l'indice locale: non si mescola con lo stato di Pinecone
+            self.pc = None
+            self.manifest = IndexManifest(os.path.join(CONFIG['paths']['local_index'], 'manifest.json'), self.index_name)
+        else:
+            options = {'api_key': CONFIG['pinecone']['api_key']}
+            if CONFIG['pinecone'].get('controller_host'):
+                options['host'] = CONFIG['pinecone']['controller_host']
+            self.pc = Pinecone(**options)
+            self.manifest = IndexManifest(CONFIG['paths']['index_manifest'], self.index_name)
         self._setup_index()
+        self.upsert_engine = UpsertEngine(
+            self.index,
+            max_batch_bytes=CONFIG['processing']['upsert_max_batch_bytes'],
+            max_batch_records=CONFIG['processing']['upsert_max_batch_records'],
+            concurrency=CONFIG['processing']['upsert_concurrency'],
+            max_retries=CONFIG['processing']['upsert_max_retries'],
+            metrics=metrics,
+            service=self.backend
+        )
     
     def _setup_index(self):
         """Crea o connette all'indice Pinecone"""
+        if self.backend == 'local':
+            self.index = LocalVectorIndex.load(
+                CONFIG['paths']['local_index'],
+                CONFIG['pinecone']['dimension'],
+                nlist=CONFIG['pinecone']['local_ivf_lists']
+            )
+            print(f"✅ Indice locale: {CONFIG['paths']['local_index']} ({self.index.count} vettori esistenti)\n")
+            return
+        
         print("🔗 Configurazione Pinecone...")
         
+        # Host esplicito: connessione diretta al data-plane (la metrica va comunque verificata)
+        if CONFIG['pinecone'].get('host'):
+            self.index = self.pc.Index(self.index_name, host=CONFIG['pinecone']['host'])
+            self._check_sparse_metric()
+            print(f"✅ Indice connesso: {CONFIG['pinecone']['host']}\n")
+            return
+        
         existing_indexes = [idx.name for idx in self.pc.list_indexes()]
         
         if self.index_name not in existing_indexes:
@@ -502,7 +1206,8 @@ class VectorIndexer:
             self.pc.create_index(
                 name=self.index_name,
                 dimension=CONFIG['pinecone']['dimension'],
-                metric='cosine',
+                # I vettori sparse si combinano solo con dotproduct (embedding OpenAI normalizzati: = coseno)
+                metric='dotproduct' if self.sparse_encoder else 'cosine',
                 spec={
                     'serverless': {
                         'cloud': 'aws',
@@ -514,67 +1219,169 @@ class VectorIndexer:
             time.sleep(30)
         
         self.index = self.pc.Index(self.index_name)
+        self._check_sparse_metric()
         stats = self.index.describe_index_stats()
         print(f"✅ Indice pronto: {stats['total_vector_count']} vettori esistenti\n")
     
+    def _check_sparse_metric(self):
+        """Disabilita i vettori sparse se l'indice non usa dotproduct (Pinecone rifiuterebbe ogni upsert)"""
+        if not self.sparse_encoder:
+            return
+        metric = CONFIG['pinecone'].get('metric')
+        if not metric:
+            try:
+                metric = self.pc.describe_index(self.index_name).metric
+            except Exception as e:
+                print(f"  ⚠️ Metrica dell'indice non verificabile ({e}): vettori sparse disabilitati "
+                      f"(imposta PINECONE_METRIC=dotproduct se l'indice la usa)")
+                self.sparse_encoder = None
+                return
+        if metric != 'dotproduct':
+            print(f"  ⚠️ L'indice usa la metrica {metric}: i vettori sparse richiedono dotproduct "
+                  f"(crea un nuovo indice), disabilitati")
+            self.sparse_encoder = None
+    
+    def _build_vector(self, chunk: Dict) -> Dict:
+        """Vettore Pinecone di un chunk con metadata"""
+        metadata = {
+            'text': chunk['text'][:500],
+            'topic': chunk.get('analysis', {}).get('topic', 'Unknown'),
+            'concepts': ', '.join(chunk.get('analysis', {}).get('concepts', [])),
+            'importance': chunk.get('analysis', {}).get('importance', 5),
+            'chunk_index': chunk['chunk_index'],
+            'page_num': chunk.get('page_num', 0),
+            'has_vision': chunk.get('vision_enhanced', False),
+            'content_type': chunk.get('analysis', {}).get('content_type', 'text')
+        }
+        
+        # Aggiungi metadata Vision se presente
+        if chunk.get('vision_data'):
+            metadata['vision_elements'] = len(chunk['vision_data'].get('visual_elements', []))
+        
+        vector = {
+            'id': chunk['id'],
+            'values': chunk['embedding'],
+            'metadata': metadata
+        }
+        
+        sparse = self.sparse.get(chunk['id'])
+        if sparse and sparse['indices']:
+            vector['sparse_values'] = sparse
+        return vector
+    
+    def _encode_sparse(self, chunks: List[Dict]):
+        """Vettori sparse BM25 dei chunks con embedding; il vocabolario resta stabile tra le esecuzioni"""
+        if not self.sparse_encoder:
+            return
+        embedded = [chunk for chunk in chunks if chunk.get('embedding')]
+        # Le statistiche dei chunks si fondono con quelle salvate: IDF coerente anche in esecuzioni parziali
+        vectors = self.sparse_encoder.encode_documents([chunk['text'] for chunk in embedded],
+                                                       ids=[chunk['id'] for chunk in embedded])
+        self.sparse = {chunk['id']: vector for chunk, vector in zip(embedded, vectors)}
+        self.sparse_encoder.save()
+        print(f"  🔤 Vettori sparse: {len(self.sparse)} chunks, vocabolario di {len(self.sparse_encoder.vocabulary)} termini")
+    
     def index_chunks(self, chunks: List[Dict]) -> int:
         """Indicizza i chunks in Pinecone"""
-        print("🚀 Indicizzazione in Pinecone...")
-        
-        indexed = 0
-        vision_enhanced = 0
-        batch_size = CONFIG['processing']['batch_size']
-        
-        for i in range(0, len(chunks), batch_size):
-            batch = chunks[i:i + batch_size]
-            vectors = []
-            
-            for chunk in batch:
-                if chunk.get('embedding'):
-                    metadata = {
-                        'text': chunk['text'][:500],
-                        'topic': chunk.get('analysis', {}).get('topic', 'Unknown'),
-                        'concepts': ', '.join(chunk.get('analysis', {}).get('concepts', [])),
-                        'importance': chunk.get('analysis', {}).get('importance', 5),
-                        'chunk_index': chunk['chunk_index'],
-                        'page_num': chunk.get('page_num', 0),
-                        'has_vision': chunk.get('vision_enhanced', False),
-                        'content_type': chunk.get('analysis', {}).get('content_type', 'text')
-                    }
-                    
-                    # Aggiungi metadata Vision se presente
-                    if chunk.get('vision_data'):
-                        metadata['vision_elements'] = len(chunk['vision_data'].get('visual_elements', []))
-                        vision_enhanced += 1
-                    
-                    vectors.append({
-                        'id': chunk['id'],
-                        'values': chunk['embedding'],
-                        'metadata': metadata
-                    })
-            
-            if vectors:
-                try:
-                    self.index.upsert(vectors)
-                    indexed += len(vectors)
-                    print(f"  ✓ Indicizzati {indexed} chunks ({vision_enhanced} con Vision)")
-                except Exception as e:
-                    print(f"  ❌ Errore batch: {e}")
-        
-        print(f"✅ Indicizzazione completata: {indexed} vettori")
+        print(f"🚀 Indicizzazione in {self.target}...")
+        self._encode_sparse(chunks)
+        
+        vectors = [self._build_vector(chunk) for chunk in chunks if chunk.get('embedding')]
+        vision_enhanced = sum(1 for chunk in chunks if chunk.get('embedding') and chunk.get('vision_data'))
+        
+        result = self.upsert_engine.upsert(vectors)
+        self.failed_ids = result.failed_ids
+        
+        failed = set(result.failed)
+        self.manifest.record(v for v in vectors if v['id'] not in failed)
+        self.manifest.save()
+        self._persist()
+        
+        if self.failed_ids:
+            print(f"  ❌ {len(self.failed_ids)} vettori non indicizzati dopo {result.retries} retry: {', '.join(self.failed_ids[:20])}")
+        
+        print(f"✅ Indicizzazione completata: {result.upserted} vettori in {result.batches} batch")
         print(f"   di cui {vision_enhanced} arricchiti con Vision\n")
         
+        return result.upserted
+
+    @property
+    def target(self) -> str:
+        return "l'indice locale" if self.backend == 'local' else "Pinecone"
+    
+    def _persist(self):
+        """L'indice locale vive in memoria: lo scrive su disco dopo ogni indicizzazione"""
+        if self.backend == 'local':
+            self.index.save()
+    
+    def _list_index_ids(self) -> List[str]:
+        """ID attualmente nell'indice (solo indici serverless supportano list)"""
+        try:
+            ids = []
+            for page in self.index.list():
+                # Secondo la versione dell'SDK le pagine contengono ID o oggetti con attributo id
+                ids.extend(getattr(item, 'id', item) for item in page)
+            return ids
+        except Exception as e:
+            print(f"  ⚠️ Impossibile elencare gli ID dell'indice ({e}): i vettori obsoleti non verranno rilevati")
+            return []
+    
+    def sync_chunks(self, chunks: List[Dict], allow_delete: bool = True) -> int:
+        """Sincronizza l'indice con i chunks: scrive solo ciò che è cambiato ed elimina i vettori spariti"""
+        print(f"🔄 Sincronizzazione incrementale con {self.target}...")
+        self._encode_sparse(chunks)
+        
+        vectors = [self._build_vector(chunk) for chunk in chunks if chunk.get('embedding')]
+        
+        # Primo sync: registra gli ID già presenti per poter eliminare quelli obsoleti
+        if not self.manifest.exists:
+            self.manifest.bootstrap(self._list_index_ids())
+        
+        # I chunks senza embedding (chiamata fallita) conservano il vettore già indicizzato
+        diff = self.manifest.diff(vectors, present_ids=[chunk['id'] for chunk in chunks])
+        if not allow_delete:
+            diff.deletes = []
+        print(f"  📋 Nuovi/modificati: {len(diff.upserts)} • Solo metadata: {len(diff.metadata_updates)} "
+              f"• Da eliminare: {len(diff.deletes)} • Invariati: {diff.unchanged}")
+        
+        upserted = self.upsert_engine.upsert(diff.upserts)
+        updated = self.upsert_engine.update_metadata(diff.metadata_updates)
+        deleted = self.upsert_engine.delete(diff.deletes)
+        
+        # Il manifest registra solo le operazioni riuscite: le altre verranno ritentate
+        failed = set(upserted.failed) | set(updated.failed)
+        self.manifest.record(v for v in diff.upserts + diff.metadata_updates if v['id'] not in failed)
+        removed = [vector_id for vector_id in diff.deletes if vector_id not in deleted.failed]
+        self.manifest.forget(removed)
+        self.manifest.save()
+        if self.sparse_encoder and removed:
+            self.sparse_encoder.forget(removed)
+            self.sparse_encoder.save()
+        self._persist()
+        
+        self.failed_ids = sorted(failed | set(deleted.failed))
+        if self.failed_ids:
+            print(f"  ❌ {len(self.failed_ids)} operazioni fallite: {', '.join(self.failed_ids[:20])}")
+        
+        indexed = diff.unchanged + upserted.upserted + updated.upserted
+        print(f"✅ Sincronizzazione completata: {indexed} vettori allineati, {deleted.upserted} eliminati\n")
         return indexed
 
 class PreprocessingPipeline:
     """Pipeline completa di preprocessing con Vision"""
     
-    def __init__(self):
-        self.pdf_processor = PDFProcessor()
-        self.semantic_analyzer = SemanticAnalyzer()
-        self.vector_indexer = VectorIndexer()
+    def __init__(self, resume: bool = False):
+        self.metrics = PipelineMetrics('vision')
+        self.semantic_analyzer = SemanticAnalyzer(self.metrics)
+        # Il chunking usa lo stesso encoder tiktoken dell'analisi
+        self.pdf_processor = PDFProcessor(self.semantic_analyzer.tokens)
+        self.vector_indexer = VectorIndexer(self.metrics)
         self.vision_analyzer = None
         self.vision_results = {}
+        self.resume = resume
+        self.checkpoint = None
+        self.deduplicator = None
+        self.batch_stats = None
         
     def run(self):
         """Esegue il preprocessing completo con Vision"""
@@ -583,76 +1390,127 @@ class PreprocessingPipeline:
         print("╚════════════════════════════════════════╝\n")
         
         start_time = time.time()
+        metrics = self.metrics
+        metrics.start_snapshots(CONFIG['paths']['metrics_json'], CONFIG['paths']['metrics_prometheus'],
+                                CONFIG['processing'].get('metrics_snapshot_seconds', 0))
         
         try:
-            # 1. Estrai PDF e identifica pagine per Vision
-            pdf_text = self.pdf_processor.extract_pdf(CONFIG['paths']['pdf_source'])
-            
-            # 2. Analisi Vision delle pagine candidate
-            if CONFIG['vision']['enable'] and self.pdf_processor.vision_candidates:
-                self.vision_analyzer = VisionAnalyzer(self.semantic_analyzer.client)
-                self.vision_results = self.vision_analyzer.process_vision_pages(
-                    CONFIG['paths']['pdf_source'],
-                    self.pdf_processor.vision_candidates,
-                    self.pdf_processor.pages  # Passa i dati delle pagine
-                )
-            
-            # 3. Crea chunks
-            chunks = self.pdf_processor.create_chunks(pdf_text)
-            
-            # Limita chunks per test se configurato
+            streaming = CONFIG['processing'].get('streaming', False)
             max_chunks = CONFIG['processing'].get('max_chunks_to_process')
-            if max_chunks and len(chunks) > max_chunks:
-                print(f"⚠️ Limitato a {max_chunks} chunks per test\n")
-                chunks = chunks[:max_chunks]
-            
-            # 4. Analisi semantica con integrazione Vision
-            print("🧠 Analisi semantica con OpenAI...")
-            analyzed_chunks = []
+            self.checkpoint = PipelineCheckpoint(
+                CONFIG['paths']['checkpoint_dir'], self._run_signature(), resume=self.resume
+            )
             
-            for i, chunk in enumerate(chunks):
-                print(f"\r  Analisi chunk {i+1}/{len(chunks)}...", end='')
-                
-                # Recupera dati Vision se disponibili per questa pagina
-                vision_data = self.vision_results.get(chunk.get('page_num'))
+            if streaming:
+                # 1-3. Estrazione e chunking in streaming: Vision su richiesta per pagina
+                print("🌊 Modalità streaming: estrazione, Vision e chunking procedono insieme\n")
+                if CONFIG['vision']['enable']:
+                    self.vision_analyzer = VisionAnalyzer(self.semantic_analyzer.client, self.semantic_analyzer.cache,
+                                                          metrics, self.semantic_analyzer.usage)
+                # Il tempo di ogni fase è quello speso a produrre i suoi elementi
+                pages = metrics.timed_iter('extraction', self.pdf_processor.iter_pages(CONFIG['paths']['pdf_source']))
+                chunks = metrics.timed_iter('chunking', self.pdf_processor.iter_chunks(pages))
+                if max_chunks:
+                    chunks = islice(chunks, max_chunks)
+            else:
+                # 1. Estrai PDF e identifica pagine per Vision
+                with metrics.stage('extraction'):
+                    pdf_text = self.pdf_processor.extract_pdf(CONFIG['paths']['pdf_source'])
                 
-                # Se abbiamo dati Vision, arricchisci il chunk
-                if vision_data:
-                    chunk['vision_enhanced'] = True
-                    chunk['vision_data'] = vision_data
+                # 2. Analisi Vision delle pagine candidate
+                if CONFIG['vision']['enable'] and self.pdf_processor.vision_candidates:
+                    self.vision_analyzer = VisionAnalyzer(self.semantic_analyzer.client, self.semantic_analyzer.cache,
+                                                          metrics, self.semantic_analyzer.usage)
+                    candidates = self.pdf_processor.top_vision_candidates(CONFIG['vision']['max_pages'])
                     
-                    # Aggiungi testo estratto da Vision
-                    if vision_data.get('extracted_text'):
-                        chunk['text'] += f"\n\n{vision_data['extracted_text']}"
-                
-                # Analisi semantica (con o senza Vision)
-                analysis = self.semantic_analyzer.analyze_chunk(chunk, vision_data)
-                chunk['analysis'] = analysis
-                
-                # Genera embedding del testo arricchito
-                embedding = self.semantic_analyzer.generate_embedding(
-                    chunk['text'], 
-                    vision_enhanced=chunk.get('vision_enhanced', False)
-                )
-                chunk['embedding'] = embedding
+                    # Pagine già analizzate prima dell'interruzione
+                    self.vision_results = {page: self.checkpoint.vision[page]
+                                           for page in candidates if page in self.checkpoint.vision}
+                    pending_pages = [page for page in candidates if page not in self.vision_results]
+                    if pending_pages:
+                        with metrics.stage('vision'):
+                            self.vision_results.update(self.vision_analyzer.process_vision_pages(
+                                CONFIG['paths']['pdf_source'],
+                                pending_pages,
+                                self.pdf_processor.pages,  # Passa i dati delle pagine
+                                on_result=self.checkpoint.append_vision
+                            ))
+                    else:
+                        print(f"♻️ Vision: {len(self.vision_results)} pagine dal checkpoint\n")
+                    self.checkpoint.mark_done('vision', pages=len(self.vision_results))
                 
-                analyzed_chunks.append(chunk)
+                # 3. Crea chunks
+                with metrics.stage('chunking'):
+                    chunks = self.pdf_processor.create_chunks(pdf_text)
                 
-                # Pausa per evitare rate limiting
-                if (i + 1) % 10 == 0:
-                    time.sleep(1)
+                # Limita chunks per test se configurato
+                if max_chunks and len(chunks) > max_chunks:
+                    print(f"⚠️ Limitato a {max_chunks} chunks per test\n")
+                    chunks = chunks[:max_chunks]
+            
+            # Dati Vision prima della deduplicazione: slide con lo stesso testo e figure diverse restano distinte
+            chunks = (self._attach_vision(chunk, streaming) for chunk in chunks)
+            if not streaming:
+                chunks = list(chunks)
+            
+            # Quasi duplicati: solo un rappresentante per gruppo va alle API
+            if CONFIG['processing'].get('dedup'):
+                self.deduplicator = NearDuplicateDetector(CONFIG['processing']['dedup_threshold'])
+                chunks = metrics.timed_iter('dedup', self.deduplicator.filter(chunks))
+                if not streaming:
+                    chunks = list(chunks)
+                    self._print_dedup()
+            
+            # 4. Analisi semantica con integrazione Vision (i chunks nel journal non si rianalizzano)
+            print("🧠 Analisi semantica con OpenAI...")
+            order = []
+            restored = dict(self.checkpoint.chunks)
+            pending = self._pending_chunks(chunks, restored, order)
+            batch_embeddings = CONFIG['processing'].get('batch_embeddings', False)
+            with metrics.stage('analysis'):
+                if CONFIG['processing'].get('batch_api'):
+                    fresh = self._analyze_chunks_batch_api(pending)
+                elif CONFIG['processing'].get('async_analysis'):
+                    fresh = asyncio.run(self._analyze_chunks_async(pending, embed=not batch_embeddings))
+                else:
+                    total = '?' if streaming else len(chunks) - sum(1 for c in chunks if c['id'] in restored)
+                    fresh = self._analyze_chunks(pending, total, embed=not batch_embeddings)
+            
+            by_id = {chunk['id']: chunk for chunk in fresh}
+            analyzed_chunks = [by_id.get(chunk_id) or restored[chunk_id] for chunk_id in order]
+            self.checkpoint.mark_done('analysis', chunks=len(analyzed_chunks))
+            
+            print(f"\n✅ Analizzati {len(fresh)} chunks ({len(analyzed_chunks) - len(fresh)} dal checkpoint)\n")
+            if self.deduplicator and streaming:
+                self._print_dedup()
             
-            print(f"\n✅ Analizzati {len(analyzed_chunks)} chunks\n")
+            if batch_embeddings:
+                with metrics.stage('embedding'):
+                    self._embed_chunks_batched(analyzed_chunks)
+                self.checkpoint.mark_done('embedding')
             
             # 5. Indicizza in Pinecone
-            indexed = self.vector_indexer.index_chunks(analyzed_chunks)
+            if self.checkpoint.is_done('indexing'):
+                indexed = self.checkpoint.stage_info('indexing')['indexed']
+                print(f"♻️ Indicizzazione già completata: {indexed} vettori\n")
+            else:
+                with metrics.stage('upsert'):
+                    if CONFIG['processing'].get('incremental_index'):
+                        # Con un limite di chunks l'insieme è parziale: non eliminare il resto dell'indice
+                        indexed = self.vector_indexer.sync_chunks(analyzed_chunks, allow_delete=not max_chunks)
+                    else:
+                        indexed = self.vector_indexer.index_chunks(analyzed_chunks)
+                self.checkpoint.mark_done('indexing', indexed=indexed)
             
             # 6. Salva dati locali
-            self._save_data(analyzed_chunks, indexed)
+            all_chunks = self.deduplicator.link(analyzed_chunks) if self.deduplicator else analyzed_chunks
+            with metrics.stage('save'):
+                self._save_data(all_chunks, indexed)
+            self.checkpoint.mark_done('save')
             
             # Report finale
             elapsed = time.time() - start_time
-            self._print_report(len(chunks), indexed, elapsed)
+            self._print_report(len(all_chunks), indexed, elapsed)
             
         except Exception as e:
             print(f"\n❌ ERRORE: {e}")
@@ -660,9 +1518,214 @@ class PreprocessingPipeline:
             traceback.print_exc()
             print("\nVerifica:")
             print("1. Le API keys in .env.local")
-            print("2. Il file corso_completo.pdf in data\\source\\")
+            print(f"2. Il file PDF {CONFIG['paths']['pdf_source']}")
             print("3. Poppler installato (per Vision)")
             print("4. La connessione internet")
+            if self.checkpoint:
+                print("\n♻️ Il lavoro completato è nel checkpoint: rilancia con --resume per riprendere")
+        finally:
+            if self.checkpoint:
+                self.checkpoint.close()
+            # Anche un'esecuzione fallita lascia le metriche di ciò che è stato fatto
+            metrics.stop_snapshots()
+            metrics.write(CONFIG['paths']['metrics_json'], CONFIG['paths']['metrics_prometheus'])
+    
+    def _run_signature(self) -> Dict:
+        """Identifica l'esecuzione: il checkpoint vale solo per lo stesso PDF e la stessa configurazione"""
+        return {
+            'pdf': pdf_content_hash(CONFIG['paths']['pdf_source']),
+            'chunk_size': CONFIG['processing']['chunk_size'],
+            'chunk_overlap': CONFIG['processing']['chunk_overlap'],
+            'extractor': CONFIG['processing']['extractor'],
+            'chunk_unit': CONFIG['processing']['chunk_unit'],
+            'chunk_tokens': CONFIG['processing']['chunk_tokens'],
+            'chunk_overlap_tokens': CONFIG['processing']['chunk_overlap_tokens'],
+            'max_chunks': CONFIG['processing'].get('max_chunks_to_process'),
+            'vision': CONFIG['vision']['enable'],
+            'selection': CONFIG['vision']['selection'],
+            'dedup': CONFIG['processing'].get('dedup') and CONFIG['processing']['dedup_threshold'],
+            'prompt_version': CONFIG['cache']['prompt_version']
+        }
+    
+    def _dedup_stats(self) -> Optional[Dict]:
+        """Gruppi di quasi duplicati e chiamate API evitate (un'analisi e un embedding per duplicato)"""
+        if not self.deduplicator:
+            return None
+        stats = self.deduplicator.stats()
+        stats['api_calls_avoided'] = {'analysis': stats['duplicates'], 'embedding': stats['duplicates']}
+        return stats
+    
+    def _print_dedup(self):
+        stats = self._dedup_stats()
+        print(f"🔁 Quasi duplicati: {stats['duplicates']} chunks collegati a {stats['clusters']} rappresentanti "
+              f"({2 * stats['duplicates']} chiamate API evitate)\n")
+    
+    @staticmethod
+    def _pending_chunks(chunks: Iterable[Dict], restored: Dict[str, Dict], order: List[str]) -> Iterator[Dict]:
+        """Registra l'ordine di tutti i chunks e passa avanti solo quelli non ancora nel journal"""
+        for chunk in chunks:
+            order.append(chunk['id'])
+            if chunk['id'] not in restored:
+                yield chunk
+    
+    def _attach_vision(self, chunk: Dict, streaming: bool) -> Dict:
+        """Arricchisce il chunk con i dati Vision della sua pagina, se disponibili"""
+        # Recupera dati Vision se disponibili per questa pagina
+        if streaming:
+            vision_data = self._vision_for_chunk(chunk)
+        else:
+            vision_data = self.vision_results.get(chunk.get('page_num'))
+        
+        # Se abbiamo dati Vision, arricchisci il chunk
+        if vision_data:
+            chunk['vision_enhanced'] = True
+            chunk['vision_data'] = vision_data
+            
+            # Aggiungi testo estratto da Vision
+            if vision_data.get('extracted_text'):
+                chunk['text'] += f"\n\n{vision_data['extracted_text']}"
+        
+        return chunk
+    
+    def _journal_chunk(self, chunk: Dict, embed: bool):
+        """Registra nel journal solo il lavoro riuscito: con --resume i fallback si rifanno.
+        
+        Restano fuori le analisi di default, gli embedding falliti (se non li recupera lo stage
+        di embedding batch) e i chunks arricchiti con il risultato di default di una pagina Vision.
+        """
+        if chunk['id'] in self.semantic_analyzer.fallback_ids:
+            return
+        if embed and chunk.get('embedding') is None:
+            return
+        if (self.vision_analyzer and chunk.get('vision_data')
+                and chunk.get('page_num') in self.vision_analyzer.fallback_pages):
+            return
+        self.checkpoint.append_chunk(chunk)
+    
+    def _analyze_chunks(self, chunks: Iterable[Dict], total, embed: bool = True) -> List[Dict]:
+        """Analisi ed embedding sequenziali, un chunk alla volta"""
+        analyzed_chunks = []
+        
+        for i, chunk in enumerate(chunks):
+            print(f"\r  Analisi chunk {i+1}/{total}...", end='')
+            
+            # Analisi semantica (con o senza Vision)
+            analysis = self.semantic_analyzer.analyze_chunk(chunk, chunk.get('vision_data'))
+            chunk['analysis'] = analysis
+            
+            # Genera embedding del testo arricchito (altrimenti in batch dopo l'analisi)
+            if embed:
+                embedding = self.semantic_analyzer.generate_embedding(
+                    chunk['text'], 
+                    vision_enhanced=chunk.get('vision_enhanced', False)
+                )
+                chunk['embedding'] = embedding
+            
+            analyzed_chunks.append(chunk)
+            self._journal_chunk(chunk, embed)
+            
+            # Pausa per evitare rate limiting
+            if (i + 1) % 10 == 0:
+                time.sleep(1)
+        
+        return analyzed_chunks
+    
+    async def _analyze_chunks_async(self, chunks: Iterable[Dict], embed: bool = True) -> List[Dict]:
+        """Analisi ed embedding concorrenti con al massimo N richieste in volo.
+        
+        L'ordine dell'output è quello dei chunks in ingresso; il prelievo dai
+        chunks (anche un generatore in streaming) è limitato da una finestra,
+        così l'estrazione procede insieme alle richieste di rete.
+        """
+        concurrency = CONFIG['processing']['concurrency']
+        analyzer = self.semantic_analyzer
+        requests = asyncio.Semaphore(concurrency)
+        window = asyncio.Semaphore(concurrency * 2)
+        completed = 0
+        
+        async def process(chunk: Dict) -> Dict:
+            nonlocal completed
+            try:
+                async with requests:
+                    chunk['analysis'] = await analyzer.analyze_chunk_async(chunk, chunk.get('vision_data'))
+                if embed:
+                    async with requests:
+                        chunk['embedding'] = await analyzer.generate_embedding_async(
+                            chunk['text'],
+                            vision_enhanced=chunk.get('vision_enhanced', False)
+                        )
+                self._journal_chunk(chunk, embed)
+                completed += 1
+                self.metrics.set_gauge('analysis_window', len(tasks) - completed)
+                print(f"\r  Analizzati {completed} chunks ({concurrency} richieste in parallelo)...", end='')
+                return chunk
+            finally:
+                window.release()
+        
+        tasks = []
+        analyzer.open_async_client()
+        try:
+            for chunk in chunks:
+                await window.acquire()
+                tasks.append(asyncio.create_task(process(chunk)))
+                # Chunks prelevati e non ancora completati (al massimo 2 * concurrency)
+                self.metrics.set_gauge('analysis_window', len(tasks) - completed)
+            return list(await asyncio.gather(*tasks))
+        finally:
+            # Input fallito, errore o interruzione: le richieste ancora in volo non devono proseguire
+            pending = [task for task in tasks if not task.done()]
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            await analyzer.async_client.close()
+    
+    def _vision_for_chunk(self, chunk: Dict) -> Optional[Dict]:
+        """In streaming analizza con Vision la pagina del chunk alla prima occorrenza"""
+        page_num = chunk.get('page_num')
+        if page_num in self.checkpoint.vision:
+            self.vision_results[page_num] = self.checkpoint.vision[page_num]
+        if page_num in self.vision_results or not self.vision_analyzer:
+            return self.vision_results.get(page_num)
+        if page_num not in self.pdf_processor.vision_candidates:
+            return None
+        if len(self.vision_results) >= CONFIG['vision']['max_pages']:
+            return None
+        
+        print()
+        with self.metrics.stage('vision'):
+            result = self.vision_analyzer.analyze_page(CONFIG['paths']['pdf_source'], page_num)
+        if result:
+            self.vision_results[page_num] = result
+            if page_num not in self.vision_analyzer.fallback_pages:
+                self.checkpoint.append_vision(page_num, result)
+        return result
+    
+    def _analyze_chunks_batch_api(self, chunks: Iterable[Dict]) -> List[Dict]:
+        """Analisi ed embedding differiti con la Batch API: raccoglie tutti i chunks e attende i risultati"""
+        chunks = list(chunks)
+        if chunks:
+            self.batch_stats = self.semantic_analyzer.analyze_chunks_batch_api(chunks)
+        embed = not CONFIG['processing'].get('batch_embeddings', False)
+        for chunk in chunks:
+            self._journal_chunk(chunk, embed)
+        return chunks
+    
+    def _embed_chunks_batched(self, chunks: List[Dict]):
+        """Embedding con richieste batch dei chunks che ancora non ne hanno uno"""
+        missing = [chunk for chunk in chunks if not chunk.get('embedding')]
+        if not missing:
+            print("♻️ Embedding già presenti per tutti i chunks\n")
+            return
+        
+        print(f"🔢 Embedding batch di {len(missing)} chunks...")
+        embeddings = self.semantic_analyzer.generate_embeddings_batch([c['text'] for c in missing])
+        for chunk, embedding in zip(missing, embeddings):
+            chunk['embedding'] = embedding
+            if embedding is not None:
+                self.checkpoint.append_embedding(chunk['id'], embedding)
+        
+        done = sum(1 for e in embeddings if e is not None)
+        print(f"✅ Embedding generati: {done}/{len(missing)}\n")
     
     def _save_data(self, chunks: List[Dict], indexed: int):
         """Salva i dati processati"""
@@ -671,7 +1734,7 @@ class PreprocessingPipeline:
         output_dir = Path(CONFIG['paths']['output_dir'])
         output_dir.mkdir(parents=True, exist_ok=True)
         
-        # Prepara chunks per salvataggio (rimuovi embeddings)
+        # Prepara chunks per salvataggio (gli embedding vanno nell'archivio binario)
         chunks_to_save = []
         vision_enhanced_count = 0
         
@@ -690,6 +1753,13 @@ class PreprocessingPipeline:
             json.dump(chunks_to_save, f, ensure_ascii=False, indent=2)
         print(f"  ✓ Chunks salvati: {chunks_file}")
         
+        embeddings = self._save_embeddings(chunks)
+        
+        # Indice lessicale BM25 per le ricerche per parola chiave esatta
+        bm25 = BM25Index.build((chunk['id'], chunk['text']) for chunk in chunks if 'duplicate_of' not in chunk)
+        bm25.save(CONFIG['paths']['bm25_index'])
+        print(f"  ✓ Indice BM25 salvato: {CONFIG['paths']['bm25_index']} ({len(bm25.terms)} termini)")
+        
         # Salva metadata
         metadata = {
             'version': '4.0-vision',
@@ -699,17 +1769,32 @@ class PreprocessingPipeline:
                 'enabled': CONFIG['vision']['enable'],
                 'pages_analyzed': len(self.vision_results) if self.vision_analyzer else 0,
                 'vision_calls': self.vision_analyzer.vision_calls if self.vision_analyzer else 0,
-                'estimated_cost': self.vision_analyzer.vision_cost if self.vision_analyzer else 0,
-                'enhanced_chunks': vision_enhanced_count
+                'cached_pages': self.vision_analyzer.cached_pages if self.vision_analyzer else 0,
+                'cost_usd': round(self.vision_analyzer.vision_cost, 6) if self.vision_analyzer else 0,
+                'enhanced_chunks': vision_enhanced_count,
+                'image_cache': self.vision_analyzer.image_cache.stats() if self.vision_analyzer else None,
+                'selection': CONFIG['vision']['selection'],
+                'selection_report': {str(page): info for page, info in sorted(self.pdf_processor.vision_report.items())}
             },
             'processing': {
                 'total_chunks': len(chunks),
                 'indexed_vectors': indexed,
+                'failed_vector_ids': self.vector_indexer.failed_ids,
+                'sparse_vectors': bool(self.vector_indexer.sparse_encoder),
+                'chunk_unit': CONFIG['processing']['chunk_unit'],
                 'chunk_size': CONFIG['processing']['chunk_size'],
+                'chunk_tokens': CONFIG['processing']['chunk_tokens'],
+                'total_tokens': sum(c.get('token_count', 0) for c in chunks),
                 'model': CONFIG['openai']['model'],
                 'vision_model': CONFIG['openai']['vision_model'],
                 'embedding_model': CONFIG['openai']['embedding_model']
             },
+            'deduplication': self._dedup_stats(),
+            'batch_api': self.batch_stats,
+            'embeddings': embeddings,
+            'bm25': bm25.stats(),
+            'cache': self.semantic_analyzer.cache.stats() if self.semantic_analyzer.cache else None,
+            'usage': self.semantic_analyzer.usage.to_dict(),
             'topics': list(set(c.get('analysis', {}).get('topic', '') 
                              for c in chunks if c.get('analysis', {}).get('topic')))
         }
@@ -719,6 +1804,31 @@ class PreprocessingPipeline:
             json.dump(metadata, f, ensure_ascii=False, indent=2)
         print(f"  ✓ Metadata salvato: {metadata_file}\n")
     
+    def _save_embeddings(self, chunks: List[Dict]) -> Optional[Dict]:
+        """Salva gli embedding nell'archivio memory-mapped, allineati agli ID dei chunks"""
+        embedded = [chunk for chunk in chunks if chunk.get('embedding')]
+        if not embedded:
+            return None
+        
+        path = CONFIG['paths']['embedding_store']
+        options = (CONFIG['pinecone']['dimension'], CONFIG['processing']['embedding_dtype'],
+                   CONFIG['openai']['embedding_model'])
+        try:
+            store = EmbeddingStore(path, *options)
+        except ValueError as e:
+            # Modello, dimensione o precisione cambiati: i vecchi vettori non sono confrontabili
+            print(f"  ⚠️ {e}: archivio ricreato")
+            shutil.rmtree(path, ignore_errors=True)
+            store = EmbeddingStore(path, *options)
+        
+        added = store.upsert([chunk['id'] for chunk in embedded], [chunk['embedding'] for chunk in embedded])
+        if not CONFIG['processing'].get('max_chunks_to_process'):
+            # Insieme completo: via le righe dei chunks che non esistono più
+            store.compact([chunk['id'] for chunk in chunks])
+        
+        print(f"  ✓ Embedding salvati: {path} ({len(store)} vettori {store.dtype}, {added} nuovi)")
+        return store.stats()
+    
     def _print_report(self, total_chunks: int, indexed: int, elapsed: float):
         """Stampa report finale"""
         print("╔════════════════════════════════════════╗")
@@ -732,9 +1842,16 @@ class PreprocessingPipeline:
         if self.vision_analyzer:
             print(f"\n👁️ VISION:")
             print(f"  • Pagine analizzate: {self.vision_analyzer.vision_calls}")
-            print(f"  • Costo Vision: ${self.vision_analyzer.vision_cost:.2f}")
+            print(f"  • Costo Vision: ${self.vision_analyzer.vision_cost:.4f}")
             print(f"  • Elementi visuali trovati: {sum(len(v.get('visual_elements', [])) for v in self.vision_results.values())}")
         
+        cache = self.semantic_analyzer.cache
+        if cache:
+            stats = cache.stats()
+            print(f"\n🗄️ CACHE:")
+            print(f"  • Hit/miss: {stats['hits']}/{stats['misses']} ({stats['hit_rate']:.0%})")
+            print(f"  • Dimensione: {stats['total_bytes'] / 1024 / 1024:.1f} MB")
+        
         print(f"\n⏱️ PERFORMANCE:")
         print(f"  • Tempo totale: {elapsed:.1f} secondi ({elapsed/60:.1f} minuti)")
         print(f"  • Tempo per chunk: {elapsed/total_chunks:.2f} secondi")
@@ -742,13 +1859,42 @@ class PreprocessingPipeline:
         print(f"\n💾 OUTPUT:")
         print(f"  • Dati salvati in: {CONFIG['paths']['output_dir']}")
         print(f"  • Cache Vision in: {CONFIG['paths']['vision_cache']}")
+        print(f"  • Metriche: {CONFIG['paths']['metrics_json']} • {CONFIG['paths']['metrics_prometheus']}")
         
-        total_cost = self.vision_analyzer.vision_cost if self.vision_analyzer else 0
-        total_cost += total_chunks * 0.002  # Stima costo GPT-3.5
-        print(f"\n💰 COSTO STIMATO TOTALE: ${total_cost:.2f}")
+        usage = self.semantic_analyzer.usage.to_dict()
+        print(f"\n💰 TOKEN E COSTI (dal campo usage delle risposte):")
+        for stage, totals in usage['by_stage'].items():
+            print(f"  • {stage}: {totals['prompt_tokens']} prompt ({totals['cached_tokens']} in cache) + "
+                  f"{totals['completion_tokens']} output in {totals['calls']} chiamate → ${totals['cost_usd']:.4f}")
+        if usage['unpriced_models']:
+            print(f"  ⚠️ Modelli senza prezzo nel listino: {', '.join(usage['unpriced_models'])}")
+        print(f"  • COSTO TOTALE: ${usage['total_cost_usd']:.4f}")
         
         print(f"\n✨ Il corso è pronto per l'analisi semantica avanzata dei quiz!")
 
+def estimate_vision_cost(pages: int) -> Tuple[Optional[float], str]:
+    """Costo previsto per `pages` pagine Vision: media reale dell'ultima esecuzione se il metadata la contiene,
+    altrimenti il massimo dai token dell'immagine (pagina A4 al DPI configurato) e dell'output"""
+    metadata_file = Path(CONFIG['paths']['metadata_file'])
+    if metadata_file.exists():
+        try:
+            with open(metadata_file, 'r', encoding='utf-8') as f:
+                vision = (json.load(f).get('usage') or {}).get('by_stage', {}).get('vision')
+        except (OSError, ValueError):
+            vision = None
+        if vision and vision.get('avg_cost_usd'):
+            return pages * vision['avg_cost_usd'], f"media di {vision['calls']} pagine dell'ultima esecuzione"
+    
+    price = model_price(CONFIG['openai']['vision_model'])
+    if price is None:
+        return None, f"modello {CONFIG['openai']['vision_model']} non presente nel listino"
+    # A4 (8.27 x 11.69 pollici) rasterizzato e ridotto come in encode_page_image
+    width, height = 8.27 * CONFIG['vision']['dpi'], 11.69 * CONFIG['vision']['dpi']
+    scale = min(1.0, CONFIG['vision']['max_size'] / max(width, height))
+    prompt = image_tokens(int(width * scale), int(height * scale), CONFIG['vision']['detail']) + len(VISION_PROMPT) // 4
+    output = CONFIG['vision']['max_output_tokens']
+    return pages * (prompt * price['input'] + output * price['output']) / 1_000_000, "massimo stimato dai token"
+
 def check_dependencies():
     """Verifica dipendenze necessarie"""
     print("🔍 Verifica dipendenze...")
@@ -759,7 +1905,7 @@ def check_dependencies():
     if not CONFIG['openai']['api_key']:
         errors.append("❌ OPENAI_API_KEY mancante in .env.local")
     
-    if not CONFIG['pinecone']['api_key']:
+    if not CONFIG['pinecone']['api_key'] and CONFIG['pinecone']['backend'] != 'local':
         errors.append("❌ PINECONE_API_KEY mancante in .env.local")
     
     # Verifica Poppler su Windows
@@ -770,6 +1916,11 @@ def check_dependencies():
             errors.append("  Scarica da: https://github.com/oschwartz10612/poppler-windows/releases")
             errors.append("  Estrai in C:\\poppler\\")
     
+    # Verifica backend di estrazione
+    if not extractor_available(CONFIG['processing']['extractor']):
+        backend = EXTRACTORS[CONFIG['processing']['extractor']]
+        errors.append(f"❌ Backend di estrazione '{backend.name}' non installato: pip install {backend.package}")
+    
     # Verifica file PDF
     if not Path(CONFIG['paths']['pdf_source']).exists():
         errors.append(f"❌ PDF non trovato: {CONFIG['paths']['pdf_source']}")
@@ -781,8 +1932,45 @@ def check_dependencies():
     print("✅ Tutte le dipendenze presenti\n")
     return True
 
-def main():
+def main(argv: List[str] = None):
     """Funzione principale"""
+    parser = argparse.ArgumentParser(description="Preprocessing v4 con GPT-4o Vision")
+    parser.add_argument('--resume', action='store_true',
+                        help="Riprende un'esecuzione interrotta saltando il lavoro già nel checkpoint")
+    parser.add_argument('--backend', choices=['pinecone', 'local'],
+                        help="Indice di destinazione (default: VECTOR_BACKEND o pinecone)")
+    parser.add_argument('--batch-api', action='store_true',
+                        help="Analisi ed embedding con la Batch API di OpenAI (risultati entro 24h, metà costo)")
+    parser.add_argument('--sparse', action='store_true',
+                        help="Vettori sparse BM25 insieme ai dense (l'indice deve usare la metrica dotproduct)")
+    parser.add_argument('--chunk-unit', choices=['chars', 'tokens'],
+                        help="Unità di chunk e overlap (default: processing.chunk_unit; cambiarla reindicizza tutto)")
+    parser.add_argument('--async-analysis', action='store_true',
+                        help="Analisi ed embedding concorrenti (processing.concurrency richieste in volo)")
+    parser.add_argument('--dedup', action='store_true',
+                        help="Analizza ed indicizza un solo rappresentante per gruppo di chunks quasi identici")
+    parser.add_argument('--extractor', choices=list(EXTRACTORS),
+                        help="Backend di estrazione del testo (default: processing.extractor)")
+    parser.add_argument('--metrics-interval', type=float,
+                        help="Secondi tra due snapshot delle metriche durante l'esecuzione (default: solo alla fine)")
+    args = parser.parse_args(argv)
+    if args.metrics_interval:
+        CONFIG['processing']['metrics_snapshot_seconds'] = args.metrics_interval
+    if args.extractor:
+        CONFIG['processing']['extractor'] = args.extractor
+    if args.backend:
+        CONFIG['pinecone']['backend'] = args.backend
+    if args.batch_api:
+        CONFIG['processing']['batch_api'] = True
+    if args.sparse:
+        CONFIG['pinecone']['sparse_vectors'] = True
+    if args.chunk_unit:
+        CONFIG['processing']['chunk_unit'] = args.chunk_unit
+    if args.async_analysis:
+        CONFIG['processing']['async_analysis'] = True
+    if args.dedup:
+        CONFIG['processing']['dedup'] = True
+    
     if not check_dependencies():
         print("\n⚠️ Risolvi i problemi sopra prima di continuare")
         return
@@ -790,14 +1978,18 @@ def main():
     # Chiedi conferma per Vision
     if CONFIG['vision']['enable']:
         print("👁️ VISION ABILITATO")
-        print(f"  Costo stimato: ${CONFIG['vision']['max_pages'] * CONFIG['vision']['cost_per_page']:.2f}")
+        cost, basis = estimate_vision_cost(CONFIG['vision']['max_pages'])
+        if cost is not None:
+            print(f"  Costo stimato per {CONFIG['vision']['max_pages']} pagine: ${cost:.2f} ({basis})")
+        else:
+            print(f"  Costo non stimabile: {basis}")
         response = input("\nProcedere con Vision? (s/n): ")
         if response.lower() != 's':
             CONFIG['vision']['enable'] = False
             print("Vision disabilitato per questa sessione\n")
     
     # Esegui pipeline
-    pipeline = PreprocessingPipeline()
+    pipeline = PreprocessingPipeline(resume=args.resume)
     pipeline.run()
 
 if __name__ == "__main__":
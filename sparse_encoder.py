@@ -0,0 +1,188 @@
+# sparse_encoder.py
+# Vettori sparse BM25 per l'indice ibrido (dense + sparse) di Pinecone
+# Lato documento: peso di saturazione BM25 del termine; lato query: IDF. Il prodotto scalare è il punteggio BM25
+
+import os
+import sys
+import json
+import time
+import argparse
+from math import log
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from bm25_index import tokenize
+
+# Cartella dei dati della pipeline (default dei comandi), relativa allo script
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'processed-v4')
+
+# Pinecone accetta al massimo 1000 valori non nulli per vettore sparse
+MAX_SPARSE_VALUES = 1000
+
+
+class SparseEncoder:
+    """Vocabolario persistente (termine -> indice stabile) più statistiche del corpus per l'IDF"""
+
+    def __init__(self, path: str, k1: float = 1.2, b: float = 0.75, avgdl_tolerance: float = 0.1):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.avgdl_tolerance = avgdl_tolerance
+        self.vocabulary: Dict[str, int] = {}
+        self.doc_freq: Dict[str, int] = {}
+        self.documents: Dict[str, Dict] = {}  # ID -> indici dei termini distinti e lunghezza in token
+        self.n_docs = 0
+        self.avgdl = 0.0
+
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.vocabulary = data['vocabulary']
+            self.doc_freq = data.get('doc_freq', {})
+            self.n_docs = data.get('n_docs', 0)
+            self.avgdl = data.get('avgdl', 0.0)
+            self.documents = data.get('documents', {})
+        self._terms = sorted(self.vocabulary, key=self.vocabulary.get)
+
+    def _term_index(self, term: str) -> int:
+        """Gli indici non cambiano mai: i termini nuovi vengono accodati"""
+        index = self.vocabulary.get(term)
+        if index is None:
+            index = self.vocabulary[term] = len(self.vocabulary)
+            self._terms.append(term)
+        return index
+
+    def fit(self, texts: Iterable[str], ids: Optional[Iterable[str]] = None) -> List[List[str]]:
+        """Aggiorna document frequency e lunghezza media; restituisce i token.
+
+        Con gli ID le statistiche si fondono con quelle salvate (un documento già visto sostituisce
+        il proprio contributo): un'esecuzione parziale non altera l'IDF del resto dell'indice.
+        Senza ID i testi sono l'intero corpus.
+        """
+        tokenized = [tokenize(text) for text in texts]
+        if ids is None:
+            self.documents, self.doc_freq = {}, {}
+            ids = [str(i) for i in range(len(tokenized))]
+        elif self.doc_freq and not self.documents:
+            print("  ⚠️ Vocabolario sparse senza statistiche per documento: IDF ricalcolato dai chunks correnti")
+            self.doc_freq = {}
+
+        for doc_id, tokens in zip(ids, tokenized):
+            self._remove(doc_id)
+            terms = set(tokens)
+            self.documents[doc_id] = {'terms': sorted(self._term_index(term) for term in terms),
+                                      'length': len(tokens)}
+            for term in terms:
+                self.doc_freq[term] = self.doc_freq.get(term, 0) + 1
+        self._update_stats()
+        return tokenized
+
+    def forget(self, ids: Iterable[str]):
+        """Toglie dalle statistiche i documenti eliminati dall'indice"""
+        for doc_id in ids:
+            self._remove(doc_id)
+        self._update_stats()
+
+    def _remove(self, doc_id: str):
+        document = self.documents.pop(doc_id, None)
+        if document is None:
+            return
+        for index in document['terms']:
+            term = self._terms[index]
+            if self.doc_freq.get(term, 0) > 1:
+                self.doc_freq[term] -= 1
+            else:
+                self.doc_freq.pop(term, None)
+
+    def _update_stats(self):
+        self.n_docs = len(self.documents)
+        # avgdl entra nei pesi dei documenti: cambiandolo cambierebbero tutti i vettori nell'indice,
+        # quindi si aggiorna solo se il corpus si è spostato oltre la tolleranza
+        avgdl = sum(doc['length'] for doc in self.documents.values()) / self.n_docs if self.n_docs else 0.0
+        if not self.avgdl or abs(avgdl - self.avgdl) > self.avgdl_tolerance * self.avgdl:
+            self.avgdl = avgdl
+
+    def encode_tokens(self, tokens: List[str]) -> Dict[str, List]:
+        """Vettore sparse di un documento: tf * (k1 + 1) / (tf + k1 * (1 - b + b * |d| / avgdl))"""
+        counts: Dict[str, int] = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+
+        norm = self.k1 * (1 - self.b + self.b * len(tokens) / (self.avgdl or 1))
+        weights = [(self._term_index(term), tf * (self.k1 + 1) / (tf + norm)) for term, tf in counts.items()]
+        return self._to_sparse(weights)
+
+    def encode_documents(self, texts: Iterable[str], ids: Optional[Iterable[str]] = None) -> List[Dict[str, List]]:
+        """Fit (vedi fit per il ruolo degli ID) e vettori sparse dei documenti"""
+        return [self.encode_tokens(tokens) for tokens in self.fit(texts, ids)]
+
+    def idf(self, term: str) -> float:
+        df = self.doc_freq.get(term, 0)
+        return log(1 + (self.n_docs - df + 0.5) / (df + 0.5))
+
+    def encode_query(self, text: str) -> Dict[str, List]:
+        """Vettore sparse della domanda: IDF dei termini presenti nel vocabolario"""
+        weights = [(self.vocabulary[term], self.idf(term))
+                   for term in set(tokenize(text)) if term in self.vocabulary]
+        return self._to_sparse(weights)
+
+    @staticmethod
+    def _to_sparse(weights: List[Tuple[int, float]]) -> Dict[str, List]:
+        weights = sorted(weights, key=lambda item: -item[1])[:MAX_SPARSE_VALUES]
+        weights.sort()
+        return {'indices': [index for index, _ in weights], 'values': [round(value, 6) for _, value in weights]}
+
+    def save(self):
+        """Scrittura atomica di vocabolario e statistiche"""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({
+                'k1': self.k1,
+                'b': self.b,
+                'n_docs': self.n_docs,
+                'avgdl': self.avgdl,
+                'updated_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'vocabulary': self.vocabulary,
+                'doc_freq': self.doc_freq,
+                'documents': self.documents
+            }, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+
+def hybrid_scale(dense: List[float], sparse: Dict[str, List], alpha: float) -> Tuple[List[float], Dict[str, List]]:
+    """Pesa dense (alpha) e sparse (1 - alpha) per una query ibrida con metrica dotproduct"""
+    if not 0 <= alpha <= 1:
+        raise ValueError("alpha deve essere tra 0 e 1")
+    return ([value * alpha for value in dense],
+            {'indices': sparse['indices'], 'values': [value * (1 - alpha) for value in sparse['values']]})
+
+
+def main(argv: List[str] = None):
+    """Comandi: query TESTO [--vocabulary PATH] | stats"""
+    parser = argparse.ArgumentParser(description="Encoder sparse BM25 per ricerca ibrida")
+    parser.add_argument('command', choices=['query', 'stats'])
+    parser.add_argument('text', nargs='?', help="Testo della domanda")
+    parser.add_argument('--vocabulary', default=os.path.join(DATA_DIR, 'sparse_vocabulary_vision.json'))
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.vocabulary):
+        print(f"❌ Vocabolario non trovato: {args.vocabulary}")
+        return 1
+    encoder = SparseEncoder(args.vocabulary)
+
+    if args.command == 'stats':
+        print(json.dumps({'terms': len(encoder.vocabulary), 'documents': encoder.n_docs,
+                          'avgdl': round(encoder.avgdl, 2)}, indent=2))
+        return 0
+    if not args.text:
+        print("❌ Indicare il testo della domanda")
+        return 1
+    print(json.dumps(encoder.encode_query(args.text)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,491 @@
+# stub_services.py
+# Server HTTP locali che imitano OpenAI (chat, embeddings, files, batches) e Pinecone (control-plane e data-plane)
+# Latenza e tasso di errore configurabili: i benchmark girano offline e senza costi
+
+import re
+import sys
+import json
+import time
+import zlib
+import base64
+import random
+import argparse
+import threading
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+# Stato degli errori simulati: alternati tra rate limit e guasti del server
+ERROR_STATUSES = (429, 500, 503)
+
+
+class StubServer:
+    """Server HTTP in un thread con latenza (latency_ms ± jitter_ms) ed errori casuali (error_rate)"""
+
+    name = ''
+    # Path esclusi dagli errori simulati (es. control-plane: gli errori riguardano il traffico dati)
+    reliable_prefixes: Tuple[str, ...] = ()
+
+    def __init__(self, latency_ms: float = 0, jitter_ms: float = 0, error_rate: float = 0, seed: int = 0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests: Dict[str, int] = {}
+        self.errors: Dict[str, int] = {}
+        self.httpd = None
+
+    # ---- ciclo di vita ----
+
+    def start(self, host: str = '127.0.0.1', port: int = 0) -> 'StubServer':
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                stub._handle(self, 'GET')
+
+            def do_POST(self):
+                stub._handle(self, 'POST')
+
+            def do_DELETE(self):
+                stub._handle(self, 'DELETE')
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def stop(self):
+        if self.httpd:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {'requests': dict(self.requests), 'errors': dict(self.errors),
+                    'total_requests': sum(self.requests.values()), 'total_errors': sum(self.errors.values())}
+
+    # ---- richieste ----
+
+    def route(self, method: str, path: str, query: Dict, body: bytes, headers) -> Tuple[int, object]:
+        """(status, risposta JSON o bytes) per una richiesta; 404 se l'endpoint non esiste"""
+        raise NotImplementedError
+
+    @staticmethod
+    def endpoint(path: str) -> str:
+        """Endpoint per le statistiche: gli ID nei path diventano {id}"""
+        return re.sub(r'/(file|batch)[-_][^/]+', r'/{id}', path)
+
+    def _handle(self, handler: BaseHTTPRequestHandler, method: str):
+        parsed = urlparse(handler.path)
+        body = handler.rfile.read(int(handler.headers.get('content-length') or 0))
+
+        if parsed.path == '/_stats':
+            return self._send(handler, 200, self.stats())
+
+        endpoint = f'{method} {self.endpoint(parsed.path)}'
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            delay = max(0.0, self.latency_ms + self.rng.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+            failure = self.rng.choice(ERROR_STATUSES) if self.rng.random() < self.error_rate else None
+            if parsed.path.startswith(self.reliable_prefixes):
+                failure = None
+            if failure:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+        if delay:
+            time.sleep(delay)
+
+        if failure:
+            return self._send(handler, failure, {'error': {'message': f'Errore simulato {failure}',
+                                                           'type': 'stub_error', 'code': failure}})
+        try:
+            status, payload = self.route(method, parsed.path, parse_qs(parsed.query), body, handler.headers)
+        except Exception as e:
+            status, payload = 400, {'error': {'message': f'{type(e).__name__}: {e}', 'type': 'invalid_request_error'}}
+        self._send(handler, status, payload)
+
+    @staticmethod
+    def _send(handler: BaseHTTPRequestHandler, status: int, payload):
+        data = payload if isinstance(payload, bytes) else json.dumps(payload).encode('utf-8')
+        handler.send_response(status)
+        handler.send_header('Content-Type', 'application/octet-stream' if isinstance(payload, bytes)
+                            else 'application/json')
+        handler.send_header('Content-Length', str(len(data)))
+        if status == 429:
+            handler.send_header('Retry-After', '0')
+        handler.end_headers()
+        handler.wfile.write(data)
+
+
+def _not_found(path: str) -> Tuple[int, Dict]:
+    return 404, {'error': {'message': f'Endpoint non simulato: {path}', 'type': 'not_found'}}
+
+
+def stub_vector(text: str, dimension: int) -> np.ndarray:
+    """Vettore unitario deterministico per un testo (stesso testo, stesso vettore)"""
+    rng = np.random.default_rng(zlib.crc32(text.encode('utf-8')))
+    vector = rng.standard_normal(dimension).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+class OpenAIStub(StubServer):
+    """Chat completions (analisi testo e Vision), embeddings e Batch API con campi usage realistici"""
+
+    name = 'openai'
+
+    # Prefisso minimo perché la cache dei prompt di OpenAI si attivi
+    CACHE_MIN_TOKENS = 1024
+    IMAGE_TOKENS = 765  # Immagine con detail high di una pagina A4
+
+    def __init__(self, *args, batch_polls: int = 1, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batch_polls = batch_polls  # Controlli di stato prima che un batch risulti completato
+        self.files: Dict[str, bytes] = {}
+        self.batches: Dict[str, Dict] = {}
+        self.prefixes = set()
+        self.counter = 0
+
+    def _new_id(self, prefix: str) -> str:
+        with self.lock:
+            self.counter += 1
+            return f'{prefix}{self.counter:08d}'
+
+    def route(self, method, path, query, body, headers):
+        if method == 'POST' and path.endswith('/chat/completions'):
+            return 200, self.chat_completion(json.loads(body))
+        if method == 'POST' and path.endswith('/embeddings'):
+            return 200, self.embeddings(json.loads(body))
+        if method == 'POST' and path.endswith('/files'):
+            return 200, self._upload(body, headers)
+        match = re.search(r'/files/([^/]+)/content$', path)
+        if method == 'GET' and match:
+            return 200, self.files[match.group(1)]
+        if method == 'POST' and path.endswith('/batches'):
+            return 200, self._create_batch(json.loads(body))
+        match = re.search(r'/batches/([^/]+?)(/cancel)?$', path)
+        if match:
+            return 200, self._batch(match.group(1), cancel=bool(match.group(2)))
+        return _not_found(path)
+
+    # ---- chat ed embeddings ----
+
+    @staticmethod
+    def _estimate_tokens(text: str) -> int:
+        return max(1, len(text) // 4)
+
+    def _prompt(self, messages: List[Dict]) -> Tuple[str, int]:
+        """Testo del prompt e numero di immagini"""
+        parts, images = [], 0
+        for message in messages:
+            content = message.get('content')
+            if isinstance(content, str):
+                parts.append(content)
+                continue
+            for part in content or []:
+                if part.get('type') == 'text':
+                    parts.append(part['text'])
+                elif part.get('type') == 'image_url':
+                    images += 1
+        return '\n'.join(parts), images
+
+    def _cached_tokens(self, prompt: str, prompt_tokens: int) -> int:
+        """Token del prefisso già visto (come la cache automatica dei prompt, a blocchi di 128)"""
+        if prompt_tokens < self.CACHE_MIN_TOKENS:
+            return 0
+        prefix = zlib.crc32(prompt[:self.CACHE_MIN_TOKENS * 4].encode('utf-8'))
+        with self.lock:
+            seen = prefix in self.prefixes
+            self.prefixes.add(prefix)
+        return self.CACHE_MIN_TOKENS if seen else 0
+
+    def chat_completion(self, request: Dict) -> Dict:
+        prompt, images = self._prompt(request.get('messages', []))
+        digest = zlib.crc32(prompt.encode('utf-8'))
+        words = re.findall(r'[a-zàèéìòù]{5,}', prompt.lower()) or ['contenuto']
+        # Le parole più frequenti vengono dal testo, non dal modello del prompt
+        concepts = [word for word, _ in Counter(words).most_common(5)]
+        if images:
+            content = {
+                'visual_elements': [{'type': 'diagram', 'description': f'Elemento {digest % 97}'}],
+                'extracted_text': ' '.join(words[:20]),
+                'tables': [], 'code_blocks': [],
+                'key_concepts': concepts,
+                'importance': digest % 10 + 1,
+                'summary': f'Pagina su {concepts[0]}'
+            }
+        else:
+            content = {
+                'topic': concepts[0].capitalize(),
+                'concepts': concepts,
+                'content_type': ('theory', 'practice', 'example', 'definition')[digest % 4],
+                'importance': digest % 10 + 1,
+                'summary': f"Estratto su {', '.join(concepts[:3])}"
+            }
+        text = json.dumps(content, ensure_ascii=False)
+        prompt_tokens = self._estimate_tokens(prompt) + images * self.IMAGE_TOKENS
+        completion_tokens = self._estimate_tokens(text)
+        return {
+            'id': self._new_id('chatcmpl-'),
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': request.get('model', 'stub'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens,
+                'prompt_tokens_details': {'cached_tokens': self._cached_tokens(prompt, prompt_tokens)}
+            }
+        }
+
+    def embeddings(self, request: Dict) -> Dict:
+        inputs = request['input']
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        dimension = request.get('dimensions') or 1536
+        data = []
+        tokens = 0
+        for index, item in enumerate(inputs):
+            text = item if isinstance(item, str) else ' '.join(map(str, item))
+            tokens += self._estimate_tokens(text) if isinstance(item, str) else len(item)
+            vector = stub_vector(text, dimension)
+            # Il client openai chiede base64 (float32 little-endian) e decodifica da sé
+            if request.get('encoding_format') == 'base64':
+                embedding = base64.b64encode(vector.astype('<f4').tobytes()).decode('ascii')
+            else:
+                embedding = vector.tolist()
+            data.append({'object': 'embedding', 'index': index, 'embedding': embedding})
+        return {'object': 'list', 'data': data, 'model': request.get('model', 'stub'),
+                'usage': {'prompt_tokens': tokens, 'total_tokens': tokens}}
+
+    # ---- Batch API ----
+
+    def _upload(self, body: bytes, headers) -> Dict:
+        boundary = headers['content-type'].split('boundary=')[1].strip('"').encode()
+        content = b''
+        for part in body.split(b'--' + boundary):
+            if b'name="file"' in part:
+                content = part.split(b'\r\n\r\n', 1)[1].rsplit(b'\r\n', 1)[0]
+        file_id = self._new_id('file-')
+        self.files[file_id] = content
+        return {'id': file_id, 'object': 'file', 'bytes': len(content), 'created_at': int(time.time()),
+                'filename': 'input.jsonl', 'purpose': 'batch', 'status': 'processed'}
+
+    def _create_batch(self, request: Dict) -> Dict:
+        batch_id = self._new_id('batch_')
+        self.batches[batch_id] = {
+            'id': batch_id, 'object': 'batch', 'endpoint': request['endpoint'],
+            'input_file_id': request['input_file_id'], 'completion_window': request['completion_window'],
+            'status': 'validating', 'created_at': int(time.time()), 'output_file_id': None,
+            'error_file_id': None, 'metadata': request.get('metadata'), 'polls': 0,
+            'request_counts': {'total': 0, 'completed': 0, 'failed': 0}
+        }
+        return self._public(self.batches[batch_id])
+
+    @staticmethod
+    def _public(batch: Dict) -> Dict:
+        return {key: value for key, value in batch.items() if key != 'polls'}
+
+    def _batch(self, batch_id: str, cancel: bool = False) -> Dict:
+        batch = self.batches[batch_id]
+        if cancel:
+            batch['status'] = 'cancelled'
+        elif batch['status'] in ('validating', 'in_progress'):
+            batch['polls'] += 1
+            batch['status'] = 'in_progress'
+            if batch['polls'] >= self.batch_polls:
+                self._complete(batch)
+        return self._public(batch)
+
+    def _complete(self, batch: Dict):
+        """Esegue le richieste del batch; error_rate vale anche per le singole righe"""
+        output, errors = [], []
+        lines = [json.loads(line) for line in self.files[batch['input_file_id']].decode('utf-8').splitlines()
+                 if line.strip()]
+        for line in lines:
+            record = {'id': self._new_id('batch_req_'), 'custom_id': line['custom_id'], 'error': None}
+            with self.lock:
+                failed = self.rng.random() < self.error_rate
+            if failed:
+                record['response'] = {'status_code': 500, 'body': {'error': {'message': 'Errore simulato 500'}}}
+                errors.append(record)
+                continue
+            body = (self.embeddings(line['body']) if line['url'].endswith('/embeddings')
+                    else self.chat_completion(line['body']))
+            record['response'] = {'status_code': 200, 'body': body}
+            output.append(record)
+
+        for key, records in (('output_file_id', output), ('error_file_id', errors)):
+            if records:
+                file_id = self._new_id('file-')
+                self.files[file_id] = ''.join(json.dumps(record) + '\n' for record in records).encode('utf-8')
+                batch[key] = file_id
+        batch['status'] = 'completed'
+        batch['request_counts'] = {'total': len(lines), 'completed': len(output), 'failed': len(errors)}
+
+
+class PineconeStub(StubServer):
+    """Indice serverless: control-plane (list, describe, create) e data-plane (upsert, update, delete,
+    list, fetch, query e statistiche). Come Pinecone, rifiuta i vettori sparse se la metrica non è dotproduct"""
+
+    name = 'pinecone'
+    reliable_prefixes = ('/indexes',)
+
+    def __init__(self, *args, dimension: int = 1536, metric: str = 'cosine', index_name: Optional[str] = None,
+                 **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dimension = dimension
+        self.metric = metric
+        self.indexes = {index_name} if index_name else set()
+        self.namespaces: Dict[str, Dict[str, Dict]] = {}
+
+    def _index_model(self, name: str) -> Dict:
+        """Descrizione dell'indice sia nella forma classica (dimension/metric/spec) sia con schema (SDK 10+)"""
+        return {
+            'name': name, 'host': self.url, 'dimension': self.dimension, 'metric': self.metric,
+            'vector_type': 'dense', 'spec': {'serverless': {'cloud': 'aws', 'region': 'us-east-1'}},
+            'schema': {'fields': {'values': {'type': 'dense_vector', 'dimension': self.dimension,
+                                             'metric': self.metric}}},
+            'deployment': {'deployment_type': 'managed', 'cloud': 'aws', 'region': 'us-east-1'},
+            'status': {'ready': True, 'state': 'Ready'}, 'deletion_protection': 'disabled'
+        }
+
+    def _control(self, method: str, path: str, request: Dict) -> Tuple[int, Dict]:
+        if path == '/indexes' and method == 'GET':
+            return 200, {'indexes': [self._index_model(name) for name in sorted(self.indexes)]}
+        if path == '/indexes' and method == 'POST':
+            fields = (request.get('schema') or {}).get('fields') or {}
+            dense = [field for field in fields.values() if field.get('type') == 'dense_vector']
+            self.metric = request.get('metric') or (dense[0].get('metric') if dense else None) or 'cosine'
+            self.dimension = request.get('dimension') or (dense[0].get('dimension') if dense else self.dimension)
+            self.indexes.add(request['name'])
+            return 201, self._index_model(request['name'])
+        name = path.rsplit('/', 1)[1]
+        if method == 'GET' and name in self.indexes:
+            return 200, self._index_model(name)
+        return 404, {'error': {'code': 'NOT_FOUND', 'message': f'Resource {name} not found'}, 'status': 404}
+
+    def _sparse_rejected(self, vectors: List[Dict]) -> bool:
+        return self.metric != 'dotproduct' and any('sparseValues' in v or 'sparse_values' in v for v in vectors)
+
+    def _namespace(self, name: Optional[str]) -> Dict[str, Dict]:
+        return self.namespaces.setdefault(name or '', {})
+
+    def route(self, method, path, query, body, headers):
+        request = json.loads(body) if body else {}
+        with self.lock:
+            if path.startswith('/indexes'):
+                return self._control(method, path, request)
+            if path in ('/vectors/upsert', '/vectors/update') and self._sparse_rejected(request.get('vectors') or [request]):
+                return 400, {'code': 3, 'message': f'Sparse vectors are only supported for indexes with metric '
+                                                   f'dotproduct, this index uses {self.metric}'}
+            if path == '/vectors/upsert':
+                vectors = self._namespace(request.get('namespace'))
+                for vector in request['vectors']:
+                    vectors[vector['id']] = vector
+                return 200, {'upsertedCount': len(request['vectors'])}
+            if path == '/vectors/update':
+                vector = self._namespace(request.get('namespace')).get(request['id'])
+                if vector is None:
+                    return 404, {'code': 5, 'message': f"Vettore {request['id']} non trovato"}
+                vector.setdefault('metadata', {}).update(request.get('setMetadata') or {})
+                for key in ('values', 'sparseValues'):
+                    if key in request:
+                        vector[key] = request[key]
+                return 200, {}
+            if path == '/vectors/delete':
+                vectors = self._namespace(request.get('namespace'))
+                if request.get('deleteAll'):
+                    vectors.clear()
+                for vector_id in request.get('ids') or []:
+                    vectors.pop(vector_id, None)
+                return 200, {}
+            if path == '/vectors/list':
+                return 200, self._list(query)
+            if path == '/vectors/fetch':
+                namespace = (query.get('namespace') or [''])[0]
+                vectors = self._namespace(namespace)
+                return 200, {'vectors': {vid: vectors[vid] for vid in query.get('ids', []) if vid in vectors},
+                             'namespace': namespace, 'usage': {'readUnits': 1}}
+            if path == '/describe_index_stats':
+                return 200, {
+                    'namespaces': {name: {'vectorCount': len(vectors)} for name, vectors in self.namespaces.items()},
+                    'dimension': self.dimension, 'indexFullness': 0.0,
+                    'totalVectorCount': sum(len(vectors) for vectors in self.namespaces.values())
+                }
+            if path == '/query':
+                return 200, self._query(request)
+        return _not_found(path)
+
+    def _list(self, query: Dict) -> Dict:
+        prefix = (query.get('prefix') or [''])[0]
+        limit = int((query.get('limit') or ['100'])[0])
+        start = int((query.get('paginationToken') or ['0'])[0])
+        namespace = (query.get('namespace') or [''])[0]
+        ids = sorted(vid for vid in self._namespace(namespace) if vid.startswith(prefix))
+        page = ids[start:start + limit]
+        response = {'vectors': [{'id': vid} for vid in page], 'namespace': namespace, 'usage': {'readUnits': 1}}
+        if start + limit < len(ids):
+            response['pagination'] = {'next': str(start + limit)}
+        return response
+
+    def _query(self, request: Dict) -> Dict:
+        vectors = list(self._namespace(request.get('namespace')).values())
+        matches = []
+        if vectors and request.get('vector'):
+            matrix = np.array([v['values'] for v in vectors], dtype=np.float32)
+            scores = matrix @ np.array(request['vector'], dtype=np.float32)
+            for i in np.argsort(-scores)[:request.get('topK', 10)]:
+                match = {'id': vectors[i]['id'], 'score': float(scores[i])}
+                if request.get('includeMetadata'):
+                    match['metadata'] = vectors[i].get('metadata', {})
+                matches.append(match)
+        return {'matches': matches, 'namespace': request.get('namespace', ''), 'usage': {'readUnits': 5}}
+
+
+def main(argv: List[str] = None):
+    """Avvia gli stub finché non si preme Ctrl+C"""
+    parser = argparse.ArgumentParser(description="Server stub di OpenAI e Pinecone")
+    parser.add_argument('--openai-port', type=int, default=8901)
+    parser.add_argument('--pinecone-port', type=int, default=8902)
+    parser.add_argument('--latency-ms', type=float, default=0, help="Latenza aggiunta a ogni richiesta")
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0, help="Frazione di richieste che falliscono (429/5xx)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--index-name', default='quiz-course-v4', help="Indice già esistente nel control-plane")
+    parser.add_argument('--metric', choices=['cosine', 'dotproduct', 'euclidean'], default='cosine')
+    args = parser.parse_args(argv)
+
+    options = dict(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, error_rate=args.error_rate, seed=args.seed)
+    openai_stub = OpenAIStub(**options).start(port=args.openai_port)
+    pinecone_stub = PineconeStub(metric=args.metric, index_name=args.index_name, **options).start(port=args.pinecone_port)
+    print(f"🤖 OpenAI:   {openai_stub.url}/v1  (OPENAI_BASE_URL)")
+    print(f"🌲 Pinecone: {pinecone_stub.url}  (PINECONE_CONTROLLER_HOST, o PINECONE_HOST per il solo data-plane)")
+    print("   Statistiche su /_stats • Ctrl+C per terminare")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        openai_stub.stop()
+        pinecone_stub.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
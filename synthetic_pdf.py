@@ -0,0 +1,228 @@
+# synthetic_pdf.py
+# PDF sintetici di un corso (pagine di testo, tabelle, pagine con immagini) per i benchmark offline
+# Scrittore PDF minimale senza dipendenze: font Helvetica standard, immagini RGB compresse con zlib
+
+import sys
+import zlib
+import random
+import argparse
+from typing import Dict, List, Tuple
+
+PAGE_WIDTH, PAGE_HEIGHT = 595, 842  # A4 in punti
+
+HEADER = "Prof. Marco Formentini - Supply Chain Management"
+
+WORDS = (
+    "supply chain gestione logistica scorte fornitore domanda previsione costo trasporto magazzino "
+    "distribuzione produzione inventario ordine livello servizio lead time capacità rete acquisti "
+    "cliente prodotto processo integrazione coordinamento rischio resilienza sostenibilità flusso "
+    "informazione collaborazione pianificazione strategia efficienza variabilità effetto bullwhip "
+    "lotto economico riordino sicurezza stock approvvigionamento outsourcing performance indicatore"
+).split()
+
+
+def _escape(text: str) -> bytes:
+    """Stringa PDF letterale in WinAnsi (latin-1) con \\, ( e ) protetti"""
+    data = text.encode('latin-1', errors='replace')
+    return data.replace(b'\\', b'\\\\').replace(b'(', b'\\(').replace(b')', b'\\)')
+
+
+def _sentence(rng: random.Random) -> str:
+    words = [rng.choice(WORDS) for _ in range(rng.randint(8, 16))]
+    return ' '.join(words).capitalize() + '.'
+
+
+def _wrap(text: str, width: int = 90) -> List[str]:
+    lines, line = [], ''
+    for word in text.split():
+        if line and len(line) + len(word) + 1 > width:
+            lines.append(line)
+            line = word
+        else:
+            line = f'{line} {word}' if line else word
+    return lines + [line] if line else lines
+
+
+def _text(x: float, y: float, size: int, text: str) -> bytes:
+    return b'BT /F1 %d Tf %.1f %.1f Td (%s) Tj ET\n' % (size, x, y, _escape(text))
+
+
+def _image(width: int, height: int, rng: random.Random) -> bytes:
+    """Immagine RGB a bande e riquadri (si comprime, ma ogni pagina ha la sua)"""
+    base = [rng.randrange(256) for _ in range(3)]
+    blocks = [(rng.randrange(width), rng.randrange(height), rng.randint(20, 120), [rng.randrange(256) for _ in range(3)])
+              for _ in range(6)]
+    rows = []
+    for y in range(height):
+        row = bytearray()
+        for x in range(width):
+            pixel = [(channel + (x + y) // 4) % 256 for channel in base]
+            for bx, by, size, color in blocks:
+                if bx <= x < bx + size and by <= y < by + size:
+                    pixel = color
+                    break
+            row.extend(pixel)
+        rows.append(bytes(row))
+    return b''.join(rows)
+
+
+class PdfWriter:
+    """Oggetti PDF numerati, scritti con tabella xref"""
+
+    def __init__(self):
+        self.objects: List[bytes] = []
+
+    def add(self, body: bytes) -> int:
+        self.objects.append(body)
+        return len(self.objects)
+
+    def reserve(self) -> int:
+        return self.add(b'')
+
+    def set(self, number: int, body: bytes):
+        self.objects[number - 1] = body
+
+    def stream(self, data: bytes, extra: bytes = b'', compress: bool = True) -> int:
+        if compress:
+            data = zlib.compress(data)
+            extra += b' /Filter /FlateDecode'
+        return self.add(b'<< /Length %d%s >>\nstream\n%s\nendstream' % (len(data), extra, data))
+
+    def save(self, path: str, root: int, info: int):
+        with open(path, 'wb') as f:
+            f.write(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+            offsets = []
+            for number, body in enumerate(self.objects, start=1):
+                offsets.append(f.tell())
+                f.write(b'%d 0 obj\n%s\nendobj\n' % (number, body))
+            xref = f.tell()
+            f.write(b'xref\n0 %d\n0000000000 65535 f \n' % (len(self.objects) + 1))
+            for offset in offsets:
+                f.write(b'%010d 00000 n \n' % offset)
+            f.write(b'trailer\n<< /Size %d /Root %d 0 R /Info %d 0 R >>\nstartxref\n%d\n%%%%EOF\n'
+                    % (len(self.objects) + 1, root, info, xref))
+
+
+def _text_page(rng: random.Random, page_num: int) -> Tuple[bytes, List[str]]:
+    ops, lines = [], []
+    y = PAGE_HEIGHT - 100
+    title = f"{page_num}. {' '.join(rng.choice(WORDS) for _ in range(3)).title()}"
+    ops.append(_text(50, y, 16, title))
+    lines.append(title)
+    y -= 30
+    while y > 80:
+        paragraph = ' '.join(_sentence(rng) for _ in range(rng.randint(2, 4)))
+        for line in _wrap(paragraph):
+            if y <= 80:
+                break
+            ops.append(_text(50, y, 10, line))
+            lines.append(line)
+            y -= 13
+        y -= 10
+    return b''.join(ops), lines
+
+
+def _table_page(rng: random.Random, page_num: int) -> Tuple[bytes, List[str]]:
+    rows, columns = rng.randint(8, 14), rng.randint(3, 5)
+    cell_width, cell_height = (PAGE_WIDTH - 100) / columns, 24
+    top = PAGE_HEIGHT - 140
+    ops = [_text(50, PAGE_HEIGHT - 100, 16, f"{page_num}. Tabella: {rng.choice(WORDS)} per {rng.choice(WORDS)}")]
+    lines = [f"{page_num}. Tabella"]
+    ops.append(b'0.5 w\n')
+    for r in range(rows):
+        cells = []
+        for c in range(columns):
+            x, y = 50 + c * cell_width, top - r * cell_height
+            ops.append(b'%.1f %.1f %.1f %.1f re S\n' % (x, y - cell_height, cell_width, cell_height))
+            value = rng.choice(WORDS) if r == 0 or c == 0 else f"{rng.uniform(0, 1000):.1f}"
+            ops.append(_text(x + 4, y - 16, 9, value))
+            cells.append(value)
+        lines.append(' '.join(cells))
+    return b''.join(ops), lines
+
+
+def _image_page(rng: random.Random, page_num: int) -> Tuple[bytes, List[str]]:
+    caption = f"Figura {page_num}: {' '.join(rng.choice(WORDS) for _ in range(5))}"
+    ops = (b'q 480 0 0 360 57 330 cm /Im1 Do Q\n' +
+           _text(57, 300, 10, caption))
+    return ops, [caption]
+
+
+def generate_course_pdf(path: str, pages: int = 100, table_ratio: float = 0.15, image_ratio: float = 0.15,
+                        duplicate_ratio: float = 0.1, seed: int = 0) -> Dict:
+    """Scrive un PDF di `pages` pagine e restituisce composizione e testo atteso per pagina.
+
+    Ogni pagina ha la stessa intestazione e un logo condiviso (come i template delle slide);
+    duplicate_ratio ripete la pagina precedente con una riga diversa (slide costruite a passi).
+    """
+    rng = random.Random(seed)
+    writer = PdfWriter()
+    catalog, pages_root = writer.reserve(), writer.reserve()
+    font = writer.add(b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>')
+    logo = writer.stream(_image(48, 48, rng), b' /Type /XObject /Subtype /Image /Width 48 /Height 48 '
+                                              b'/ColorSpace /DeviceRGB /BitsPerComponent 8')
+
+    kinds = {'text': 0, 'table': 0, 'image': 0, 'duplicate': 0}
+    page_ids, expected = [], []
+    previous = None
+    for page_num in range(1, pages + 1):
+        roll = rng.random()
+        xobjects = b'/Logo %d 0 R' % logo
+        if previous and roll < duplicate_ratio:
+            kind = 'duplicate'
+            body, lines, xobjects = previous
+            extra = _sentence(rng)
+            body, lines = body + _text(50, 60, 10, extra), lines + [extra]
+        elif roll < duplicate_ratio + table_ratio:
+            kind = 'table'
+            body, lines = _table_page(rng, page_num)
+        elif roll < duplicate_ratio + table_ratio + image_ratio:
+            kind = 'image'
+            body, lines = _image_page(rng, page_num)
+            image = writer.stream(_image(240, 180, rng), b' /Type /XObject /Subtype /Image /Width 240 /Height 180 '
+                                                         b'/ColorSpace /DeviceRGB /BitsPerComponent 8')
+            xobjects += b' /Im1 %d 0 R' % image
+        else:
+            kind = 'text'
+            body, lines = _text_page(rng, page_num)
+        kinds[kind] += 1
+        previous = (body, lines, xobjects)
+
+        content = (_text(50, PAGE_HEIGHT - 50, 9, HEADER) + b'q 30 0 0 30 515 792 cm /Logo Do Q\n' + body)
+        contents = writer.stream(content)
+        page_ids.append(writer.add(
+            b'<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %d %d] /Resources << /Font << /F1 %d 0 R >> '
+            b'/XObject << %s >> >> /Contents %d 0 R >>'
+            % (pages_root, PAGE_WIDTH, PAGE_HEIGHT, font, xobjects, contents)))
+        expected.append('\n'.join([HEADER] + lines))
+
+    writer.set(pages_root, b'<< /Type /Pages /Kids [%s] /Count %d >>'
+               % (b' '.join(b'%d 0 R' % page for page in page_ids), len(page_ids)))
+    writer.set(catalog, b'<< /Type /Catalog /Pages %d 0 R >>' % pages_root)
+    info = writer.add(b'<< /Title (Corso sintetico) /Producer (synthetic_pdf.py) >>')
+    writer.save(path, catalog, info)
+    return {'path': path, 'pages': pages, 'kinds': kinds, 'seed': seed, 'expected_text': expected}
+
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description="Genera un PDF sintetico di un corso")
+    parser.add_argument('output', help="File PDF da scrivere")
+    parser.add_argument('--pages', type=int, default=100)
+    parser.add_argument('--table-ratio', type=float, default=0.15)
+    parser.add_argument('--image-ratio', type=float, default=0.15)
+    parser.add_argument('--duplicate-ratio', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--reference', action='store_true', help="Scrive anche il testo atteso (.txt accanto al PDF)")
+    args = parser.parse_args(argv)
+
+    result = generate_course_pdf(args.output, args.pages, args.table_ratio, args.image_ratio,
+                                 args.duplicate_ratio, args.seed)
+    if args.reference:
+        with open(args.output.rsplit('.', 1)[0] + '.txt', 'w', encoding='utf-8') as f:
+            f.write('\n\n'.join(result['expected_text']))
+    print(f"📄 {args.output}: {args.pages} pagine {result['kinds']}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
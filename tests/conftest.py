@@ -0,0 +1,75 @@
+# conftest.py
+# Fixture comuni: stub locali di OpenAI e Pinecone e CONFIG delle pipeline puntato su di essi
+
+import os
+import sys
+import copy
+import functools
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+@functools.lru_cache(maxsize=None)
+def _byte_encoding_needed() -> bool:
+    """True se tiktoken non riesce a caricare l'encoder reale (i file BPE si scaricano dalla rete)"""
+    import tiktoken
+    try:
+        tiktoken.encoding_for_model('gpt-3.5-turbo')
+        return False
+    except Exception:
+        return True
+
+
+@pytest.fixture
+def offline_tiktoken(monkeypatch):
+    """Encoder reale se disponibile, altrimenti un encoder a byte: i test non dipendono dalla rete"""
+    tiktoken = pytest.importorskip('tiktoken')
+    if _byte_encoding_needed():
+        encoding = tiktoken.Encoding('bytes', pat_str=r"\S+|\s+",
+                                     mergeable_ranks={bytes([i]): i for i in range(256)}, special_tokens={})
+        monkeypatch.setattr(tiktoken, 'encoding_for_model', lambda model: encoding)
+
+
+@pytest.fixture
+def start_stub():
+    """Avvia stub_services.OpenAIStub / PineconeStub su una porta libera e li ferma a fine test"""
+    started = []
+
+    def start(cls, **options):
+        stub = cls(**options).start()
+        started.append(stub)
+        return stub
+
+    yield start
+    for stub in started:
+        stub.stop()
+
+
+@pytest.fixture
+def use_stubs(tmp_path, offline_tiktoken):
+    """CONFIG di una pipeline puntato agli stub, con tutti i file in tmp_path (ripristinato a fine test)"""
+    saved = []
+
+    def use(module, openai_stub=None, pinecone_stub=None):
+        config = module.CONFIG
+        saved.append((config, copy.deepcopy(config)))
+        for key, value in config['paths'].items():
+            if isinstance(value, str):
+                config['paths'][key] = str(tmp_path / value.replace('\\', '/').split('/')[-1])
+        config['openai'].update(api_key='sk-test', batch_poll_seconds=0)
+        if openai_stub:
+            config['openai']['base_url'] = f'{openai_stub.url}/v1'
+        config['pinecone'].update(api_key='pc-test', backend='pinecone', host=None, controller_host=None)
+        if pinecone_stub:
+            config['pinecone']['host'] = pinecone_stub.url
+        config['cache']['enable'] = False
+        return config
+
+    yield use
+    for config, original in reversed(saved):
+        config.clear()
+        config.update(original)
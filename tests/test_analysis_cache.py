@@ -0,0 +1,33 @@
+# test_analysis_cache.py
+# Cache delle analisi: budget del prompt e unità di chunking fanno parte della chiave
+
+import pytest
+
+pytest.importorskip('openai')
+
+from stub_services import OpenAIStub
+from pipeline_metrics import PipelineMetrics
+
+CHAT = 'POST /v1/chat/completions'
+CHUNK = {'id': 'chunk_0', 'chunk_index': 0, 'text': "Gestione delle scorte e previsione della domanda. " * 40}
+
+
+@pytest.mark.parametrize('section, key, value', [
+    ('openai', 'analysis_prompt_tokens', 400),
+    ('processing', 'chunk_unit', 'tokens'),
+])
+def test_changed_setting_misses_the_analysis_cache(start_stub, use_stubs, section, key, value):
+    import preprocess_v4
+
+    stub = start_stub(OpenAIStub)
+    config = use_stubs(preprocess_v4, openai_stub=stub)
+    config['cache']['enable'] = True
+    analyzer = preprocess_v4.SemanticAnalyzer(PipelineMetrics('text'))
+
+    analyzer.analyze_chunk(dict(CHUNK))
+    analyzer.analyze_chunk(dict(CHUNK))
+    assert stub.stats()['requests'][CHAT] == 1
+
+    config[section][key] = value
+    analyzer.analyze_chunk(dict(CHUNK))
+    assert stub.stats()['requests'][CHAT] == 2
@@ -0,0 +1,206 @@
+# test_async_analysis.py
+# Analisi concorrente (AsyncOpenAI) ed embedding batch contro OpenAIStub: ordine, concorrenza, checkpoint
+
+import json
+import asyncio
+import threading
+
+import numpy as np
+import pytest
+
+pytest.importorskip('openai')
+
+from stub_services import OpenAIStub, stub_vector
+from pipeline_checkpoint import PipelineCheckpoint
+
+CONCURRENCY = 4
+
+
+class InFlightStub(OpenAIStub):
+    """OpenAIStub che registra il massimo di richieste servite contemporaneamente"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.in_flight = 0
+        self.peak = 0
+        self.probe = threading.Lock()
+
+    def _handle(self, handler, method):
+        with self.probe:
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        try:
+            super()._handle(handler, method)
+        finally:
+            with self.probe:
+                self.in_flight -= 1
+
+
+class FlakyEmbeddingsStub(OpenAIStub):
+    """OpenAIStub con i primi `rate_limited` embeddings.create in 429 e un 400 per i batch con un input rifiutato"""
+
+    def __init__(self, *args, rate_limited: int = 0, rejected: str = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.rate_limited = rate_limited
+        self.rejected = rejected
+        self.batch_sizes = []
+
+    def route(self, method, path, query, body, headers):
+        if method == 'POST' and path.endswith('/embeddings'):
+            inputs = json.loads(body)['input']
+            self.batch_sizes.append(len(inputs))
+            if self.rate_limited:
+                self.rate_limited -= 1
+                return 429, {'error': {'message': 'Rate limit simulato', 'type': 'requests', 'code': 'rate_limit_exceeded'}}
+            if self.rejected in inputs:
+                return 400, {'error': {'message': 'Input non valido', 'type': 'invalid_request_error'}}
+        return super().route(method, path, query, body, headers)
+
+
+def _chunks(count: int):
+    topics = ['scorte', 'trasporto', 'fornitori', 'previsione', 'magazzino', 'logistica']
+    return [{
+        'id': f'chunk_{i}',
+        'chunk_index': i,
+        'text': f"{topics[i % len(topics)]} " * 5 + f"Paragrafo {i} sulla gestione della supply chain.",
+    } for i in range(count)]
+
+
+@pytest.fixture
+def pipeline(start_stub, use_stubs, tmp_path):
+    """PreprocessingPipeline testuale con indice locale e checkpoint in tmp_path"""
+    import preprocess_v4
+
+    def build(**stub_options):
+        stub = start_stub(InFlightStub, **stub_options)
+        config = use_stubs(preprocess_v4, openai_stub=stub)
+        config['pinecone']['backend'] = 'local'
+        config['processing']['concurrency'] = CONCURRENCY
+        instance = preprocess_v4.PreprocessingPipeline()
+        instance.checkpoint = PipelineCheckpoint(config['paths']['checkpoint_dir'], {'test': 'async'})
+        return instance, stub, config
+
+    return build
+
+
+def test_output_order_matches_input_order(pipeline):
+    instance, stub, _ = pipeline(latency_ms=20, jitter_ms=19, seed=1)
+    chunks = _chunks(24)
+
+    # Generatore come in streaming: il prelievo è limitato dalla finestra
+    result = asyncio.run(instance._analyze_chunks_async(iter(chunks)))
+
+    assert [chunk['id'] for chunk in result] == [chunk['id'] for chunk in chunks]
+    for chunk in result:
+        assert chunk['analysis']['topic'].lower() in chunk['text']
+        assert np.allclose(chunk['embedding'], stub_vector(chunk['text'], 1536), atol=1e-6)
+
+
+def test_in_flight_requests_stay_within_concurrency(pipeline):
+    instance, stub, _ = pipeline(latency_ms=30, jitter_ms=10, seed=2)
+
+    asyncio.run(instance._analyze_chunks_async(_chunks(32)))
+
+    assert 1 < stub.peak <= CONCURRENCY
+
+
+def test_failing_input_cancels_requests_in_flight(pipeline):
+    instance, stub, _ = pipeline(latency_ms=200, seed=5)
+
+    def chunks():
+        yield from _chunks(6)
+        raise RuntimeError('estrazione interrotta')
+
+    async def run():
+        with pytest.raises(RuntimeError):
+            await instance._analyze_chunks_async(chunks())
+        # Nessun task di analisi sopravvive all'errore dell'input
+        return [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+
+    assert asyncio.run(run()) == []
+    assert not instance.checkpoint.chunks
+
+
+def test_checkpoint_journals_only_successful_chunks(pipeline):
+    instance, stub, config = pipeline(latency_ms=5, error_rate=0.6, seed=4)
+    chunks = _chunks(20)
+
+    result = asyncio.run(instance._analyze_chunks_async(chunks))
+    instance.checkpoint.close()
+
+    assert len(result) == len(chunks)
+    failed = {chunk['id'] for chunk in result
+              if chunk['id'] in instance.semantic_analyzer.fallback_ids or chunk['embedding'] is None}
+    assert failed and len(failed) < len(chunks)
+    # Analisi di ripiego ed embedding falliti non sono lavoro finito: la ripresa li rifà
+    resumed = PipelineCheckpoint(config['paths']['checkpoint_dir'], {'test': 'async'}, resume=True)
+    assert sorted(resumed.chunks) == sorted(chunk['id'] for chunk in result if chunk['id'] not in failed)
+    for chunk in result:
+        if chunk['id'] not in failed:
+            assert resumed.chunks[chunk['id']]['analysis'] == chunk['analysis']
+    resumed.close()
+
+
+def test_batch_embeddings_are_aligned_with_inputs(start_stub, use_stubs):
+    import preprocess_v4
+    from pipeline_metrics import PipelineMetrics
+
+    stub = start_stub(OpenAIStub)
+    config = use_stubs(preprocess_v4, openai_stub=stub)
+    config['processing']['embedding_batch_max_items'] = 7
+    analyzer = preprocess_v4.SemanticAnalyzer(PipelineMetrics('text'))
+    texts = [chunk['text'] for chunk in _chunks(30)]
+
+    embeddings = analyzer.generate_embeddings_batch(texts)
+
+    assert stub.stats()['requests']['POST /v1/embeddings'] == 5
+    for text, embedding in zip(texts, embeddings):
+        assert np.allclose(embedding, stub_vector(text, 1536), atol=1e-6)
+
+
+def _embedding_analyzer(start_stub, use_stubs, **stub_options):
+    """SemanticAnalyzer senza retry dell'SDK: gli errori arrivano tutti a _embed_batch"""
+    import preprocess_v4
+    from pipeline_metrics import PipelineMetrics
+
+    stub = start_stub(FlakyEmbeddingsStub, **stub_options)
+    config = use_stubs(preprocess_v4, openai_stub=stub)
+    config['processing'].update(embedding_batch_max_items=8, embedding_backoff_seconds=0.01)
+    analyzer = preprocess_v4.SemanticAnalyzer(PipelineMetrics('text'))
+    analyzer.client = analyzer.client.with_options(max_retries=0)
+    return analyzer, stub, config
+
+
+def test_rate_limited_embedding_batch_is_retried_whole(start_stub, use_stubs):
+    analyzer, stub, config = _embedding_analyzer(start_stub, use_stubs, rate_limited=2)
+    texts = [chunk['text'] for chunk in _chunks(8)]
+
+    embeddings = analyzer.generate_embeddings_batch(texts)
+
+    # Nessuna divisione: tre tentativi dello stesso batch da 8
+    assert stub.batch_sizes == [8, 8, 8]
+    for text, embedding in zip(texts, embeddings):
+        assert np.allclose(embedding, stub_vector(text, 1536), atol=1e-6)
+
+
+def test_exhausted_retries_fail_the_batch_without_splitting(start_stub, use_stubs):
+    analyzer, stub, config = _embedding_analyzer(start_stub, use_stubs, rate_limited=100)
+    texts = [chunk['text'] for chunk in _chunks(8)]
+
+    embeddings = analyzer.generate_embeddings_batch(texts)
+
+    assert stub.batch_sizes == [8] * (config['processing']['embedding_max_retries'] + 1)
+    assert embeddings == [None] * len(texts)
+
+
+def test_rejected_input_is_isolated_by_splitting(start_stub, use_stubs):
+    texts = [chunk['text'] for chunk in _chunks(8)]
+    analyzer, stub, _ = _embedding_analyzer(start_stub, use_stubs, rejected=texts[5])
+
+    embeddings = analyzer.generate_embeddings_batch(texts)
+
+    assert embeddings[5] is None
+    for i, (text, embedding) in enumerate(zip(texts, embeddings)):
+        if i != 5:
+            assert np.allclose(embedding, stub_vector(text, 1536), atol=1e-6)
+    assert max(stub.batch_sizes[1:]) < 8
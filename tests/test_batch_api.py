@@ -0,0 +1,40 @@
+# test_batch_api.py
+# Batch API della pipeline Vision contro OpenAIStub: le richieste fallite si ripetono con i dati del proprio chunk
+
+import pytest
+
+pytest.importorskip('openai')
+pytest.importorskip('pdf2image')
+
+from stub_services import OpenAIStub
+from pipeline_metrics import PipelineMetrics
+
+
+def _chunks(count: int):
+    return [{
+        'id': f'chunk_{i}',
+        'text': f"Capitolo {i}: gestione delle scorte e previsione della domanda nella supply chain.",
+        'page_num': i + 1,
+        'vision_data': {'key_concepts': [f'figura{i}'], 'visual_elements': [{'type': 'diagram'}], 'importance': 5}
+    } for i in range(count)]
+
+
+def test_retried_chunks_keep_their_own_vision_data(start_stub, use_stubs):
+    import preprocess_v4_vision as pipeline
+
+    stub = start_stub(OpenAIStub, error_rate=0.3, seed=3)
+    config = use_stubs(pipeline, openai_stub=stub)
+    config['cache']['enable'] = True
+    analyzer = pipeline.SemanticAnalyzer(PipelineMetrics('vision'))
+    chunks = _chunks(12)
+
+    stats = analyzer.analyze_chunks_batch_api(chunks)
+
+    assert stats['analysis_retried'] > 0
+    for i, chunk in enumerate(chunks):
+        concepts = set(chunk['analysis']['concepts'])
+        assert f'figura{i}' in concepts
+        assert not {f'figura{j}' for j in range(len(chunks)) if j != i} & concepts
+        # La cache è indicizzata dai dati Vision del chunk stesso
+        key = analyzer._analysis_key(chunk, chunk['vision_data'])
+        assert analyzer.cache.get('analysis', key) == chunk['analysis']
@@ -0,0 +1,35 @@
+# test_checkpoint.py
+# Journal del checkpoint: le pagine Vision con risultato di default non sono lavoro finito
+
+import pytest
+
+pytest.importorskip('openai')
+pytest.importorskip('pdf2image')
+
+from openai import OpenAI
+
+from stub_services import OpenAIStub
+from pipeline_checkpoint import PipelineCheckpoint
+
+
+def test_vision_fallback_pages_are_not_journaled(start_stub, use_stubs, monkeypatch):
+    import preprocess_v4_vision as pipeline
+
+    stub = start_stub(OpenAIStub, error_rate=0.5, seed=7)
+    config = use_stubs(pipeline, openai_stub=stub)
+    # Senza retry dell'SDK ogni errore simulato diventa un risultato di default
+    client = OpenAI(api_key='sk-test', base_url=config['openai']['base_url'], max_retries=0)
+    analyzer = pipeline.VisionAnalyzer(client)
+    pages = list(range(1, 6))  # Una pausa anti rate limit ogni 5 pagine
+    monkeypatch.setattr(analyzer, 'iter_page_images',
+                        lambda pdf_path, wanted: ((page, b'immagine %d' % page) for page in wanted))
+    checkpoint = PipelineCheckpoint(config['paths']['checkpoint_dir'], {'test': 'vision'})
+
+    results = analyzer.process_vision_pages('corso.pdf', pages, on_result=checkpoint.append_vision)
+    checkpoint.close()
+
+    assert sorted(results) == pages
+    assert analyzer.fallback_pages and len(analyzer.fallback_pages) < len(pages)
+    resumed = PipelineCheckpoint(config['paths']['checkpoint_dir'], {'test': 'vision'}, resume=True)
+    assert sorted(resumed.vision) == sorted(set(pages) - analyzer.fallback_pages)
+    resumed.close()
@@ -0,0 +1,156 @@
+# test_index_sync.py
+# Sincronizzazione incrementale dell'indice contro PineconeStub: manifest, bootstrap, retry e divisione dei batch
+
+import pytest
+
+pytest.importorskip('pinecone')
+
+from stub_services import PineconeStub, stub_vector
+from pipeline_metrics import PipelineMetrics
+from upsert_engine import UpsertEngine
+
+WRITES = ('POST /vectors/upsert', 'POST /vectors/update', 'POST /vectors/delete')
+
+
+def _chunks(count: int):
+    return [{
+        'id': f'chunk_{i}',
+        'chunk_index': i,
+        'text': f"Paragrafo {i} sulla gestione delle scorte.",
+        'analysis': {'topic': 'scorte', 'concepts': [f'concetto{i}'], 'importance': 5},
+        'embedding': stub_vector(f"Paragrafo {i}", 1536).tolist()
+    } for i in range(count)]
+
+
+def _writes(stub) -> dict:
+    requests = stub.stats()['requests']
+    return {endpoint: requests.get(endpoint, 0) for endpoint in WRITES}
+
+
+@pytest.fixture
+def indexer(start_stub, use_stubs):
+    """VectorIndexer sul data-plane di un PineconeStub; ogni chiamata riapre lo stesso manifest"""
+    import preprocess_v4
+
+    stub = start_stub(PineconeStub, index_name='test-index')
+    use_stubs(preprocess_v4, pinecone_stub=stub)
+
+    def build():
+        instance = preprocess_v4.VectorIndexer(PipelineMetrics('text'))
+        instance.upsert_engine.backoff_base = 0.01
+        return instance
+
+    return build, stub
+
+
+def test_first_sync_bootstraps_and_deletes_obsolete_vectors(indexer):
+    build, stub = indexer
+    # Vettore lasciato da un'esecuzione precedente senza manifest
+    stub.namespaces[''] = {'obsoleto': {'id': 'obsoleto', 'values': [0.0] * 1536}}
+    chunks = _chunks(5)
+
+    indexed = build().sync_chunks(chunks)
+
+    assert indexed == len(chunks)
+    assert sorted(stub.namespaces['']) == sorted(chunk['id'] for chunk in chunks)
+    assert _writes(stub)['POST /vectors/delete'] == 1
+
+
+def test_unchanged_rerun_writes_nothing(indexer):
+    build, stub = indexer
+    chunks = _chunks(5)
+    build().sync_chunks(chunks)
+    before = _writes(stub)
+
+    indexed = build().sync_chunks(chunks)
+
+    assert indexed == len(chunks)
+    assert _writes(stub) == before
+
+
+def test_metadata_change_updates_in_place(indexer):
+    build, stub = indexer
+    chunks = _chunks(5)
+    build().sync_chunks(chunks)
+    before = _writes(stub)
+
+    chunks[2]['analysis']['importance'] = 9
+    build().sync_chunks(chunks)
+
+    after = _writes(stub)
+    assert after['POST /vectors/update'] - before['POST /vectors/update'] == 1
+    assert after['POST /vectors/upsert'] == before['POST /vectors/upsert']
+    assert stub.namespaces['']['chunk_2']['metadata']['importance'] == 9
+
+
+def test_removed_chunk_is_deleted(indexer):
+    build, stub = indexer
+    chunks = _chunks(5)
+    build().sync_chunks(chunks)
+    before = _writes(stub)
+
+    indexed = build().sync_chunks(chunks[:2] + chunks[3:])
+
+    after = _writes(stub)
+    assert indexed == 4
+    assert after['POST /vectors/delete'] - before['POST /vectors/delete'] == 1
+    assert after['POST /vectors/upsert'] == before['POST /vectors/upsert']
+    assert 'chunk_2' not in stub.namespaces['']
+
+
+def test_chunk_without_embedding_keeps_its_vector(indexer):
+    build, stub = indexer
+    chunks = _chunks(5)
+    build().sync_chunks(chunks)
+    before = _writes(stub)
+
+    # Embedding fallito in questa esecuzione: il chunk esiste ancora
+    chunks[3]['embedding'] = None
+    indexed = build().sync_chunks(chunks)
+
+    assert indexed == 4
+    assert _writes(stub) == before
+    assert 'chunk_3' in stub.namespaces['']
+    # Anche il manifest lo conserva: l'esecuzione successiva non lo riscrive
+    build().sync_chunks(_chunks(5))
+    assert _writes(stub) == before
+
+
+def _engine(stub, **options) -> UpsertEngine:
+    import pinecone
+
+    # Gli SDK recenti ritentano già da soli: senza i loro retry gli errori arrivano al motore
+    client_options = {}
+    if hasattr(pinecone, 'RetryConfig'):
+        client_options['retry_config'] = pinecone.RetryConfig(max_retries=0)
+    index = pinecone.Pinecone(api_key='pc-test', **client_options).Index('test-index', host=stub.url)
+    return UpsertEngine(index, backoff_base=0.01, **options)
+
+
+def _vectors(count: int):
+    return [{'id': f'v{i}', 'values': stub_vector(f'v{i}', 8).tolist(), 'metadata': {'n': i}} for i in range(count)]
+
+
+def test_upsert_retries_transient_errors(start_stub):
+    stub = start_stub(PineconeStub, dimension=8, error_rate=0.3, seed=5)
+    vectors = _vectors(40)
+
+    result = _engine(stub, max_batch_records=4, max_retries=10).upsert(vectors, progress=False)
+
+    assert stub.stats()['total_errors'] > 0
+    assert result.retries > 0
+    assert result.upserted == len(vectors) and not result.failed
+    assert sorted(stub.namespaces['']) == sorted(vector['id'] for vector in vectors)
+
+
+def test_rejected_batch_is_split_down_to_the_bad_vector(start_stub):
+    # Indice coseno: Pinecone rifiuta con 400 i batch che contengono un vettore sparse
+    stub = start_stub(PineconeStub, dimension=8)
+    vectors = _vectors(8)
+    vectors[5]['sparse_values'] = {'indices': [1], 'values': [0.5]}
+
+    result = _engine(stub).upsert(vectors, progress=False)
+
+    assert result.failed_ids == ['v5']
+    assert result.upserted == 7
+    assert sorted(stub.namespaces['']) == sorted(vector['id'] for vector in vectors if vector['id'] != 'v5')
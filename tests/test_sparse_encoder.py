@@ -0,0 +1,58 @@
+# test_sparse_encoder.py
+# Statistiche BM25 dell'encoder sparse: le esecuzioni parziali si fondono con il modello salvato
+
+import pytest
+
+from sparse_encoder import SparseEncoder
+
+TEXTS = {
+    'chunk_0': "gestione delle scorte di magazzino",
+    'chunk_1': "previsione della domanda e scorte di sicurezza",
+    'chunk_2': "trasporto e distribuzione delle merci",
+    'chunk_3': "fornitori e acquisti nella supply chain",
+}
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'sparse_vocabulary.json')
+
+
+def _fit(path, ids):
+    encoder = SparseEncoder(path)
+    encoder.encode_documents([TEXTS[doc_id] for doc_id in ids], ids=ids)
+    encoder.save()
+    return SparseEncoder(path)
+
+
+def test_partial_run_keeps_statistics_of_other_chunks(path):
+    full = _fit(path, list(TEXTS))
+    idf = {term: full.idf(term) for term in full.doc_freq}
+
+    partial = _fit(path, ['chunk_1'])
+
+    assert partial.n_docs == len(TEXTS)
+    assert {term: partial.idf(term) for term in partial.doc_freq} == idf
+
+
+def test_changed_chunk_replaces_its_own_contribution(path):
+    _fit(path, list(TEXTS))
+    changed = "trasporto su gomma"
+    encoder = SparseEncoder(path)
+
+    encoder.fit([changed], ids=['chunk_0'])
+
+    assert encoder.n_docs == len(TEXTS)
+    assert encoder.doc_freq['scorte'] == 1
+    assert encoder.doc_freq['trasporto'] == 2
+    assert 'magazzino' not in encoder.doc_freq
+
+
+def test_forget_removes_deleted_chunks(path):
+    encoder = _fit(path, list(TEXTS))
+
+    encoder.forget(['chunk_2', 'chunk_3'])
+
+    assert encoder.n_docs == 2
+    assert 'merci' not in encoder.doc_freq
+    assert encoder.doc_freq['scorte'] == 2
@@ -0,0 +1,65 @@
+# token_budget.py
+# Misure in token (tiktoken) per chunking e prompt: niente tagli a caratteri che sprecano o troncano
+
+from typing import Iterable, Iterator, List, Tuple
+
+
+class TokenBudget:
+    """Conteggi, troncamenti e assemblaggio di prompt entro un numero esatto di token"""
+
+    def __init__(self, encoding, batch_size: int = 256):
+        self.encoding = encoding
+        self.batch_size = batch_size
+
+    def encode(self, text: str) -> List[int]:
+        # Il testo del PDF può contenere "<|endoftext|>": va trattato come testo normale
+        return self.encoding.encode(text, disallowed_special=())
+
+    def count(self, text: str) -> int:
+        return len(self.encode(text))
+
+    def count_batch(self, texts: List[str]) -> List[int]:
+        return [len(tokens) for tokens in self.encoding.encode_batch(texts, disallowed_special=())]
+
+    def measure(self, texts: Iterable[str]) -> Iterator[Tuple[str, int]]:
+        """Coppie (testo, token) codificando a blocchi con encode_batch; consuma l'input in modo pigro"""
+        window = []
+        for text in texts:
+            window.append(text)
+            if len(window) >= self.batch_size:
+                yield from zip(window, self.count_batch(window))
+                window = []
+        if window:
+            yield from zip(window, self.count_batch(window))
+
+    def _prefix_chars(self, tokens: List[int]) -> int:
+        """Caratteri coperti dai token indicati (un carattere spezzato tra due token non conta)"""
+        return len(self.encoding.decode_bytes(tokens).decode('utf-8', errors='ignore'))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Prefisso del testo lungo al massimo max_tokens token"""
+        tokens = self.encode(text)
+        if len(tokens) <= max_tokens:
+            return text
+        return text[:self._prefix_chars(tokens[:max(max_tokens, 0)])]
+
+    def tail_start(self, text: str, n_tokens: int) -> int:
+        """Posizione (in caratteri) da cui iniziano gli ultimi n_tokens token del testo"""
+        tokens = self.encode(text)
+        if n_tokens <= 0:
+            return len(text)
+        if n_tokens >= len(tokens):
+            return 0
+        return self._prefix_chars(tokens[:-n_tokens])
+
+    def fit(self, prefix: str, text: str, suffix: str, budget: int) -> str:
+        """Prompt prefix + text + suffix entro `budget` token, accorciando solo il testo"""
+        available = budget - self.count(prefix) - self.count(suffix)
+        fitted = self.truncate(text, available)
+        prompt = prefix + fitted + suffix
+        # Ai confini i token possono fondersi diversamente: si accorcia finché il totale rientra
+        while self.count(prompt) > budget and fitted:
+            available -= 1
+            fitted = self.truncate(fitted, available)
+            prompt = prefix + fitted + suffix
+        return prompt
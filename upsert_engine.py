@@ -0,0 +1,190 @@
+# upsert_engine.py
+# Upsert parallelo in Pinecone con batch dimensionati in byte, retry e report degli ID falliti
+
+import json
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, List, Optional
+
+# Status HTTP per cui ha senso ritentare
+TRANSIENT_STATUS = {408, 429, 500, 502, 503, 504}
+
+# Status per cui si divide il batch invece di scartarlo per intero
+SPLITTABLE_STATUS = {400, 413, 422}
+
+
+class UpsertResult:
+    """Esito di un'operazione: vettori elaborati, ID falliti con errore, retry effettuati"""
+
+    def __init__(self):
+        self.upserted = 0
+        self.batches = 0
+        self.retries = 0
+        self.failed: Dict[str, str] = {}
+
+    @property
+    def failed_ids(self) -> List[str]:
+        return sorted(self.failed)
+
+    def to_dict(self) -> Dict:
+        return {
+            'upserted': self.upserted,
+            'batches': self.batches,
+            'retries': self.retries,
+            'failed_ids': self.failed_ids
+        }
+
+
+class UpsertEngine:
+    """Esegue gli upsert di un indice Pinecone (o di un fake con la stessa interfaccia)"""
+
+    def __init__(self, index: Any, max_batch_bytes: int = 2 * 1024 * 1024, max_batch_records: int = 1000,
+                 concurrency: int = 4, max_retries: int = 5, backoff_base: float = 0.5,
+                 namespace: Optional[str] = None, metrics=None, service: str = 'pinecone'):
+        self.index = index
+        self.max_batch_bytes = max_batch_bytes
+        self.max_batch_records = max_batch_records
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.namespace = namespace
+        self.metrics = metrics  # PipelineMetrics opzionale: latenza, retry ed errori per endpoint
+        self.service = service  # Prefisso degli endpoint nelle metriche (pinecone | local)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def vector_size(vector: Dict) -> int:
+        """Stima dei byte del vettore nel payload JSON"""
+        return len(json.dumps(vector, ensure_ascii=False).encode('utf-8'))
+
+    def make_batches(self, vectors: List[Dict]) -> List[List[Dict]]:
+        """Raggruppa i vettori rispettando limite di byte e di record per richiesta"""
+        # Margine per l'involucro della richiesta ({"vectors": [...], "namespace": ...})
+        budget = self.max_batch_bytes - 1024
+        batches, current, current_bytes = [], [], 0
+
+        for vector in vectors:
+            size = self.vector_size(vector) + 1
+            if current and (len(current) >= self.max_batch_records or current_bytes + size > budget):
+                batches.append(current)
+                current, current_bytes = [], 0
+            current.append(vector)
+            current_bytes += size
+
+        if current:
+            batches.append(current)
+        return batches
+
+    @staticmethod
+    def _status(error: Exception) -> Optional[int]:
+        for attr in ('status', 'status_code', 'code'):
+            value = getattr(error, attr, None)
+            if isinstance(value, int):
+                return value
+        return None
+
+    def is_transient(self, error: Exception) -> bool:
+        """Errori di rete/timeout (senza status) e 408/429/5xx sono transitori"""
+        status = self._status(error)
+        return status is None or status in TRANSIENT_STATUS
+
+    def _send(self, batch: List[Dict]):
+        if self.namespace:
+            self.index.upsert(vectors=batch, namespace=self.namespace)
+        else:
+            self.index.upsert(vectors=batch)
+
+    def _send_update(self, batch: List[Dict]):
+        """Aggiorna solo i metadata (un vettore per richiesta, come da API)"""
+        for vector in batch:
+            kwargs = {'id': vector['id'], 'set_metadata': vector['metadata']}
+            if self.namespace:
+                kwargs['namespace'] = self.namespace
+            self.index.update(**kwargs)
+
+    def _send_delete(self, batch: List[Dict]):
+        kwargs = {'ids': [vector['id'] for vector in batch]}
+        if self.namespace:
+            kwargs['namespace'] = self.namespace
+        self.index.delete(**kwargs)
+
+    def _run_batch(self, batch: List[Dict], result: UpsertResult, send: Callable[[List[Dict]], None],
+                   endpoint: str = 'pinecone'):
+        """Esegue un batch con backoff esponenziale; payload rifiutati vengono divisi a metà"""
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                send(batch)
+                if self.metrics:
+                    self.metrics.observe(endpoint, time.perf_counter() - start)
+                with self._lock:
+                    result.upserted += len(batch)
+                return
+            except Exception as e:
+                status = self._status(e)
+                if self.metrics:
+                    self.metrics.observe(endpoint, time.perf_counter() - start)
+                    self.metrics.increment('errors', endpoint=endpoint, status=status or 'network')
+
+                # Payload troppo grande o vettore non valido: dividi per isolare i record problematici
+                if status in SPLITTABLE_STATUS and len(batch) > 1:
+                    middle = len(batch) // 2
+                    self._run_batch(batch[:middle], result, send, endpoint)
+                    self._run_batch(batch[middle:], result, send, endpoint)
+                    return
+
+                if not self.is_transient(e) or attempt >= self.max_retries:
+                    with self._lock:
+                        for vector in batch:
+                            result.failed[vector['id']] = str(e)
+                    return
+
+                attempt += 1
+                with self._lock:
+                    result.retries += 1
+                if self.metrics:
+                    self.metrics.increment('retries', endpoint=endpoint)
+                delay = self.backoff_base * (2 ** (attempt - 1))
+                time.sleep(delay + random.uniform(0, delay))
+
+    def _execute(self, batches: List[List[Dict]], send: Callable[[List[Dict]], None],
+                 label: str, progress: bool, endpoint: str = 'pinecone') -> UpsertResult:
+        """Esegue i batch con al massimo `concurrency` richieste in parallelo"""
+        result = UpsertResult()
+        result.batches = len(batches)
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [executor.submit(self._run_batch, batch, result, send, endpoint) for batch in batches]
+            if self.metrics:
+                self.metrics.set_gauge(f'{self.service}_batches', len(batches))
+            for done, future in enumerate(as_completed(futures), 1):
+                future.result()
+                if self.metrics:
+                    self.metrics.set_gauge(f'{self.service}_batches', len(batches) - done)
+                if progress:
+                    print(f"\r  ✓ {label} {done}/{len(batches)} ({result.upserted} vettori)", end='')
+
+        if progress and batches:
+            print()
+        return result
+
+    def upsert(self, vectors: List[Dict], progress: bool = True) -> UpsertResult:
+        """Upsert di tutti i vettori con al massimo `concurrency` richieste in parallelo"""
+        return self._execute(self.make_batches(vectors), self._send, "Batch", progress,
+                             f'{self.service} /vectors/upsert')
+
+    def update_metadata(self, vectors: List[Dict], progress: bool = True) -> UpsertResult:
+        """Aggiorna in place i metadata dei vettori (valori invariati)"""
+        return self._execute([[vector] for vector in vectors], self._send_update, "Metadata", progress,
+                             f'{self.service} /vectors/update')
+
+    def delete(self, ids: List[str], progress: bool = True) -> UpsertResult:
+        """Elimina i vettori indicati, a blocchi di max_batch_records ID"""
+        records = [{'id': vector_id} for vector_id in ids]
+        size = self.max_batch_records
+        batches = [records[i:i + size] for i in range(0, len(records), size)]
+        return self._execute(batches, self._send_delete, "Delete", progress,
+                             f'{self.service} /vectors/delete')
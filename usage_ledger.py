@@ -0,0 +1,161 @@
+# usage_ledger.py
+# Registro dei token realmente consumati (campo usage delle risposte OpenAI) per fase e modello
+# Il listino prezzi trasforma i token in costo: niente più stime fisse per pagina o per chunk
+
+import os
+import sys
+import json
+import math
+import argparse
+import threading
+from typing import Dict, List, Optional
+
+# Cartella dei dati della pipeline (default dei comandi), relativa allo script
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'processed-v4')
+
+# USD per milione di token (listino OpenAI standard; la Batch API costa la metà).
+# cached_input è il prezzo dei token del prompt serviti dalla cache automatica dei prompt.
+PRICING = {
+    'gpt-4o-mini': {'input': 0.15, 'cached_input': 0.075, 'output': 0.60},
+    'gpt-4o': {'input': 2.50, 'cached_input': 1.25, 'output': 10.00},
+    'gpt-4-turbo': {'input': 10.00, 'cached_input': 10.00, 'output': 30.00},
+    'gpt-4': {'input': 30.00, 'cached_input': 30.00, 'output': 60.00},
+    'gpt-3.5-turbo': {'input': 0.50, 'cached_input': 0.50, 'output': 1.50},
+    'text-embedding-3-small': {'input': 0.02, 'cached_input': 0.02, 'output': 0.0},
+    'text-embedding-3-large': {'input': 0.13, 'cached_input': 0.13, 'output': 0.0},
+    'text-embedding-ada-002': {'input': 0.10, 'cached_input': 0.10, 'output': 0.0},
+}
+BATCH_DISCOUNT = 0.5
+
+
+def model_price(model: str, pricing: Dict[str, Dict] = PRICING) -> Optional[Dict]:
+    """Prezzo del modello; le versioni datate (gpt-4o-2024-08-06) usano il prefisso più lungo noto"""
+    if model in pricing:
+        return pricing[model]
+    matches = [name for name in pricing if model.startswith(name + '-')]
+    return pricing[max(matches, key=len)] if matches else None
+
+
+def _field(obj, name: str, default=0):
+    """Campo di un oggetto usage dell'SDK o del dict di una risposta della Batch API"""
+    value = obj.get(name) if isinstance(obj, dict) else getattr(obj, name, None)
+    return default if value is None else value
+
+
+def image_tokens(width: int, height: int, detail: str = 'high') -> int:
+    """Token di input di un'immagine per i modelli gpt-4o: 85 fissi + 170 per riquadro di 512 px.
+
+    Con detail high l'immagine è ridotta entro 2048x2048 e poi col lato corto a 768 px.
+    """
+    if detail == 'low':
+        return 85
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+
+class UsageLedger:
+    """Token e costo per (fase, modello, batch); condiviso tra client sync, async e Batch API"""
+
+    def __init__(self, pricing: Dict[str, Dict] = PRICING):
+        self.pricing = pricing
+        self.entries: Dict[tuple, Dict] = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, model: str, usage, batch: bool = False):
+        """Registra l'usage di una risposta (None se la risposta non lo riporta)"""
+        prompt = _field(usage, 'prompt_tokens') if usage is not None else 0
+        completion = _field(usage, 'completion_tokens') if usage is not None else 0
+        details = _field(usage, 'prompt_tokens_details', None) if usage is not None else None
+        cached = _field(details, 'cached_tokens') if details is not None else 0
+
+        with self._lock:
+            entry = self.entries.setdefault((stage, model, batch), {
+                'stage': stage, 'model': model, 'batch': batch, 'calls': 0, 'calls_without_usage': 0,
+                'prompt_tokens': 0, 'cached_tokens': 0, 'completion_tokens': 0
+            })
+            entry['calls'] += 1
+            if usage is None:
+                entry['calls_without_usage'] += 1
+            entry['prompt_tokens'] += prompt
+            entry['cached_tokens'] += cached
+            entry['completion_tokens'] += completion
+
+    def record_response(self, stage: str, response, model: str, batch: bool = False):
+        """Registra una risposta dell'SDK o un body della Batch API; il modello riportato ha la precedenza"""
+        self.record(stage, _field(response, 'model', None) or model, _field(response, 'usage', None), batch)
+
+    def cost(self, entry: Dict) -> Optional[float]:
+        price = model_price(entry['model'], self.pricing)
+        if price is None:
+            return None
+        uncached = entry['prompt_tokens'] - entry['cached_tokens']
+        cost = (uncached * price['input'] + entry['cached_tokens'] * price['cached_input'] +
+                entry['completion_tokens'] * price['output']) / 1_000_000
+        return cost * BATCH_DISCOUNT if entry['batch'] else cost
+
+    def total_cost(self, stage: Optional[str] = None) -> float:
+        """Costo in USD (di una fase o complessivo); i modelli senza prezzo non contano"""
+        with self._lock:
+            entries = [entry for entry in self.entries.values() if stage is None or entry['stage'] == stage]
+        return sum(self.cost(entry) or 0.0 for entry in entries)
+
+    def to_dict(self) -> Dict:
+        """Registro per il metadata: righe per fase e modello, totali per fase e complessivi"""
+        with self._lock:
+            entries = [dict(entry) for entry in self.entries.values()]
+
+        by_stage: Dict[str, Dict] = {}
+        for entry in entries:
+            cost = self.cost(entry)
+            entry['cost_usd'] = round(cost, 6) if cost is not None else None
+            # Medie per chiamata: la base per calibrare dimensione dei prompt e DPI
+            entry['avg_prompt_tokens'] = round(entry['prompt_tokens'] / entry['calls'], 1)
+            entry['avg_completion_tokens'] = round(entry['completion_tokens'] / entry['calls'], 1)
+            stage = by_stage.setdefault(entry['stage'], {'calls': 0, 'prompt_tokens': 0, 'cached_tokens': 0,
+                                                         'completion_tokens': 0, 'cost_usd': 0.0})
+            for key in ('calls', 'prompt_tokens', 'cached_tokens', 'completion_tokens'):
+                stage[key] += entry[key]
+            stage['cost_usd'] = round(stage['cost_usd'] + (cost or 0.0), 6)
+        for stage in by_stage.values():
+            stage['avg_cost_usd'] = round(stage['cost_usd'] / stage['calls'], 6) if stage['calls'] else None
+
+        return {
+            'entries': sorted(entries, key=lambda entry: (entry['stage'], entry['model'], entry['batch'])),
+            'by_stage': by_stage,
+            'total_tokens': sum(entry['prompt_tokens'] + entry['completion_tokens'] for entry in entries),
+            'total_cost_usd': round(sum(stage['cost_usd'] for stage in by_stage.values()), 6),
+            'unpriced_models': sorted({entry['model'] for entry in entries if entry['cost_usd'] is None}),
+            'pricing': {model: self.pricing[model] for model in sorted(self.pricing)
+                        if any(model_price(entry['model'], self.pricing) is self.pricing[model] for entry in entries)}
+        }
+
+
+def main(argv: List[str] = None):
+    """Costi registrati nel metadata di un'esecuzione"""
+    parser = argparse.ArgumentParser(description="Token e costi di un'esecuzione della pipeline")
+    parser.add_argument('metadata', nargs='?', default=os.path.join(DATA_DIR, 'metadata_vision.json'))
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.metadata):
+        print(f"❌ Metadata non trovato: {args.metadata}")
+        return 1
+    with open(args.metadata, 'r', encoding='utf-8') as f:
+        usage = json.load(f).get('usage')
+    if not usage:
+        print("❌ Il metadata non contiene il registro dei token (esecuzione precedente all'introduzione)")
+        return 1
+
+    for entry in usage['entries']:
+        cost = f"${entry['cost_usd']:.4f}" if entry['cost_usd'] is not None else 'prezzo sconosciuto'
+        print(f"  • {entry['stage']} {entry['model']}{' (batch)' if entry['batch'] else ''}: {entry['calls']} chiamate, "
+              f"{entry['prompt_tokens']} token prompt ({entry['cached_tokens']} in cache), "
+              f"{entry['completion_tokens']} di output → {cost}")
+    print(f"💰 Totale: ${usage['total_cost_usd']:.4f} ({usage['total_tokens']} token)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())